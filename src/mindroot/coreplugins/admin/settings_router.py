@@ -7,6 +7,7 @@ from lib.providers.commands import command, command_manager
 from lib.providers import services
 from lib.providers.commands import command_manager
 from lib.db.organize_models import organize_for_display
+from mindroot.registry import data_access
 from copy import deepcopy
 
 router = APIRouter()
@@ -27,6 +28,7 @@ def read_settings() -> List[Dict]:
 def write_settings(settings: List[Dict]):
     with open(SETTINGS_FILE_PATH, 'w') as settings_file:
         json.dump(settings, settings_file, indent=4)
+    data_access.invalidate()
 
 # Helper function to read models file
 def read_models() -> List[Dict]:
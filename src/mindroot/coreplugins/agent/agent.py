@@ -10,10 +10,11 @@ from lib.providers.hooks import hook_manager
 from lib.pipelines.pipe import pipeline_manager
 from lib.providers.services import service
 from lib.providers.services import service_manager
-from lib.json_str_block import replace_raw_blocks
+from lib.json_str_block import replace_raw_blocks, RawBlockRewriter
+from lib.json_escape import JsonEscaper
 import sys
 from lib.utils.check_args import *
-from .command_parser import parse_streaming_commands, invalid_start_format
+from .command_parser import parse_streaming_commands, invalid_start_format, StreamingCommandParser
 from datetime import datetime
 import pytz
 import traceback
@@ -83,6 +84,57 @@ async def get_agent_data(agent_name, context=None):
     return agent_data
 
 
+# template file name -> (mtime, source), and compiled templates by source
+_template_files = {}
+_compiled_templates = {}
+
+# rendered static system message parts, see Agent.render_static_system_msg()
+_static_system_msgs = {}
+MAX_STATIC_SYSTEM_MSGS = 64
+
+def read_template(name):
+    """Read a template from this directory, rereading it only if it changed."""
+    path = os.path.join(os.path.dirname(__file__), name)
+    mtime = os.stat(path).st_mtime_ns
+    cached = _template_files.get(name)
+    if cached is None or cached[0] != mtime:
+        with open(path, "r") as f:
+            cached = (mtime, f.read())
+        _template_files[name] = cached
+    return cached[1]
+
+def compile_template(source):
+    if source not in _compiled_templates:
+        _compiled_templates[source] = Template(source)
+    return _compiled_templates[source]
+
+# commands declared with @command(flags=[PARALLEL_FLAG]) don't depend on the
+# output of the commands next to them, so a run of them in one response is
+# executed concurrently
+PARALLEL_FLAG = 'parallel'
+
+# commands with one of these flags have no side effects that later commands
+# depend on, so they are started as soon as they are complete in the stream
+# while the rest of the response is still being generated. None of the core
+# commands qualifies (they all send output), plugins declare them with e.g.
+# @command(flags=['read_only'])
+SPECULATIVE_FLAGS = ['read_only', 'idempotent']
+
+def command_has_flag(cmd_name, flag):
+    """True if every registered implementation of the command declares the flag."""
+    functions = command_manager.functions.get(cmd_name)
+    if not functions:
+        return False
+    return all(flag in (func_info['flags'] or []) for func_info in functions)
+
+async def run_concurrently(coros):
+    """Run coroutines concurrently and return their results in order."""
+    if hasattr(asyncio, 'TaskGroup'):
+        async with asyncio.TaskGroup() as group:
+            tasks = [group.create_task(coro) for coro in coros]
+        return [task.result() for task in tasks]
+    return await asyncio.gather(*coros)
+
 def find_new_substring(s1, s2):
     if s1 in s2:
         return s2.replace(s1, '', 1)
@@ -102,13 +154,12 @@ class Agent:
         self.agent = agent
 
         if sys_core_template is None:
-            system_template_path = os.path.join(os.path.dirname(__file__), "system.j2")
-            with open(system_template_path, "r") as f:
-                self.sys_core_template = f.read()
+            self.sys_core_template = read_template("system.j2")
         else:
             self.sys_core_template = sys_core_template
 
-        self.sys_template = Template(self.sys_core_template)
+        self.sys_template = compile_template(self.sys_core_template)
+        self.context_template = compile_template(read_template("system_context.j2"))
 
         self.cmd_handler = {}
         self.context = context
@@ -141,8 +192,7 @@ class Agent:
             "arguments": cmd_args,
             "context": str(context)
         })
-        context.chat_log.add_message({"role": "assistant", "content": [{"type": "text", 
-                                                                       "text": '['+json_cmd+']' }]})
+        context.chat_log.add_commands([{cmd_name: cmd_args}])
         command_manager.context = context
         # cmd_args might be a single arg like integer or string, or it may be an array, or an object/dict with named args
         try:
@@ -232,76 +282,138 @@ class Agent:
             return None, buffer
 
 
+    async def run_cmd(self, cmd_name, cmd_args, cmd, context):
+        result = await self.handle_cmds(cmd_name, cmd_args, json_cmd=json.dumps(cmd), context=context)
+        await context.command_result(cmd_name, result)
+        return result
+
     async def parse_cmd_stream(self, stream, context):
         buffer = ""
         results = []
         full_cmds = []
+        # parallel commands waiting to run, as (cmd_name, cmd_args, cmd)
+        parallel_cmds = []
+        # commands started while streaming, as (cmd_name, cmd_args, task)
+        speculative_cmds = []
+        speculate = os.environ.get('AH_SPECULATIVE_COMMANDS', '1').lower() not in ['0', 'false', 'no']
+
+        def add_result(cmd_name, cmd_args, result):
+            sys_header = "Note: tool command results follow, not user replies" 
+            full_cmds.append({ "SYSTEM": sys_header, "cmd": cmd_name, "args": cmd_args, "result": result})
+            if result is not None:
+                results.append({"SYSTEM": sys_header, "cmd": cmd_name, "args": { "omitted": "(see command msg.)"}, "result": result})
+
+        async def run_parallel_cmds():
+            # speculative commands were parsed before the batched ones
+            if speculative_cmds:
+                started = list(speculative_cmds)
+                speculative_cmds.clear()
+                started_results = await asyncio.gather(*[task for _, _, task in started])
+                for (cmd_name, cmd_args, _), result in zip(started, started_results):
+                    add_result(cmd_name, cmd_args, result)
+            if not parallel_cmds:
+                return
+            batch = list(parallel_cmds)
+            parallel_cmds.clear()
+            logger.debug(f"Running {len(batch)} commands concurrently")
+            batch_results = await run_concurrently([self.run_cmd(cmd_name, cmd_args, cmd, context)
+                                                    for cmd_name, cmd_args, cmd in batch])
+            for (cmd_name, cmd_args, _), result in zip(batch, batch_results):
+                add_result(cmd_name, cmd_args, result)
 
         num_processed = 0
         parse_failed = False
+        raw_rewriter = None
+        json_escaper = None
+        parser = StreamingCommandParser()
         
-        async for part in stream:
-            buffer += part
-            logger.debug(f"Current buffer: ||{buffer}||")
+        try:
+            async for part in stream:
+                buffer += part
 
-            if invalid_start_format(buffer):
-                context.chat_log.add_message({"role": "assistant", "content": buffer})
+                if invalid_start_format(buffer):
+                    context.chat_log.add_message({"role": "assistant", "content": buffer})
  
-                results.append({"cmd": "UNKNOWN", "args": { "invalid": "("}, "result": error_result})
-                return results, full_cmds 
- 
-            commands, partial_cmd = parse_streaming_commands(buffer)
-            if not isinstance(commands, list):
-                commands = [commands]
-
-            logger.debug(f"commands: {commands}, partial_cmd: {partial_cmd}")
-
-            if len(commands) > num_processed:
-                logger.debug("New command(s) found")
-                for i in range(num_processed, len(commands)):
-                    try:
-                        cmd = commands[i]
+                    results.append({"cmd": "UNKNOWN", "args": { "invalid": "("}, "result": error_result})
+                    return results, full_cmds 
+
+                if not parse_failed:
+                    parser.feed(part)
+                    if parser.failed:
+                        # not strict enough JSON for the incremental parser,
+                        # fall back to re-parsing the whole buffer
+                        logger.warning("Incremental command parse failed, falling back to full buffer parsing")
+                        parse_failed = True
+                        raw_rewriter = RawBlockRewriter()
+                        json_escaper = JsonEscaper()
+
+                if parse_failed:
+                    commands, partial_cmd = parse_streaming_commands(buffer, raw_rewriter, json_escaper)
+                    if not isinstance(commands, list):
+                        commands = [commands]
+                else:
+                    commands, partial_cmd = parser.commands, parser.partial
+
+                if len(commands) > num_processed:
+                    logger.debug("New command(s) found")
+                    for i in range(num_processed, len(commands)):
                         try:
-                            cmd_name = next(iter(cmd))
+                            cmd = commands[i]
+                            try:
+                                cmd_name = next(iter(cmd))
+                            except Exception as e:
+                                print("next iter failed. cmd is")
+                                print(cmd)
+                                break
+                            if isinstance(cmd, str):
+                                print("\033[91m" + "Invalid command format, expected object, trying to parse anyway" + "\033[0m")
+                                print("\033[91m" + str(cmd) + "\033[0m")
+                                cmd = json.loads(cmd)
+                                cmd_name = next(iter(cmd))
+                            cmd_args = cmd[cmd_name]
+                            logger.debug(f"Processing command: {cmd}")
+                            await context.partial_command(cmd_name, json.dumps(cmd_args), cmd_args, complete=True)
+
+                            if speculate and not parallel_cmds and \
+                                    any(command_has_flag(cmd_name, flag) for flag in SPECULATIVE_FLAGS):
+                                # start now and keep reading the stream, the result
+                                # is collected before the next command that has to wait
+                                task = asyncio.ensure_future(self.run_cmd(cmd_name, cmd_args, cmd, context))
+                                speculative_cmds.append((cmd_name, cmd_args, task))
+                            elif command_has_flag(cmd_name, PARALLEL_FLAG) or \
+                                    any(command_has_flag(cmd_name, flag) for flag in SPECULATIVE_FLAGS):
+                                # runs together with the parallel commands next to it
+                                parallel_cmds.append((cmd_name, cmd_args, cmd))
+                            else:
+                                # other commands (e.g. say) keep their order
+                                await run_parallel_cmds()
+                                result = await self.run_cmd(cmd_name, cmd_args, cmd, context)
+                                add_result(cmd_name, cmd_args, result)
+
+                            num_processed = len(commands)
                         except Exception as e:
-                            print("next iter failed. cmd is")
-                            print(cmd)
-                            break
-                        if isinstance(cmd, str):
-                            print("\033[91m" + "Invalid command format, expected object, trying to parse anyway" + "\033[0m")
-                            print("\033[91m" + str(cmd) + "\033[0m")
-                            cmd = json.loads(cmd)
-                            cmd_name = next(iter(cmd))
-                        cmd_args = cmd[cmd_name]
-                        logger.debug(f"Processing command: {cmd}")
-                        await context.partial_command(cmd_name, json.dumps(cmd_args), cmd_args)
-
-                        result = await self.handle_cmds(cmd_name, cmd_args, json_cmd=json.dumps(cmd), context=context)
-                        await context.command_result(cmd_name, result)
-                        sys_header = "Note: tool command results follow, not user replies" 
-                        full_cmds.append({ "SYSTEM": sys_header, "cmd": cmd_name, "args": cmd_args, "result": result})
-                        if result is not None:
-                            results.append({"SYSTEM": sys_header, "cmd": cmd_name, "args": { "omitted": "(see command msg.)"}, "result": result})
-
-                        num_processed = len(commands)
-                    except Exception as e:
-                        trace = traceback.format_exc()
-                        logger.error(f"Error processing command: {e} \n{trace}")
-                        logger.error(str(e))
-                        pass
-            else:
-                logger.debug("No new commands found")
-                if partial_cmd is not None and partial_cmd != {}:
-                    logger.debug(f"Partial command {partial_cmd}")
-                    try:
-                        cmd_name = next(iter(partial_cmd))
-                        cmd_args = partial_cmd[cmd_name]
-                        logger.debug(f"Partial command detected: {partial_cmd}")
-                        await context.partial_command(cmd_name, json.dumps(cmd_args), cmd_args)
-                    except json.JSONDecodeError as de:
-                        logger.error("Failed to parse partial command")
-                        logger.error(str(de))
-                        pass
+                            trace = traceback.format_exc()
+                            logger.error(f"Error processing command: {e} \n{trace}")
+                            logger.error(str(e))
+                            pass
+                else:
+                    if partial_cmd is not None and partial_cmd != {}:
+                        try:
+                            cmd_name = next(iter(partial_cmd))
+                            cmd_args = partial_cmd[cmd_name]
+                            # chunk (the JSON of the arguments) is only built if it is sent
+                            await context.partial_command(cmd_name, None, cmd_args)
+                        except json.JSONDecodeError as de:
+                            logger.error("Failed to parse partial command")
+                            logger.error(str(de))
+                            pass
+        except BaseException:
+            # e.g. the stream failed or the task was cancelled
+            for _, _, task in speculative_cmds:
+                task.cancel()
+            raise
+
+        await run_parallel_cmds()
 
         #print("\033[92m" + str(full_cmds) + "\033[0m")
         # getting false positive on this check
@@ -318,21 +430,44 @@ class Agent:
  
         return results, full_cmds
 
+    def render_static_system_msg(self):
+        """Render the part of the system message that only depends on the agent.
+
+        It is cached per agent version and template, so the start of the
+        system message stays byte-identical across iterations and turns and
+        provider-side prompt caching can reuse it.
+        """
+        commands = self.agent["commands"]
+        key = (self.sys_core_template,
+               json.dumps(self.agent, sort_keys=True, default=str),
+               tuple(name for name in commands if name in command_manager.functions))
+        static_msg = _static_system_msgs.get(key)
+        if static_msg is None:
+            command_docs = command_manager.get_some_docstrings(commands)
+            logger.debug("Docstrings:")
+            logger.debug(command_docs)
+            data = {
+                "command_docs": command_docs,
+                "agent": self.agent,
+                "persona": self.agent['persona']
+            }
+            static_msg = self.sys_template.render(data)
+            if len(_static_system_msgs) >= MAX_STATIC_SYSTEM_MSGS:
+                _static_system_msgs.clear()
+            _static_system_msgs[key] = static_msg
+        return static_msg
+
     async def render_system_msg(self):
-        logger.debug("Docstrings:")
-        logger.debug(command_manager.get_some_docstrings(self.agent["commands"]))
         now = datetime.now()
 
         formatted_time = now.strftime("~ %Y-%m-%d %I %p %Z%z")
 
         data = {
-            "command_docs": command_manager.get_some_docstrings(self.agent["commands"]),
-            "agent": self.agent,
-            "persona": self.agent['persona'],
             "formatted_datetime": formatted_time,
             "context_data": self.context.data
         }
-        self.system_message = self.sys_template.render(data)
+        # static part first, then what changes between iterations
+        self.system_message = self.render_static_system_msg() + "\n" + self.context_template.render(data)
         additional_instructions = await hook_manager.add_instructions(self.context)
 
         for instruction in additional_instructions:
@@ -370,6 +505,79 @@ class Agent:
 
         ret, full_cmds = await self.parse_cmd_stream(stream, context)
         logger.debug("System message was:")
-        logger.debug(await self.render_system_msg())
+        logger.debug(self.system_message)
         return ret, full_cmds
 
+
+
+# Test cases
+import unittest
+
+class _TestContext:
+    """Just enough of ChatContext for parse_cmd_stream()."""
+
+    def __init__(self):
+        self.data = {}
+        self.flags = []
+        self.chat_log = type('TestChatLog', (), {'add_message': lambda self, message: None,
+                                                  'add_commands': lambda self, commands: None})()
+
+    async def partial_command(self, *args, **kwargs):
+        pass
+
+    async def running_command(self, *args, **kwargs):
+        pass
+
+    async def command_result(self, *args, **kwargs):
+        pass
+
+class TestSpeculativeCommands(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.events = []
+
+        async def test_lookup(key, context=None):
+            self.events.append(('start', key))
+            await asyncio.sleep(0.2)
+            self.events.append(('end', key))
+            return key
+
+        command_manager.register_function('test_lookup', 'test', test_lookup, None, None, ['read_only'])
+        self.agent = Agent.__new__(Agent)
+        self.agent.agent = {'commands': ['test_lookup']}
+
+    def tearDown(self):
+        command_manager.functions.pop('test_lookup', None)
+        command_manager._dispatch_cache.clear()
+
+    async def stream(self, text, fail=False):
+        yield text
+        self.events.append(('stream', 'waiting'))
+        # the rest of the response takes a while to generate
+        await asyncio.sleep(0.1)
+        if fail:
+            raise RuntimeError('stream failed')
+        self.events.append(('stream', 'end'))
+        yield ']'
+
+    async def test_starts_before_stream_ends(self):
+        text = '[{"test_lookup": {"key": "a"}}'
+        results, full_cmds = await self.agent.parse_cmd_stream(self.stream(text), _TestContext())
+        self.assertEqual([cmd['result'] for cmd in full_cmds], ['a'])
+        self.assertLess(self.events.index(('start', 'a')), self.events.index(('stream', 'end')))
+
+    async def test_cancelled_when_stream_fails(self):
+        text = '[{"test_lookup": {"key": "a"}}'
+        with self.assertRaises(RuntimeError):
+            await self.agent.parse_cmd_stream(self.stream(text, fail=True), _TestContext())
+        self.assertIn(('start', 'a'), self.events)
+        await asyncio.sleep(0.3)
+        self.assertNotIn(('end', 'a'), self.events)
+
+    async def test_disabled(self):
+        os.environ['AH_SPECULATIVE_COMMANDS'] = '0'
+        try:
+            text = '[{"test_lookup": {"key": "a"}}'
+            await self.agent.parse_cmd_stream(self.stream(text), _TestContext())
+        finally:
+            del os.environ['AH_SPECULATIVE_COMMANDS']
+        self.assertGreater(self.events.index(('start', 'a')), self.events.index(('stream', 'end')))
@@ -2,20 +2,23 @@ import json
 import re
 from typing import List, Dict, Tuple, Any
 from partial_json_parser import loads, ensure_json
-from lib.json_str_block import replace_raw_blocks
+from lib.json_str_block import replace_raw_blocks, RawBlockRewriter
 from lib.utils.parse_json_newlines_partial import json_loads
 from lib.utils.merge_arrays import merge_json_arrays
-from lib.json_escape import escape_for_json
+from lib.json_escape import escape_for_json, JsonEscaper
 import sys
 import traceback
 
 
-def parse_streaming_commands(buffer: str) -> Tuple[List[Dict[str, Any]], str]:
+def parse_streaming_commands(buffer: str, raw_rewriter=None, json_escaper=None) -> Tuple[List[Dict[str, Any]], str]:
     """
     Parse streaming commands from a buffer, identifying complete commands.
     
     Args:
     buffer (str): The current buffer of streamed data.
+    raw_rewriter (RawBlockRewriter, optional): Keeps the RAW block conversion of the
+        buffer between calls, so only newly streamed text is converted.
+    json_escaper (JsonEscaper, optional): Same for escape_for_json() of the buffer.
     
     Returns:
     Tuple[List[Dict[str, Any]], str]: A tuple containing a list of complete commands and the last partial command (if any).
@@ -27,7 +30,7 @@ def parse_streaming_commands(buffer: str) -> Tuple[List[Dict[str, Any]], str]:
         return [], None
     
     try:
-        raw_replaced = replace_raw_blocks(buffer)
+        raw_replaced = replace_raw_blocks(buffer, raw_rewriter)
         #raw_replaced = escape_for_json(raw_replaced)
         complete_commands = json.loads(raw_replaced)
         print(1)
@@ -41,8 +44,11 @@ def parse_streaming_commands(buffer: str) -> Tuple[List[Dict[str, Any]], str]:
         except Exception:
             pass
         try:
-            raw_replaced = escape_for_json(buffer)
-            complete_commands = json.loads(raw_replaced)
+            if json_escaper is not None:
+                escaped = json_escaper.escape(buffer)
+            else:
+                escaped = escape_for_json(buffer)
+            complete_commands = json.loads(escaped)
             #print("Found complete command from escape_for_json")
             print(2)
             return complete_commands, None
@@ -50,11 +56,11 @@ def parse_streaming_commands(buffer: str) -> Tuple[List[Dict[str, Any]], str]:
             pass
         try:
             #print("trying merge_json_arrays with partial=True")
-            complete_commands = merge_json_arrays(buffer, partial=True)
+            complete_commands = merge_json_arrays(raw_replaced, partial=True)
             num_commands = len(complete_commands)
             if num_commands > 1:
-                complete_commands = complete_commands[:num_commands-1]
                 current_partial = complete_commands[-1]
+                complete_commands = complete_commands[:num_commands-1]
             else:
                 current_partial = complete_commands[-1]
                 complete_commands = []
@@ -69,7 +75,7 @@ def parse_streaming_commands(buffer: str) -> Tuple[List[Dict[str, Any]], str]:
             pass
 
         try:
-            raw_replaced = replace_raw_blocks(buffer)
+            raw_replaced = replace_raw_blocks(buffer, raw_rewriter)
             complete_commands = loads(raw_replaced)
             num_commands = len(complete_commands)
             print("parsed, num complete commands:", num_commands)
@@ -93,8 +99,8 @@ def parse_streaming_commands(buffer: str) -> Tuple[List[Dict[str, Any]], str]:
             complete_commands = merge_json_arrays(raw_replaced, partial=True)
             num_commands = len(complete_commands)
             if num_commands > 1:
-                complete_commands = complete_commands[:num_commands-1]
                 current_partial = complete_commands[-1]
+                complete_commands = complete_commands[:num_commands-1]
             else:
                 current_partial = complete_commands[-1]
                 complete_commands = []
@@ -113,8 +119,8 @@ def parse_streaming_commands(buffer: str) -> Tuple[List[Dict[str, Any]], str]:
             complete_commands = json_loads(raw_replaced)
             num_commands = len(complete_commands)
             if num_commands > 1:
-                complete_commands = complete_commands[:num_commands-1]
                 current_partial = complete_commands[-1]
+                complete_commands = complete_commands[:num_commands-1]
             else:
                 current_partial = complete_commands[-1]
                 complete_commands = []
@@ -160,6 +166,377 @@ def parse_streaming_commands(buffer: str) -> Tuple[List[Dict[str, Any]], str]:
     print(10)
     return complete_commands, current_partial
 
+START_RAW = 'START_RAW'
+END_RAW = 'END_RAW'
+
+_WHITESPACE = ' \t\r\n'
+_LITERAL_END = _WHITESPACE + ',]}:'
+_STRING_SPECIAL = re.compile(r'["\\]')
+_HIGH_SURROGATE = re.compile(r'\\u[dD][89abAB][0-9a-fA-F]{2}')
+
+# parser states
+_VALUE = 0
+_KEY = 1
+_COLON = 2
+_AFTER = 3
+_STRING = 4
+_LITERAL = 5
+_RAW_START = 6
+_RAW = 7
+_RAW_CLOSE = 8
+
+
+class StreamingCommandParser:
+    """
+    Resumable parser for a streamed command list.
+
+    parse_streaming_commands() re-parses the whole buffer on every token.
+    This parser consumes only the newly streamed chunk and remembers where it
+    stopped (including START_RAW/END_RAW state), building the command objects
+    as it goes, so the total work for a response is linear in its length.
+
+    Usage:
+        parser = StreamingCommandParser()
+        async for part in stream:
+            new_cmds = parser.feed(part)
+            partial = parser.partial  # command still being streamed, or None
+
+    Top level commas and brackets are skipped, so several concatenated
+    command lists ("[...][...]" or "[...], {...}") produce one flat list.
+    If the text can't be parsed, `failed` is set and further input is
+    ignored; callers can fall back to parse_streaming_commands().
+    """
+
+    def __init__(self):
+        self.commands = []
+        self.failed = False
+        self._state = _VALUE
+        # open containers, each entry is [container, pending key]
+        self._stack = []
+        self._str_pieces = []
+        # for `partial`: how many pieces were read, the text read but not
+        # decoded yet, and the decoded start of the string being streamed
+        self._str_seen = 0
+        self._pending = ''
+        self._decoded = ''
+        self._str_is_key = False
+        self._str_slot = None
+        self._str_raw = False
+        self._escape = False
+        self._raw_probe = None
+        self._raw_quoted = False
+        self._raw_tail = ''
+        self._literal = []
+        self._snapshot = None
+
+    def feed(self, chunk: str) -> List[Any]:
+        """
+        Consume the next streamed chunk.
+
+        Returns:
+        List[Any]: commands completed by this chunk (also appended to `commands`).
+        """
+        num_before = len(self.commands)
+        if self.failed or not chunk:
+            return []
+        self._snapshot = None
+        pos = 0
+        n = len(chunk)
+        while pos < n and not self.failed:
+            state = self._state
+            if state == _STRING:
+                pos = self._scan_string(chunk, pos)
+            elif state == _RAW:
+                pos = self._scan_raw(chunk, pos)
+            else:
+                pos = self._scan_token(chunk, pos, state)
+        return self.commands[num_before:]
+
+    @property
+    def partial(self):
+        """The command currently being streamed (with its partial arguments), or None."""
+        if self.failed or not self._stack:
+            return None
+        if self._str_slot is not None and self._snapshot is None:
+            container, key = self._str_slot
+            container[key] = self._partial_string()
+            self._snapshot = True
+        return self._stack[0][0]
+
+    def _fail(self):
+        self.failed = True
+        return 0
+
+    def _scan_token(self, chunk, pos, state):
+        c = chunk[pos]
+
+        if state == _LITERAL:
+            if c not in _LITERAL_END:
+                self._literal.append(c)
+                return pos + 1
+            self._finish_literal()
+            return pos
+
+        if state == _RAW_START:
+            # the raw text starts on the line after START_RAW
+            if c in ' \t\r':
+                return pos + 1
+            self._state = _RAW
+            return pos + 1 if c == '\n' else pos
+
+        if state == _RAW_CLOSE:
+            # accept the quoted form: "START_RAW ... END_RAW"
+            if c == '"':
+                self._raw_quoted = False
+                self._state = self._after_value_state()
+                return pos + 1
+            if self._raw_quoted and c in _WHITESPACE:
+                return pos + 1
+            self._raw_quoted = False
+            self._state = self._after_value_state()
+            return pos
+
+        if c in _WHITESPACE:
+            return pos + 1
+
+        if not self._stack:
+            # between commands
+            if c in ',[]':
+                return pos + 1
+            return self._start_value(c, pos)
+
+        container = self._stack[-1][0]
+
+        if state == _VALUE:
+            if c == ']' and isinstance(container, list):
+                return self._close(pos)
+            return self._start_value(c, pos)
+
+        if state == _KEY:
+            if c == '"':
+                self._start_string(is_key=True)
+                return pos + 1
+            if c == '}':
+                return self._close(pos)
+            return self._fail()
+
+        if state == _COLON:
+            if c == ':':
+                self._state = _VALUE
+                return pos + 1
+            return self._fail()
+
+        # _AFTER
+        if c == ',':
+            self._state = _KEY if isinstance(container, dict) else _VALUE
+            return pos + 1
+        if (c == '}' and isinstance(container, dict)) or (c == ']' and isinstance(container, list)):
+            return self._close(pos)
+        return self._fail()
+
+    def _start_value(self, c, pos):
+        if c == '{' or c == '[':
+            new_container = {} if c == '{' else []
+            self._attach(new_container)
+            self._stack.append([new_container, None])
+            self._state = _KEY if c == '{' else _VALUE
+            return pos + 1
+        if c == '"':
+            self._start_string(is_key=False)
+            return pos + 1
+        if c in ']}:,':
+            return self._fail()
+        self._literal = [c]
+        self._state = _LITERAL
+        return pos + 1
+
+    def _attach(self, value):
+        """Insert a value into the innermost open container, returning its slot."""
+        if not self._stack:
+            return None
+        frame = self._stack[-1]
+        container = frame[0]
+        if isinstance(container, list):
+            container.append(value)
+            return (container, len(container) - 1)
+        container[frame[1]] = value
+        return (container, frame[1])
+
+    def _close(self, pos):
+        frame = self._stack.pop()
+        if not self._stack:
+            self.commands.append(frame[0])
+        self._state = self._after_value_state()
+        return pos + 1
+
+    def _after_value_state(self):
+        return _AFTER if self._stack else _VALUE
+
+    def _finish_value(self, value):
+        if self._stack:
+            self._attach(value)
+        else:
+            self.commands.append(value)
+        self._state = self._after_value_state()
+
+    def _finish_literal(self):
+        literal = ''.join(self._literal)
+        self._literal = []
+        if literal == START_RAW:
+            self._start_raw(quoted=False)
+            return
+        try:
+            value = json.loads(literal)
+        except ValueError:
+            self._fail()
+            return
+        self._finish_value(value)
+
+    def _start_string(self, is_key):
+        self._str_pieces = []
+        self._str_seen = 0
+        self._pending = ''
+        self._decoded = ''
+        self._str_is_key = is_key
+        self._str_raw = False
+        self._escape = False
+        self._state = _STRING
+        if is_key:
+            self._raw_probe = None
+        else:
+            self._raw_probe = 0
+            self._str_slot = self._attach('')
+
+    def _start_raw(self, quoted):
+        if self._str_slot is None:
+            self._str_slot = self._attach('')
+        self._str_pieces = []
+        self._str_seen = 0
+        self._pending = ''
+        self._str_raw = True
+        self._raw_quoted = quoted
+        self._raw_tail = ''
+        self._state = _RAW_START
+
+    def _scan_string(self, chunk, pos):
+        if self._escape:
+            self._escape = False
+            self._str_pieces.append(chunk[pos])
+            return pos + 1
+
+        if self._raw_probe is not None:
+            c = chunk[pos]
+            if c == START_RAW[self._raw_probe]:
+                self._raw_probe += 1
+                self._str_pieces.append(c)
+                if self._raw_probe == len(START_RAW):
+                    self._raw_probe = None
+                    self._start_raw(quoted=True)
+                return pos + 1
+            self._raw_probe = None
+
+        m = _STRING_SPECIAL.search(chunk, pos)
+        if m is None:
+            self._str_pieces.append(chunk[pos:])
+            return len(chunk)
+        i = m.start()
+        if chunk[i] == '\\':
+            self._str_pieces.append(chunk[pos:i + 1])
+            self._escape = True
+            return i + 1
+        self._str_pieces.append(chunk[pos:i])
+        self._finish_string()
+        return i + 1
+
+    def _finish_string(self):
+        text = ''.join(self._str_pieces)
+        self._str_pieces = []
+        if self._str_is_key:
+            self._stack[-1][1] = _decode_json_string(text)
+            self._state = _COLON
+            return
+        self._set_string_value(_decode_json_string(text))
+
+    def _set_string_value(self, value):
+        slot = self._str_slot
+        self._str_slot = None
+        if slot is None:
+            self.commands.append(value)
+        else:
+            container, key = slot
+            container[key] = value
+        self._state = self._after_value_state()
+
+    def _scan_raw(self, chunk, pos):
+        text = self._raw_tail + chunk[pos:]
+        idx = text.find(END_RAW)
+        if idx == -1:
+            # hold back anything that could be the start of END_RAW
+            keep = 0
+            for k in range(min(len(END_RAW) - 1, len(text)), 0, -1):
+                if text.endswith(END_RAW[:k]):
+                    keep = k
+                    break
+            self._str_pieces.append(text[:len(text) - keep])
+            self._raw_tail = text[len(text) - keep:]
+            return len(chunk)
+
+        self._str_pieces.append(text[:idx])
+        consumed = idx + len(END_RAW) - len(self._raw_tail)
+        self._raw_tail = ''
+        value = ''.join(self._str_pieces)
+        self._str_pieces = []
+        self._str_raw = False
+        self._set_string_value(value)
+        self._state = _RAW_CLOSE
+        return pos + consumed
+
+    def _partial_string(self):
+        pieces = self._str_pieces
+        if self._str_seen < len(pieces):
+            self._pending += ''.join(pieces[self._str_seen:])
+            self._str_seen = len(pieces)
+        if self._str_raw:
+            return self._pending
+        if self._raw_probe is not None:
+            # might still turn out to be START_RAW
+            return ''
+        # decode the text streamed since the last call, up to the last
+        # complete escape
+        text = self._pending
+        end = len(text)
+        if self._escape:
+            end -= 1
+        # an incomplete \uXXXX escape
+        u = text.rfind('\\u', max(0, end - 5), end)
+        if u != -1 and _is_escape(text, u):
+            end = u
+        # a high surrogate is decoded together with the low one after it
+        if end >= 6 and _HIGH_SURROGATE.match(text, end - 6) and _is_escape(text, end - 6):
+            end -= 6
+        if end > 0:
+            self._decoded += _decode_json_string(text[:end])
+            self._pending = text[end:]
+        return self._decoded
+
+
+def _is_escape(text, i):
+    """Whether the backslash at i starts an escape (isn't escaped itself)."""
+    start = i
+    while start > 0 and text[start - 1] == '\\':
+        start -= 1
+    return (i - start) % 2 == 0
+
+
+def _decode_json_string(text):
+    if '\\' not in text:
+        return text
+    try:
+        return json.loads('"' + text + '"', strict=False)
+    except ValueError:
+        return text
+
+
 def invalid_start_format(str):
     # string is supposed to be an array in JSON format
     # if it starts with a non-whitespace character that is not [
@@ -247,6 +624,98 @@ class TestCommandParser(unittest.TestCase):
         self.assertEqual(len(commands), 0)
         self.assertEqual(partial, {"key": "value"})
 
+    def test_unclosed_array(self):
+        # complete commands of an array that is never closed (same as the bracket split parser)
+        a = {"say": {"text": "a"}}
+        b = {"say": {"text": "b"}}
+        for buffer, expected in [('[{"say": {"text": "a"}}', [a]),
+                                 ('[{"say": {"text": "a"}}][{"say": {"text": "b"}}', [a, b]),
+                                 ('[{"say": {"text": "a"}}, {"say": {"text": "b"}}', [a, b])]:
+            commands, partial = parse_streaming_commands(buffer)
+            self.assertEqual(commands, expected)
+            self.assertIsNone(partial)
+
+    def test_partial_after_complete_commands(self):
+        buffer = '[{"say": {"text": "a"}}, {"say": {"text": "b"}}, {"say": {"text": "c'
+        commands, partial = parse_streaming_commands(buffer)
+        self.assertEqual(commands, [{"say": {"text": "a"}}, {"say": {"text": "b"}}])
+        self.assertEqual(partial, {"say": {"text": "c"}})
+
+    def test_partial_raw_block_fallback(self):
+        buffer = '[ {"write": { "filename": "/test.py",\n "text": "START_RAW\ndef foo'
+        commands, partial = parse_streaming_commands(buffer)
+        self.assertEqual(commands, [])
+        self.assertEqual(partial, {"write": {"filename": "/test.py", "text": "def foo\n"}})
+
+
+class TestStreamingCommandParser(unittest.TestCase):
+    def feed_all(self, buffer, chunk_size=1):
+        parser = StreamingCommandParser()
+        for i in range(0, len(buffer), chunk_size):
+            parser.feed(buffer[i:i+chunk_size])
+        return parser
+
+    def test_complete_commands(self):
+        buffer = '[{"say": {"text": "Hello"}}, {"do_something": {"arg1": "value1", "n": [1, 2.5, null, true]}}]'
+        for chunk_size in [1, 3, len(buffer)]:
+            parser = self.feed_all(buffer, chunk_size)
+            self.assertEqual(parser.commands, [{"say": {"text": "Hello"}},
+                                               {"do_something": {"arg1": "value1", "n": [1, 2.5, None, True]}}])
+            self.assertIsNone(parser.partial)
+            self.assertFalse(parser.failed)
+
+    def test_feed_returns_new_commands(self):
+        parser = StreamingCommandParser()
+        self.assertEqual(parser.feed('[{"say": {"text": "Hi"}}, {"say"'), [{"say": {"text": "Hi"}}])
+        self.assertEqual(parser.feed(': {"text": "there"}}]'), [{"say": {"text": "there"}}])
+
+    def test_partial_command(self):
+        parser = self.feed_all('[{"say": {"text": "Hello"}}, {"do_something": {"arg1": "valu')
+        self.assertEqual(parser.commands, [{"say": {"text": "Hello"}}])
+        self.assertEqual(parser.partial, {"do_something": {"arg1": "valu"}})
+
+    def test_partial_escapes(self):
+        parser = self.feed_all('[{"say": {"text": "a\\nb\\u00e')
+        self.assertEqual(parser.partial, {"say": {"text": "a\nb"}})
+        parser.feed('9\\"')
+        self.assertEqual(parser.partial, {"say": {"text": "a\nb\u00e9\""}})
+
+    def test_partial_escapes_every_chunk(self):
+        text = 'x\\\\u00e9 \\ud83d\\ude00 "q"\n\u00e9\\'
+        buffer = '[{"say": {"text": ' + json.dumps(text) + '}}]'
+        parser = StreamingCommandParser()
+        for i in range(len(buffer)):
+            parser.feed(buffer[i])
+            partial = parser.partial
+            if partial is not None and isinstance(partial.get("say"), dict) and "text" in partial["say"]:
+                self.assertTrue(text.startswith(partial["say"]["text"]), partial)
+        self.assertEqual(parser.commands, [{"say": {"text": text}}])
+
+    def test_raw_block(self):
+        buffer = '[ { "json_encoded_md": { "markdown": START_RAW\nThe moon, "so" bright\n\\n END_RA\nEND_RAW\n} } ]'
+        for chunk_size in [1, 4, len(buffer)]:
+            parser = self.feed_all(buffer, chunk_size)
+            self.assertEqual(parser.commands, [{"json_encoded_md": {"markdown": 'The moon, "so" bright\n\\n END_RA\n'}}])
+
+    def test_quoted_raw_block(self):
+        buffer = '[ {"write": { "filename": "/test.py",\n "text": "START_RAW\ndef foo():\n    print("hi")\nEND_RAW\n" }\n } ]'
+        parser = self.feed_all(buffer)
+        self.assertEqual(parser.commands, [{"write": {"filename": "/test.py", "text": 'def foo():\n    print("hi")\n'}}])
+
+    def test_partial_raw_block(self):
+        parser = self.feed_all('[{"json_encoded_md": {"markdown": START_RAW\n## Title\nEND_')
+        self.assertEqual(parser.partial, {"json_encoded_md": {"markdown": "## Title\n"}})
+
+    def test_concatenated_lists(self):
+        parser = self.feed_all('[{"say": {"text": "a"}}][{"say": {"text": "b"}}], {"say": {"text": "c"}}')
+        self.assertEqual([cmd["say"]["text"] for cmd in parser.commands], ["a", "b", "c"])
+
+    def test_invalid_json(self):
+        parser = self.feed_all('[{"say": {"text": "Hello"}, {"invalid": "command"}]')
+        self.assertTrue(parser.failed)
+        self.assertEqual(parser.commands, [])
+        self.assertIsNone(parser.partial)
+
 
 
 def ex6():
@@ -1,6 +1,7 @@
 from lib.providers.commands import command, command_manager
 from lib.providers.services import service_manager
 from lib.chatcontext import ChatContext
+from lib.session_cache import session_cache
 from .services import init_chat_session, send_message_to_agent, subscribe_to_agent_messages
 import asyncio
 import json
@@ -193,64 +194,63 @@ async def converse_with_agent(agent_name: str, sub_log_id: str, first_message: s
     print('===================================================================')
     print(context, context.agent_name)
     await init_chat_session(context.agent_name, my_sub_log_id)
-    my_sub_context = ChatContext(service_manager, command_manager)
-    await my_sub_context.load_context(my_sub_log_id)
-    my_sub_context.data['parent_log_id'] = context.log_id
-    my_sub_log = my_sub_context.chat_log
-
-    to_exit = f"Context: {contextual_info}\n\n Conversation exit criteria: {exit_criteria}.\n\n When exit_criteria met, use the exit_conversation() command specifying concise detailed takeaways."
-    init_sub_msg = f"[SYSTEM]: Initiating chat session with [{my_sub_context.agent_name}] taking User role... \n\n" + to_exit
-    my_sub_log.add_message({"role": "user", "content": init_sub_msg})
-    my_sub_log.add_message({"role": "assistant", "content": f"[{agent_name}]:" + first_message})
+    # keep the subconversation in memory between runs, it is read after each one
+    async with session_cache.use(my_sub_log_id):
+        my_sub_context = await session_cache.get(my_sub_log_id)
+        my_sub_context.data['parent_log_id'] = context.log_id
+        my_sub_log = my_sub_context.chat_log
+
+        to_exit = f"Context: {contextual_info}\n\n Conversation exit criteria: {exit_criteria}.\n\n When exit_criteria met, use the exit_conversation() command specifying concise detailed takeaways."
+        init_sub_msg = f"[SYSTEM]: Initiating chat session with [{my_sub_context.agent_name}] taking User role... \n\n" + to_exit
+        my_sub_log.add_message({"role": "user", "content": init_sub_msg})
+        my_sub_log.add_message({"role": "assistant", "content": f"[{agent_name}]:" + first_message})
     
-    finished_conversation = False
-    my_sub_context.data['finished_conversation'] = False
-    my_sub_context.save_context()
-
-    takeaways = ""
-
-    blank_my_replies = 0
-
-    while not finished_conversation:
-        if 'finished_conversation' not in my_sub_context.data:
-            raise Exception("Error: 'finished_conversation' key not found in context.data " + str(my_sub_context))
-        replies = []
-        async with asyncio.timeout(1200.0):
-            [_, replies] = await send_message_to_agent(sub_log_id, first_message)
-        #print replies data for debugging, in magenta
-        print(termcolor.colored('replies:', 'magenta', attrs=['bold']))
-        print(termcolor.colored(replies, 'magenta', attrs=['bold']))
-
-        async with asyncio.timeout(1200.0):
-            [_, my_replies] = await send_message_to_agent(my_sub_log_id, f"[{agent_name}]: {json.dumps(replies)}")
-            # print my_replies data for debugging, in cyan
-            print(termcolor.colored('my_replies:', 'cyan', attrs=['bold']))
-            print(termcolor.colored(my_replies, 'cyan', attrs=['bold']))
-
-            if len(my_replies) == 0:
-                blank_my_replies += 1
-                if blank_my_replies > 3:
-                    # print in red for debugging
-                    print("Too many blank replies, exiting conversation")
-                    break
-
-        if my_sub_context.data['finished_conversation'] == True:
-            takeaways = my_sub_context.data['takeaways']
-            finished_conversation = True
-            break
-        else:
-            first_message = json.dumps(my_replies)
+        finished_conversation = False
+        my_sub_context.data['finished_conversation'] = False
+        my_sub_context.save_context()
+
+        takeaways = ""
+
+        blank_my_replies = 0
+
+        while not finished_conversation:
+            if 'finished_conversation' not in my_sub_context.data:
+                raise Exception("Error: 'finished_conversation' key not found in context.data " + str(my_sub_context))
+            replies = []
+            async with asyncio.timeout(1200.0):
+                [_, replies] = await send_message_to_agent(sub_log_id, first_message)
+            #print replies data for debugging, in magenta
+            print(termcolor.colored('replies:', 'magenta', attrs=['bold']))
+            print(termcolor.colored(replies, 'magenta', attrs=['bold']))
+
+            async with asyncio.timeout(1200.0):
+                [_, my_replies] = await send_message_to_agent(my_sub_log_id, f"[{agent_name}]: {json.dumps(replies)}")
+                # print my_replies data for debugging, in cyan
+                print(termcolor.colored('my_replies:', 'cyan', attrs=['bold']))
+                print(termcolor.colored(my_replies, 'cyan', attrs=['bold']))
+
+                if len(my_replies) == 0:
+                    blank_my_replies += 1
+                    if blank_my_replies > 3:
+                        # print in red for debugging
+                        print("Too many blank replies, exiting conversation")
+                        break
+
+            if my_sub_context.data['finished_conversation'] == True:
+                takeaways = my_sub_context.data['takeaways']
+                finished_conversation = True
+                break
+            else:
+                first_message = json.dumps(my_replies)
             
-        print("End of loop")
-        sub_context = ChatContext(service_manager, command_manager)
-
-        await sub_context.load_context(sub_log_id)
-        await my_sub_context.load_context(my_sub_log_id)
+            print("End of loop")
+            sub_context = await session_cache.get(sub_log_id)
+            my_sub_context = await session_cache.get(my_sub_log_id)
   
-        print(termcolor.colored('my_sub_context.data:', 'blue', attrs=['bold']))
-        print(termcolor.colored(my_sub_context.data, 'blue', attrs=['bold']))
-        print(termcolor.colored('sub_context.data:', 'blue', attrs=['bold']))
-        print(termcolor.colored(sub_context.data, 'blue', attrs=['bold']))
+            print(termcolor.colored('my_sub_context.data:', 'blue', attrs=['bold']))
+            print(termcolor.colored(my_sub_context.data, 'blue', attrs=['bold']))
+            print(termcolor.colored('sub_context.data:', 'blue', attrs=['bold']))
+            print(termcolor.colored(sub_context.data, 'blue', attrs=['bold']))
          
     return {
         f"[SYSTEM]: Exited conversation with {agent_name}. {agent_name} takeaways were:": takeaways
@@ -269,10 +269,9 @@ Parameters:
     Return: None
     """
     parent_log = context.data['parent_log_id']
-    parent_context = ChatContext(service_manager, command_manager)
-    await parent_context.load_context(parent_log)
-    chat_log.add_message({"role": "assistant", "content": message})
-    await agent_output("new_message", {"content": message, "agent": context.agent['name']})
-    chat_log = parent_context.chat_log
+    # the parent's run is waiting on this subconversation, so don't take its lock
+    parent_context = await session_cache.get(parent_log)
+    parent_context.chat_log.add_message({"role": "assistant", "content": message})
+    await parent_context.agent_output("new_message", {"content": message, "agent": context.agent['name']})
     return None
 
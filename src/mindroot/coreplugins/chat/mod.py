@@ -1,5 +1,7 @@
 print("ah_chat module")
 from lib.providers.hooks import hook
+from lib.session_cache import session_cache
+from lib.chatcontext import context_writer
 from fastapi.staticfiles import StaticFiles
 import os
 from pathlib import Path
@@ -12,3 +14,9 @@ async def startup(app, context):
     
     app.mount("/imgs", StaticFiles(directory=str(imgs_dir)), name="imgs")
     print("Mounted imgs, dir: ", imgs_dir)
+
+    app.router.on_shutdown.append(save_sessions)
+
+def save_sessions():
+    session_cache.flush()
+    context_writer.flush()
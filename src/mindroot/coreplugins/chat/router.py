@@ -39,8 +39,11 @@ async def get_persona_avatar(persona_name: str):
 
 
 @router.get("/chat/{log_id}/events")
-async def chat_events(log_id: str):
-    return EventSourceResponse(await subscribe_to_agent_messages(log_id))
+async def chat_events(request: Request, log_id: str, deltas: bool = False):
+    # sent by the browser when it reconnects, so we can replay what it missed
+    last_event_id = request.headers.get('last-event-id')
+    # clients that apply partial_command deltas ask for them with ?deltas=1
+    return EventSourceResponse(await subscribe_to_agent_messages(log_id, last_event_id, deltas))
 
 @router.post("/chat/{log_id}/{task_id}/cancel")
 async def cancel_chat(log_id: str, task_id: str):
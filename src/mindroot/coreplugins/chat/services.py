@@ -1,10 +1,13 @@
 from lib.providers.services import service, service_manager
 from lib.providers.commands import command_manager
 from lib.pipelines.pipe import pipeline_manager, pipe
-from lib.chatcontext import ChatContext
+from lib.chatcontext import ChatContext, context_writer
 from lib.chatlog import ChatLog
+from lib.session_cache import session_cache
+from lib.event_broadcaster import EventBroadcaster
 from typing import List
 from lib.utils.dataurl import dataurl_to_pil
+from lib.utils.partial_delta import PartialCommandEncoder
 from .models import MessageParts
 from coreplugins.agent import agent
 import os
@@ -19,7 +22,11 @@ from PIL import Image
 from io import BytesIO
 import base64
 
-sse_clients = {}
+# agent output events by session, for the SSE endpoints
+sse_clients = EventBroadcaster()
+
+# log_id -> PartialCommandEncoder for the command being streamed
+partial_encoders = {}
 
 @service()
 async def init_chat_session(agent_name: str, log_id: str):
@@ -37,23 +44,17 @@ async def init_chat_session(agent_name: str, log_id: str):
     context.chat_log = ChatLog(log_id=log_id, agent=agent_name)
     print("context.agent_name: ", context.agent_name)
     context.save_context()
+    session_cache.add(context)
     print("initiated_chat_session: ", log_id, agent_name, context.agent_name, context.agent)
     return log_id
 
 @service()
 async def get_chat_history(session_id: str):
-    context = ChatContext(command_manager, service_manager)
-    await context.load_context(session_id)
-    agent = await service_manager.get_agent_data(context.agent_name)
-    
-    persona = agent['persona']['name']
-    messages = context.chat_log.get_recent()
-    for message in messages:
-        if message['role'] == 'user':
-            message['persona'] = 'user'
-        else:
-            message['persona'] = persona
-    return messages
+    context = await session_cache.get(session_id)
+    persona = context.agent['persona']['name']
+    # copies, the cached chat log's messages are sent to the LLM as they are
+    return [{**message, 'persona': 'user' if message['role'] == 'user' else persona}
+            for message in context.chat_log.get_history()]
 
 def process_result(result, formatted_results):
     print("type of result is ", type(result))
@@ -87,6 +88,17 @@ def process_result(result, formatted_results):
 
 @service()
 async def send_message_to_agent(session_id: str, message: str | List[MessageParts], max_iterations=35, context=None, user=None):
+    """Add a user message to a session and run its agent until it is done.
+
+    Runs on a session are serialized, as they share its cached context and
+    chat log: a message sent while the agent is still working on the
+    previous one is added and answered after that run, including all of its
+    command iterations, has finished.
+    """
+    async with session_cache.use(session_id, lock=True):
+        return await _send_message_to_agent(session_id, message, max_iterations, user)
+
+async def _send_message_to_agent(session_id, message, max_iterations, user):
     try:
         if type(message) is list:
             message = [m.dict() for m in message]
@@ -96,9 +108,7 @@ async def send_message_to_agent(session_id: str, message: str | List[MessagePart
             return []
 
         print("send_message_to_agent: ", session_id, message, max_iterations)
-        context = ChatContext(command_manager, service_manager)
-
-        await context.load_context(session_id)
+        context = await session_cache.get(session_id)
         print(context) 
         agent_ = agent.Agent(agent=context.agent)
         if user is not None:
@@ -130,6 +140,9 @@ async def send_message_to_agent(session_id: str, message: str | List[MessagePart
 
         context.save_context()
 
+        # per agent history window, e.g. "history_window": { "max_tokens": 60000, "keep_first": 1 }
+        history_window = context.agent.get('history_window', {})
+
         continue_processing = True
         iterations = 0
         results = []
@@ -143,7 +156,9 @@ async def send_message_to_agent(session_id: str, message: str | List[MessagePart
                     print(2)
                     context.current_model = os.environ.get("DEFAULT_LLM_MODEL")
     
-                results, full_cmds = await agent_.chat_commands(context.current_model, context=context, messages=context.chat_log.get_recent())
+                recent = context.chat_log.get_recent(history_window.get('max_tokens'),
+                                                     history_window.get('keep_first', 0))
+                results, full_cmds = await agent_.chat_commands(context.current_model, context=context, messages=recent)
                 try:
                     tmp_data3 = { "results": full_cmds }
                     tmp_data3 = await pipeline_manager.process_results(tmp_data3, context=context)
@@ -194,7 +209,7 @@ async def send_message_to_agent(session_id: str, message: str | List[MessagePart
                         process_result(result, formatted_results)
                     print("Time to process results: ", time.time() - st_process)
                     
-                    context.chat_log.add_message({"role": "user", "content": formatted_results})
+                    context.chat_log.add_message({"role": "user", "content": formatted_results}, command_result=True)
                     results.append(out_results) 
                 else:
                     print("Processing iteration: ", iterations, "no message added")
@@ -225,45 +240,58 @@ def add_current_time(data: dict, context=None) -> dict:
 
 @service()
 async def finished_chat(context=None):
+    context_writer.flush(context.log_id)
+    partial_encoders.pop(context.log_id, None)
     await context.agent_output("finished_chat", { "persona": context.agent['persona']['name'] })
 
 @service()
-async def subscribe_to_agent_messages(session_id: str, context=None):
+async def subscribe_to_agent_messages(session_id: str, last_event_id=None, deltas=False, context=None):
     async def event_generator():
-        queue = asyncio.Queue()
-        if session_id not in sse_clients:
-            sse_clients[session_id] = set()
-        sse_clients[session_id].add(queue)
-        try:
-            while True:
-                data = await queue.get()
-                await asyncio.sleep(0.005)
-                print('.', end='', flush=True)
-                yield data
-        except asyncio.CancelledError:
-            sse_clients[session_id].remove(queue)
-            if not sse_clients[session_id]:
-                del sse_clients[session_id]
+        subscription = sse_clients.subscribe(session_id, last_event_id, deltas=deltas)
+        async for _, event in subscription:
+            yield event
     return event_generator()
 
 @service()
 async def close_chat_session(session_id: str, context=None):
-    if session_id in sse_clients:
-        del sse_clients[session_id]
+    sse_clients.close_session(session_id)
     # Any additional cleanup needed
 
 @service()
-async def agent_output(event: str, data: dict, context=None):
-    log_id = context.log_id
-    if log_id in sse_clients:
-        for queue in sse_clients[log_id]:
-            await queue.put({"event": event, "data": json.dumps(data)})
+async def agent_output(event: str, data: dict, snapshot=None, context=None):
+    sse_clients.publish(context.log_id, event, data, snapshot)
 
 @service()
-async def partial_command(command: str, chunk: str, params, context=None):
+async def partial_command(command: str, chunk: str, params, complete=False, context=None):
+    """Send the arguments of a command that is being streamed.
+
+    Events carry only the text appended since the previous event when that
+    is all that changed (see lib.utils.partial_delta), and a full snapshot
+    otherwise or when the command is complete. Subscribers that didn't ask
+    for deltas get the full params and chunk (their JSON, computed when the
+    event is sent if None) in every event.
+    """
     agent_ = context.agent
-    await context.agent_output("partial_command", { "command": command, "chunk": chunk, "params": params,
-                                                    "persona": agent_['persona']['name'] })
+    encoder = partial_encoders.get(context.log_id)
+    if encoder is None:
+        encoder = partial_encoders[context.log_id] = PartialCommandEncoder()
+    data = encoder.encode(command, params, complete)
+    if complete:
+        partial_encoders.pop(context.log_id, None)
+    if data is None:
+        return
+    persona = agent_['persona']['name']
+    data['persona'] = persona
+    # the encoder's copy of the arguments is replaced, not changed, by later events
+    full_params = encoder.params if encoder.params is not None else params
+
+    instance = data['instance']
+
+    def snapshot():
+        return { "command": command, "instance": instance, "chunk": chunk if chunk is not None else json.dumps(full_params),
+                 "params": full_params, "persona": persona }
+
+    await context.agent_output("partial_command", data, snapshot)
 
 @service()
 async def running_command(command: str, args, context=None):
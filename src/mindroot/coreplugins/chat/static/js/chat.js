@@ -28,6 +28,21 @@ window.registerCommandHandler = function(command, handler) {
   commandHandlers[command] = handler;
 }
 
+// partial_command deltas carry only the text appended to one argument,
+// see lib/utils/partial_delta.py. Returns undefined if a delta was missed.
+function applyPartialDelta(params, path, offset, suffix) {
+  if (path.length == 0) {
+    if (typeof(params) != 'string' || params.length < offset) return undefined
+    return (params.length == offset ? params : params.substring(0, offset)) + suffix
+  }
+  if (params == null || typeof(params) != 'object') return undefined
+  const value = applyPartialDelta(params[path[0]], path.slice(1), offset, suffix)
+  if (value === undefined) return undefined
+  const updated = Array.isArray(params) ? [...params] : {...params}
+  updated[path[0]] = value
+  return updated
+}
+
 function tryParse(markdown) {
     try {
       console.log('markdown =', markdown);
@@ -96,7 +111,7 @@ class Chat extends BaseEl {
   firstUpdated() {
     console.log('First updated');
     console.log('sessionid: ', this.sessionid);
-    this.sse = new EventSource(`/chat/${this.sessionid}/events`);
+    this.sse = new EventSource(`/chat/${this.sessionid}/events?deltas=1`);
     // this.sse.addEventListener('new_message', this._aiMessage.bind(this));
     const thisPartial = this._partialCmd.bind(this)
     this.sse.addEventListener('image', this._imageMsg.bind(this));
@@ -234,6 +249,17 @@ class Chat extends BaseEl {
     console.log(event);
     const data = JSON.parse(event.data);
     console.log("data:", data)
+    if (data.suffix !== undefined) {
+      const partial = this.partialParams
+      const params = (partial && partial.command == data.command && partial.instance == data.instance) ?
+        applyPartialDelta(partial.params, data.path, data.offset, data.suffix) : undefined
+      if (params === undefined) {
+        // missed part of the arguments, the next snapshot has all of them
+        return
+      }
+      data.params = params
+    }
+    this.partialParams = { command: data.command, instance: data.instance, params: data.params }
     if (this.messages[this.messages.length - 1].sender != 'ai' || this.startNewMsg) {
       console.log('adding message');
       this.messages = [...this.messages, { content: '', sender: 'ai', persona: data.persona }];
@@ -1,94 +1,46 @@
 from fastapi import APIRouter, Depends, HTTPException, Form, Response, Request, Query
 from lib.route_decorators import public_routes, public_route
 from sse_starlette.sse import EventSourceResponse
+from coreplugins.chat.services import sse_clients
 from typing import List
-import asyncio
-import aiohttp
 import json
 
 router = APIRouter()
 
-async def create_sse_client(url: str, access_token: str, queue: asyncio.Queue, conv_id: str):
-    """Creates internal SSE client that forwards to queue with conversation ID"""
-    headers = {
-        'Cookie': f'access_token={access_token}'
-    }
-    
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, headers=headers) as response:
-            current_event = None
-            current_data = None
-            
-            async for line in response.content:
-                if line:
-                    try:
-                        decoded_line = line.decode().strip()
-                        
-                        # Handle event line
-                        if decoded_line.startswith('event:'):
-                            current_event = decoded_line.split(':', 1)[1].strip()
-                            continue
-                            
-                        # Handle data line
-                        if decoded_line.startswith('data:'):
-                            current_data = decoded_line.split(':', 1)[1].strip()
-                            try:
-                                # Parse and add conversation ID
-                                data = json.loads(current_data)
-                                data['conversation_id'] = conv_id
-                                current_data = json.dumps(data)
-                            except Exception as e:
-                                print(f"Error processing data JSON: {e}")
-                            
-                            # Reconstruct SSE message
-                            if current_event:
-                                await queue.put(f"event: {current_event}\ndata: {current_data}\n\n")
-                            else:
-                                await queue.put(f"data: {current_data}\n\n")
-                            
-                            current_event = None
-                            current_data = None
-                            
-                    except Exception as e:
-                        print(f"Error processing SSE line: {e}")
+def tag_event(event: dict, conv_tag: str) -> dict:
+    """Add the conversation ID to an event without decoding its data.
+
+    Args:
+        event (dict): Event from the broadcaster, data is a JSON object string
+        conv_tag (str): '"conversation_id": "<id>"'
+
+    Returns:
+        dict: Event with the tagged data
+    """
+    data = event['data']
+    if data == '{}':
+        data = '{' + conv_tag + '}'
+    else:
+        data = data[:-1] + ', ' + conv_tag + '}'
+    return {'id': event['id'], 'event': event['event'], 'data': data}
 
 @router.get("/events/multi")
 async def multiplexed_events(
     request: Request,
-    conversation_ids: List[str] = Query(None)
+    conversation_ids: List[str] = Query(None),
+    deltas: bool = False
 ):
     if not conversation_ids:
         raise HTTPException(status_code=400, detail="conversation_ids parameter is required")
 
-    # Get access token from cookie
-    access_token = request.cookies.get('access_token')
-    if not access_token:
-        raise HTTPException(status_code=401, detail="Access token required")
-
-    # Create queue for aggregated messages
-    main_queue = asyncio.Queue()
-
-    # Get base URL for chat events
-    base_url = str(request.base_url).rstrip('/')
-    
-    tasks = []
-    for conv_id in conversation_ids:
-        url = f"{base_url}/chat/{conv_id}/events"
-        task = asyncio.create_task(
-            create_sse_client(url, access_token, main_queue, conv_id)
-        )
-        tasks.append(task)
+    conv_tags = {conv_id: '"conversation_id": ' + json.dumps(conv_id) for conv_id in conversation_ids}
+    last_event_id = request.headers.get('last-event-id')
 
     async def event_generator():
-        try:
-            while True:
-                message = await main_queue.get()
-                if message:
-                    yield message
-        except asyncio.CancelledError:
-            for task in tasks:
-                task.cancel()
-            raise
+        # subscribe directly to the chat event broadcaster, the subscription
+        # is released when the client disconnects and this generator is closed
+        subscription = sse_clients.subscribe(conversation_ids, last_event_id, deltas=deltas)
+        async for conv_id, event in subscription:
+            yield tag_event(event, conv_tags[conv_id])
 
     return EventSourceResponse(event_generator())
-
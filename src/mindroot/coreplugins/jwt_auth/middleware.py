@@ -4,7 +4,10 @@ from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 import jwt
 from datetime import datetime, timedelta
 from lib.route_decorators import public_routes, public_route
+from collections import OrderedDict
+import hashlib
 import os
+import time
 
 SECRET_KEY = os.environ.get("JWT_SECRET_KEY", None)
 
@@ -23,30 +26,58 @@ def create_access_token(data: dict):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+class TokenCache:
+    """LRU cache of verified token payloads, keyed by a hash of the token.
+
+    Entries are dropped when the token expires, so a cached token is never
+    accepted for longer than jwt.decode would accept it.
+    """
+
+    def __init__(self, max_size=None):
+        if max_size is None:
+            max_size = int(os.environ.get('AH_JWT_CACHE_SIZE', 1024))
+        self.max_size = max_size
+        # token hash -> (payload, exp timestamp)
+        self._payloads = OrderedDict()
+
+    def get(self, key):
+        entry = self._payloads.get(key)
+        if entry is None:
+            return None
+        payload, exp = entry
+        if exp is not None and exp <= time.time():
+            del self._payloads[key]
+            return None
+        self._payloads.move_to_end(key)
+        return payload
+
+    def add(self, key, payload):
+        exp = payload.get('exp')
+        self._payloads[key] = (payload, exp if isinstance(exp, (int, float)) else None)
+        self._payloads.move_to_end(key)
+        while len(self._payloads) > self.max_size:
+            self._payloads.popitem(last=False)
+
+token_cache = TokenCache()
+
 def decode_token(token: str):
+    key = hashlib.sha256(token.encode()).digest()
+    payload = token_cache.get(key)
+    if payload is not None:
+        return dict(payload)
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        return payload
     except jwt.ExpiredSignatureError:
-        print("Token has expired")
         return False
     except jwt.InvalidTokenError:
-        print("Invalid token")
         return False
+    token_cache.add(key, payload)
+    return dict(payload)
 
 async def middleware(request: Request, call_next):
     try:
-        print('-------------------------- auth middleware ----------------------------')
-        print('Request URL:', request.url.path)
         if request.url.path in public_routes:
-            print('Public route: ', request.url.path)
             return await call_next(request)
-        else:
-            print('Not a public route: ', request.url.path)
-            # public_routes is set, iterate and print all
-            #print("Printing all public routes: ")
-            #for route in public_routes:
-            #    print('Public route: ', route)
 
         token = request.cookies.get("access_token")
         if token:
@@ -55,18 +86,11 @@ async def middleware(request: Request, call_next):
                 request.state.user = payload
                 return await call_next(request)
             else:
-                print("Invalid or expired token, redirecting to login..")
                 return RedirectResponse(url="/login")
-                #return JSONResponse(
-                #    status_code=401,
-                #    content={"detail": "Invalid or expired token"}
-                #)
 
-        print("..Did not find token in cookies..")
         try:
             token = await security(request)
         except HTTPException as e:
-            print('HTTPException: No valid token found: ', e)
             return RedirectResponse(url="/login")
 
         if token:
@@ -75,14 +99,11 @@ async def middleware(request: Request, call_next):
                 request.state.user = payload
                 return await call_next(request)
             else:
-                print("Invalid or expired token, redirecting to login..")
                 return RedirectResponse(url="/login")
 
-        print('No valid token found')
         return RedirectResponse(url="/login")
 
     except HTTPException as e:
-        print('HTTPException:', e)
         return RedirectResponse(url="/login")
 
     except Exception as e:
@@ -99,6 +120,3 @@ async def middleware(request: Request, call_next):
             status_code=500,
             content={"detail": f"Internal server error: {str(e)}"}
         )
-
-    response = await call_next(request)
-    return response
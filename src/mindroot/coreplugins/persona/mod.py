@@ -48,7 +48,7 @@ async def get_persona_data(persona_name, context=None):
     print("\033[0m", file=sys.stderr)
     return persona_data
 
-@command()
+@command(flags=['parallel'])
 async def pic_of_me(prompt="", context=None):
     """pic_of_me
 
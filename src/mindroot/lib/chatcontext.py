@@ -2,6 +2,7 @@ from .providers.services import service_manager
 from .providers.commands import command_manager
 import os
 import json
+import asyncio
 from .chatlog import ChatLog
 from typing import TypeVar, Type, Protocol, runtime_checkable
 
@@ -42,30 +43,52 @@ class ChatContext:
     def cmds(self, command_set: Type[CommandSetT]) -> CommandSetT:
         return self._commands[command_set]
 
-    def save_context(self):
+    def save_context(self, immediate=False):
+        """Save the context metadata (data and agent name).
+
+        Messages are not included, the ChatLog persists those itself. Saves
+        are coalesced by context_writer, pass immediate=True to write now.
+        """
         if not self.log_id:
             raise ValueError("log_id is not set for the context.")
-        context_file = f'data/context/context_{self.log_id}.json'
         self.data['log_id'] = self.log_id
-        context_data = {
-            'data': self.data,
-            'chat_log': self.chat_log._get_log_data(),
-        }
+        self._saved_agent_name()
+        if immediate or not os.path.exists(self._context_file()):
+            context_writer.flush(self.log_id)
+            self._write_context()
+        else:
+            context_writer.schedule(self)
+
+    def _context_file(self, log_id=None):
+        if log_id is None:
+            log_id = self.log_id
+        return f'data/context/context_{log_id}.json'
+
+    def _saved_agent_name(self):
         if 'name' in self.agent:
-            context_data['agent_name'] = self.agent['name']
+            return self.agent['name']
         elif 'agent_name' in self.data:
-            context_data['agent_name'] = self.data['agent_name']
+            return self.data['agent_name']
         elif self.agent_name is not None:
-            context_data['agent_name'] = self.agent_name
-        if 'agent_name' not in context_data:
-            raise ValueError("Tried to save chat context, but agent name not found in context")
-        with open(context_file, 'w') as f:
+            return self.agent_name
+        raise ValueError("Tried to save chat context, but agent name not found in context")
+
+    def _write_context(self):
+        context_file = self._context_file()
+        context_data = {
+            'data': self.data,
+            'agent_name': self._saved_agent_name()
+        }
+        # write to a temp file and rename so a crash can't leave a truncated context
+        tmp_file = context_file + '.tmp'
+        with open(tmp_file, 'w') as f:
             json.dump(context_data, f, indent=2)
+        os.replace(tmp_file, context_file)
         print("Saved context to:", context_file)
 
     async def load_context(self, log_id):
         self.log_id = log_id
-        context_file = f'data/context/context_{log_id}.json'
+        context_file = self._context_file(log_id)
         if os.path.exists(context_file):
             with open(context_file, 'r') as f:
                 context_data = json.load(f)
@@ -101,3 +124,129 @@ class ChatContext:
             return getattr(self.command_manager, name)
 
 
+class ContextWriter:
+    """Write-behind for ChatContext.save_context.
+
+    Repeated saves of a context within delay seconds are coalesced into a
+    single write of its latest state. Call flush() to write pending saves
+    now, e.g. when a chat turn finishes or on shutdown.
+    """
+
+    def __init__(self, delay=None):
+        if delay is None:
+            delay = float(os.environ.get('AH_CONTEXT_SAVE_DELAY', 1.0))
+        self.delay = delay
+        # log_id -> context waiting to be written
+        self._pending = {}
+        self._handle = None
+
+    def schedule(self, context: ChatContext) -> None:
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # no event loop to run the delayed write
+            context._write_context()
+            return
+        self._pending[context.log_id] = context
+        if self._handle is None:
+            self._handle = loop.call_later(self.delay, self.flush)
+
+    def flush(self, log_id=None) -> None:
+        """Write pending saves, all of them or just the one for log_id."""
+        if log_id is not None:
+            pending = {}
+            if log_id in self._pending:
+                pending[log_id] = self._pending.pop(log_id)
+        else:
+            pending, self._pending = self._pending, {}
+        if not self._pending and self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        for log_id, context in pending.items():
+            try:
+                context._write_context()
+            except Exception as e:
+                print(f"Error saving context {log_id}: {e}")
+
+
+context_writer = ContextWriter()
+
+
+import unittest
+from unittest import mock
+
+class TestContextWriter(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        import tempfile
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.old_cwd = os.getcwd()
+        os.chdir(self.tmp_dir.name)
+        os.makedirs('data/context')
+        self.old_dir = os.environ.get('CHATLOG_DIR')
+        os.environ['CHATLOG_DIR'] = os.path.join(self.tmp_dir.name, 'data/chat')
+        self.old_delay = context_writer.delay
+        context_writer.delay = 0.05
+
+    def tearDown(self):
+        context_writer.flush()
+        context_writer.delay = self.old_delay
+        if self.old_dir is None:
+            del os.environ['CHATLOG_DIR']
+        else:
+            os.environ['CHATLOG_DIR'] = self.old_dir
+        os.chdir(self.old_cwd)
+        self.tmp_dir.cleanup()
+
+    def context(self, log_id='test'):
+        context = ChatContext(command_manager, service_manager)
+        context.log_id = log_id
+        context.agent_name = 'test_agent'
+        context.agent = {'name': 'test_agent', 'flags': []}
+        context.chat_log = ChatLog(log_id=log_id, agent='test_agent')
+        return context
+
+    def saved(self, log_id='test'):
+        with open(f'data/context/context_{log_id}.json') as f:
+            return json.load(f)
+
+    async def test_burst_coalesced(self):
+        context = self.context()
+        context.save_context()
+        with mock.patch.object(ChatContext, '_write_context', autospec=True,
+                               side_effect=ChatContext._write_context) as write:
+            for i in range(10):
+                context.data['step'] = i
+                context.save_context()
+            write.assert_not_called()
+            await asyncio.sleep(0.1)
+        write.assert_called_once()
+        self.assertEqual(self.saved()['data']['step'], 9)
+
+    async def test_flush_writes_pending(self):
+        context = self.context()
+        context.save_context()
+        context.data['step'] = 1
+        context.save_context()
+        self.assertNotIn('step', self.saved()['data'])
+        # as on shutdown
+        context_writer.flush()
+        self.assertEqual(self.saved()['data']['step'], 1)
+        self.assertIsNone(context_writer._handle)
+
+    async def test_reload_without_chat_log(self):
+        context = self.context()
+        context.data['finished_conversation'] = False
+        context.chat_log.add_message({'role': 'user', 'content': 'Hello'})
+        context.chat_log.add_message({'role': 'assistant', 'content': 'Hi'})
+        context.save_context(immediate=True)
+        # the messages are in the chat log's own file, not the context file
+        self.assertEqual(set(self.saved()), {'data', 'agent_name'})
+        self.assertNotIn('Hello', json.dumps(self.saved()))
+
+        reloaded = ChatContext(command_manager, service_manager)
+        with mock.patch.object(service_manager, 'get_agent_data', create=True,
+                               new=mock.AsyncMock(return_value=context.agent)):
+            await reloaded.load_context('test')
+        self.assertEqual(reloaded.agent_name, 'test_agent')
+        self.assertEqual(reloaded.data['finished_conversation'], False)
+        self.assertEqual([message['content'] for message in reloaded.chat_log.get_history()], ['Hello', 'Hi'])
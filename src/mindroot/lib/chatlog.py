@@ -1,8 +1,15 @@
 import os
 import json
-from typing import List, Dict
+from bisect import bisect_left
+from typing import List, Dict, Optional
 import sys
 
+# Chat logs are stored as JSONL segments: a 'meta' record followed by
+# 'add' records for each message and small 'merge' records when a repeated
+# role is folded into the previous message. Once enough merge records pile
+# up the file is compacted (rewritten with one 'add' record per message).
+DEFAULT_COMPACT_AFTER = 100
+
 class ChatLog:
     def __init__(self, log_id=0, agent=None, context_length: int = 4096):
         self.log_id = log_id
@@ -13,22 +20,49 @@ class ChatLog:
         self.context_length = context_length
         self.log_dir = os.environ.get('CHATLOG_DIR', 'data/chat')
         self.log_dir = os.path.join(self.log_dir, self.agent)
+        self.compact_after = int(os.environ.get('CHATLOG_COMPACT_AFTER', DEFAULT_COMPACT_AFTER))
+        self._num_deltas = 0
+        # cached token estimates, _token_prefix[i] is the total for messages[:i]
+        self._token_counts = []
+        self._token_prefix = [0]
+        # indexes of messages holding the results of the commands in the message before
+        self._command_results = set()
+        # command list of the last message, by index, so repeated commands are
+        # appended without parsing and serializing the message text again
+        self._command_lists = {}
+        # index of the message whose text hasn't been updated with its command list yet
+        self._stale = None
         if not os.path.exists(self.log_dir):
             os.makedirs(self.log_dir)
         self.load_log()
 
     def _get_log_data(self) -> Dict[str, any]:
+        self._serialize()
         return {
             'agent': self.agent,
             'messages': self.messages
         }
 
+    def _log_file(self, log_id=None) -> str:
+        if log_id is None:
+            log_id = self.log_id
+        return os.path.join(self.log_dir, f'chatlog_{log_id}.jsonl')
+
+    def _legacy_log_file(self, log_id=None) -> str:
+        if log_id is None:
+            log_id = self.log_id
+        return os.path.join(self.log_dir, f'chatlog_{log_id}.json')
+
     def _calculate_message_length(self, message: Dict[str, str]) -> int:
         return len(json.dumps(message)) // 3
 
-    def add_message(self, message: Dict[str, str]) -> None:
+    def add_message(self, message: Dict[str, str], command_result: bool = False) -> None:
+        """Add a message, merging it into the previous one if the role repeats.
+
+        command_result marks a message carrying the results of the commands in
+        the message before it, so history windowing keeps the two together.
+        """
         if len(self.messages)>0 and self.messages[-1]['role'] == message['role']:
-            print("found repeat role")
             # check if messasge is str
             # if so, convert to dict with type 'text':
             if type(message['content']) == str:
@@ -37,66 +71,442 @@ class ChatLog:
                 for part in message['content']:
                     if part['type'] == 'image':
                         print("found image")
-                        self.messages.append(message)
-                        self.save_log()
+                        self._append_message(message, command_result)
                         return
 
             try:
-                cmd_list = json.loads(self.messages[-1]['content'][0]['text'])
-                if type(cmd_list) != list:
-                    cmd_list = [cmd_list]
+                cmd_list = self._command_list(len(self.messages) - 1)
                 new_json = json.loads(message['content'][0]['text'])
                 if type(new_json) != list:
                     new_json = [new_json]
-                new_cmd_list = cmd_list + new_json
-                self.messages[-1]['content'] = [{ 'type': 'text', 'text': json.dumps(new_cmd_list) }]
+                self._merge_commands(cmd_list, new_json, command_result)
             except Exception as e:
                 # assume previous mesage was not a command, was a string
+                self._serialize()
                 new_msg_text = self.messages[-1]['content'][0]['text'] + message['content'][0]['text']
-                self.messages.append({'role': message['role'], 'content': [{'type': 'text', 'text': new_msg_text}]})
+                self._append_message({'role': message['role'], 'content': [{'type': 'text', 'text': new_msg_text}]},
+                                     command_result)
                 #print('could not combine commands. probably normal if user message and previous system output', e)
                 #print(self.messages[-1])
                 #print(message)
                 #raise e
         else:
-            if len(self.messages)>0:
-                print('roles do not repeat, last message role is ', self.messages[-1]['role'], 'new message role is ', message['role'])
-            self.messages.append(message)
-        self.save_log()
+            self._append_message(message, command_result)
+
+    def add_commands(self, commands: List[Dict], role: str = 'assistant') -> None:
+        """Add commands, appending them to the previous message if it is a command list.
+
+        Same as add_message() with the commands as JSON text, but the commands
+        are kept as objects: appending is O(1) and the message text is only
+        written when the history is read or saved.
+
+        Args:
+            commands (list): Command objects, e.g. [{"say": {"text": "Hi"}}]
+            role (str): Message role
+        """
+        index = len(self.messages) - 1
+        if index >= 0 and self.messages[index]['role'] == role:
+            try:
+                cmd_list = self._command_list(index)
+            except Exception:
+                # previous message is text, add_message joins the two
+                self.add_message({'role': role, 'content': [{'type': 'text', 'text': json.dumps(commands)}]})
+                return
+            self._merge_commands(cmd_list, list(commands))
+            return
+        self._append_message({'role': role, 'content': [{'type': 'text', 'text': json.dumps(commands)}]})
+        self._command_lists[len(self.messages) - 1] = list(commands)
+
+    def _command_list(self, index: int) -> List:
+        """Commands in the message at index, parsing its text the first time.
+
+        Raises an exception if the message isn't a JSON command list.
+        """
+        cmd_list = self._command_lists.get(index)
+        if cmd_list is None:
+            content = self.messages[index]['content']
+            if type(content) == str:
+                raise ValueError('message content is not a command list')
+            cmd_list = json.loads(content[0]['text'])
+            if type(cmd_list) != list:
+                cmd_list = [cmd_list]
+            self._command_lists[index] = cmd_list
+        return cmd_list
+
+    def _merge_commands(self, cmd_list: List, new_cmds: List, command_result: bool = False) -> None:
+        """Append commands to the command list of the last message."""
+        index = len(self.messages) - 1
+        cmd_list.extend(new_cmds)
+        self._stale = index
+        # estimate instead of serializing the whole message again
+        count = self._calculate_message_length(new_cmds)
+        self._token_counts[index] += count
+        self._token_prefix[index + 1] += count
+        record = {'op': 'merge', 'index': index, 'commands': new_cmds}
+        if not command_result and index in self._command_results:
+            # a user message merged into command results, it starts a turn now
+            self._command_results.discard(index)
+            record['command_result'] = False
+        self._append_record(record)
+
+    def _serialize(self) -> None:
+        """Write the command list of a merged message back to its text."""
+        if self._stale is None:
+            return
+        index = self._stale
+        self._stale = None
+        self.messages[index]['content'] = [{ 'type': 'text', 'text': json.dumps(self._command_lists[index]) }]
+
+    def _append_message(self, message: Dict, command_result: bool = False) -> None:
+        # only the last message can be merged into
+        self._serialize()
+        self._command_lists = {}
+        self.messages.append(message)
+        record = {'op': 'add', 'message': message}
+        if command_result:
+            self._command_results.add(len(self.messages) - 1)
+            record['command_result'] = True
+        self._update_token_counts(len(self.messages) - 1)
+        self._append_record(record)
+
+    def _update_token_counts(self, start: int = 0) -> None:
+        """Recompute cached token estimates for messages[start:]."""
+        del self._token_counts[start:]
+        del self._token_prefix[start + 1:]
+        for message in self.messages[start:]:
+            count = self._calculate_message_length(message)
+            self._token_counts.append(count)
+            self._token_prefix.append(self._token_prefix[-1] + count)
 
     def get_history(self) -> List[Dict[str, str]]:
+        self._serialize()
         return self.messages
 
-    def get_recent(self, max_tokens: int = 4096) -> List[Dict[str, str]]:
-        recent_messages = []
-        total_length = 0
-        #print('returning all messages', self.messages)
-        return self.messages
+    def get_recent(self, max_tokens: Optional[int] = None, keep_first: int = 0) -> List[Dict[str, str]]:
+        """Get the most recent messages that fit in a token budget.
 
-        #for message in self.messages:
-        #    message_length = self._calculate_message_length(message)
-        #    if total_length + message_length <= max_tokens:
-        #        recent_messages.append(message)
-        #        total_length += message_length
-        #    else:
-        #        break
-        # 
-        #return recent_messages
+        Args:
+            max_tokens (int, optional): Token budget, None for the whole history
+            keep_first (int): Number of messages at the start of the log to always include
+
+        Returns:
+            list: Messages in the window
+        """
+        self._serialize()
+        if max_tokens is None:
+            return self.messages
+        if len(self._token_counts) != len(self.messages):
+            self._update_token_counts(0)
+
+        total = self._token_prefix[-1]
+        if total <= max_tokens:
+            return self.messages
+
+        num_messages = len(self.messages)
+        keep_first = min(keep_first, num_messages)
+        # the user message that started the current turn, a long tool loop may follow it
+        turn = next((i for i in range(num_messages - 1, keep_first - 1, -1)
+                     if self.messages[i]['role'] == 'user' and i not in self._command_results), None)
+        budget = max_tokens - self._token_prefix[keep_first]
+        # first index where the remaining messages fit in the budget
+        start = bisect_left(self._token_prefix, total - budget, lo=keep_first)
+        if turn is not None and start > turn:
+            # keep the turn's request, fill the rest of the budget with its latest
+            # commands, never starting on results without the commands they belong to
+            budget -= self._token_counts[turn]
+            start = bisect_left(self._token_prefix, total - budget, lo=turn + 1)
+            while start < num_messages and start in self._command_results:
+                start += 1
+            if start >= num_messages:
+                # nothing fits, send the last commands anyway
+                start = num_messages - 1
+                if start in self._command_results and start - 1 > turn:
+                    start -= 1
+            return self.messages[:keep_first] + self.messages[turn:turn + 1] + self.messages[start:]
+        # start the window on a user turn, never on results without the commands they belong to
+        while start < num_messages and (self.messages[start]['role'] != 'user' or start in self._command_results):
+            start += 1
+        if start >= num_messages:
+            # nothing fits, send the last turn anyway
+            start = num_messages - 1
+            if start in self._command_results and start - 1 >= keep_first:
+                start -= 1
+        start = max(start, keep_first)
+        return self.messages[:keep_first] + self.messages[start:]
+
+    def _append_record(self, record: Dict) -> None:
+        log_file = self._log_file()
+        if not os.path.exists(log_file):
+            # first write for this log, start a new segment with the full state
+            self.save_log()
+            return
+        with open(log_file, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+        if record['op'] != 'add':
+            self._num_deltas += 1
+            if self._num_deltas >= self.compact_after:
+                self.save_log()
 
     def save_log(self) -> None:
-        log_file = os.path.join(self.log_dir, f'chatlog_{self.log_id}.json')
-        with open(log_file, 'w') as f:
-            json.dump(self._get_log_data(), f, indent=2)
+        """Rewrite the whole log as a compacted segment (one 'add' record per message)."""
+        self._serialize()
+        log_file = self._log_file()
+        tmp_file = log_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            f.write(json.dumps({'op': 'meta', 'agent': self.agent}) + '\n')
+            for i, message in enumerate(self.messages):
+                record = {'op': 'add', 'message': message}
+                if i in self._command_results:
+                    record['command_result'] = True
+                f.write(json.dumps(record) + '\n')
+        os.replace(tmp_file, log_file)
+        self._num_deltas = 0
+
+    def _replay(self, log_file: str) -> bool:
+        """Load the records of a log file.
+
+        Returns:
+            bool: False if invalid records (e.g. cut off by a crash) were skipped
+        """
+        valid = True
+        messages = []
+        command_results = set()
+        merged = {}
+        num_deltas = 0
+        with open(log_file, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # partially written last record
+                    print("Skipping invalid chat log record in", log_file)
+                    valid = False
+                    continue
+                op = record.get('op')
+                if op == 'add':
+                    messages.append(record['message'])
+                    if record.get('command_result'):
+                        command_results.add(len(messages) - 1)
+                elif op == 'merge':
+                    index = record['index']
+                    if index not in merged:
+                        cmd_list = json.loads(messages[index]['content'][0]['text'])
+                        if type(cmd_list) != list:
+                            cmd_list = [cmd_list]
+                        merged[index] = cmd_list
+                    merged[index].extend(record['commands'])
+                    if record.get('command_result') is False:
+                        command_results.discard(index)
+                    num_deltas += 1
+                elif op == 'meta':
+                    self.agent = record.get('agent', self.agent)
+        for index, cmd_list in merged.items():
+            messages[index]['content'] = [{ 'type': 'text', 'text': json.dumps(cmd_list) }]
+        self.messages = messages
+        self._command_results = command_results
+        self._num_deltas = num_deltas
+        return valid
 
     def load_log(self, log_id = None) -> None:
         if log_id is None:
             log_id = self.log_id
         self.log_id = log_id
-        log_file = os.path.join(self.log_dir, f'chatlog_{log_id}.json')
+        log_file = self._log_file(log_id)
+        legacy_file = self._legacy_log_file(log_id)
+        self._command_results = set()
+        self._command_lists = {}
+        self._stale = None
         if os.path.exists(log_file):
-            with open(log_file, 'r') as f:
+            if not self._replay(log_file):
+                # records appended after a partial line would be lost too
+                self.save_log()
+        elif os.path.exists(legacy_file):
+            # migrate chat logs saved as a single JSON document
+            with open(legacy_file, 'r') as f:
                 log_data = json.load(f)
                 self.agent = log_data.get('agent')
                 self.messages = log_data.get('messages', [])
+            self.save_log()
+            os.remove(legacy_file)
+            print("Migrated chat log to", log_file)
         else:
             self.messages = []
+        self._update_token_counts(0)
+
+
+
+# Test cases
+import unittest
+
+class TestChatLogRecent(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.old_dir = os.environ.get('CHATLOG_DIR')
+        os.environ['CHATLOG_DIR'] = self.tmp_dir.name
+        self.log = ChatLog(log_id='test', agent='test_agent')
+
+    def tearDown(self):
+        if self.old_dir is None:
+            del os.environ['CHATLOG_DIR']
+        else:
+            os.environ['CHATLOG_DIR'] = self.old_dir
+        self.tmp_dir.cleanup()
+
+    def add_tool_loop(self, num_commands):
+        self.log.add_message({'role': 'user', 'content': [{'type': 'text', 'text': 'Please do the task ' + 'x' * 100}]})
+        for i in range(num_commands):
+            self.log.add_commands([{'run': {'step': i, 'text': 'y' * 200}}])
+            self.log.add_message({'role': 'user', 'content': [{'type': 'text', 'text': f'result {i} ' + 'z' * 100}]},
+                                 command_result=True)
+
+    def test_whole_history_fits(self):
+        self.add_tool_loop(2)
+        self.assertEqual(self.log.get_recent(10000), self.log.messages)
+
+    def test_long_tool_loop(self):
+        self.add_tool_loop(10)
+        self.assertGreater(self.log._token_prefix[-1], 1000)
+        recent = self.log.get_recent(400)
+        # the task, then the latest command/result pairs
+        self.assertIs(recent[0], self.log.messages[0])
+        self.assertEqual(recent[1]['role'], 'assistant')
+        self.assertEqual([m['role'] for m in recent[1:]], ['assistant', 'user'] * ((len(recent) - 1) // 2))
+        self.assertGreater(len(recent), 3)
+        self.assertEqual(recent[-1], self.log.messages[-1])
+        tokens = sum(self.log._calculate_message_length(m) for m in recent)
+        self.assertLessEqual(tokens, 400)
+
+    def test_window_starts_on_user_turn(self):
+        self.add_tool_loop(3)
+        self.log.add_message({'role': 'assistant', 'content': [{'type': 'text', 'text': 'done'}]})
+        self.add_tool_loop(3)
+        recent = self.log.get_recent(self.log._token_prefix[-1] - 10)
+        self.assertEqual(recent[0]['role'], 'user')
+        self.assertNotIn(self.log.messages.index(recent[0]), self.log._command_results)
+
+    def test_nothing_fits(self):
+        self.add_tool_loop(3)
+        recent = self.log.get_recent(10)
+        self.assertEqual(recent, [self.log.messages[0]] + self.log.messages[-2:])
+
+
+class TestChatLogFile(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.old_env = {name: os.environ.get(name) for name in ['CHATLOG_DIR', 'CHATLOG_COMPACT_AFTER']}
+        os.environ['CHATLOG_DIR'] = self.tmp_dir.name
+        os.environ['CHATLOG_COMPACT_AFTER'] = '5'
+        self.log = ChatLog(log_id='test', agent='test_agent')
+
+    def tearDown(self):
+        for name, value in self.old_env.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        self.tmp_dir.cleanup()
+
+    def reload(self):
+        return ChatLog(log_id='test', agent='test_agent')
+
+    def records(self):
+        with open(self.log._log_file(), 'r') as f:
+            return [json.loads(line) for line in f]
+
+    def add_commands_message(self, i):
+        self.log.add_message({'role': 'assistant', 'content': [{'type': 'text', 'text': json.dumps([{'say': {'text': str(i)}}])}]})
+
+    def assert_reloads(self):
+        log = self.reload()
+        self.assertEqual(log.messages, self.log.get_history())
+        self.assertEqual(log._command_results, self.log._command_results)
+        return log
+
+    def test_replay_add_and_merge(self):
+        self.log.add_message({'role': 'user', 'content': [{'type': 'text', 'text': 'hi'}]})
+        for i in range(3):
+            self.add_commands_message(i)
+        self.log.add_message({'role': 'user', 'content': [{'type': 'text', 'text': '{"result": 1}'}]}, command_result=True)
+        self.assertEqual([r['op'] for r in self.records()], ['meta', 'add', 'add', 'merge', 'merge', 'add'])
+        self.assertEqual(json.loads(self.log.get_history()[1]['content'][0]['text']),
+                         [{'say': {'text': str(i)}} for i in range(3)])
+        log = self.assert_reloads()
+        self.assertEqual(log._command_results, {2})
+        self.assertEqual(log._num_deltas, 2)
+
+    def test_compaction(self):
+        self.log.add_message({'role': 'user', 'content': [{'type': 'text', 'text': 'hi'}]})
+        for i in range(6):
+            self.add_commands_message(i)
+        # the 5th merge record compacts the file, merges are appended after it again
+        self.assertEqual([r['op'] for r in self.records()], ['meta', 'add', 'add'])
+        self.assertEqual(self.log._num_deltas, 0)
+        self.add_commands_message(6)
+        self.assertEqual([r['op'] for r in self.records()], ['meta', 'add', 'add', 'merge'])
+        self.assert_reloads()
+
+    def test_crash_while_compacting(self):
+        self.log.add_message({'role': 'user', 'content': [{'type': 'text', 'text': 'hi'}]})
+        self.add_commands_message(0)
+        with open(self.log._log_file(), 'r') as f:
+            before = f.read()
+        from unittest import mock
+        with mock.patch('os.replace', side_effect=OSError('crash')):
+            with self.assertRaises(OSError):
+                self.log.save_log()
+        # the log file is untouched, the temp file is ignored
+        with open(self.log._log_file(), 'r') as f:
+            self.assertEqual(f.read(), before)
+        self.assertTrue(os.path.exists(self.log._log_file() + '.tmp'))
+        self.assert_reloads()
+
+    def test_partial_last_record(self):
+        self.log.add_message({'role': 'user', 'content': [{'type': 'text', 'text': 'hi'}]})
+        self.add_commands_message(0)
+        with open(self.log._log_file(), 'a') as f:
+            f.write('{"op": "merge", "index": 1, "comm')
+        log = self.reload()
+        self.assertEqual(log.messages, self.log.messages)
+        # rewritten, so records appended next don't follow the partial line
+        log.add_message({'role': 'user', 'content': [{'type': 'text', 'text': 'more'}]})
+        self.assertEqual(self.reload().messages, log.messages)
+
+    def test_migrate_json_log(self):
+        messages = [{'role': 'user', 'content': [{'type': 'text', 'text': 'hi'}]},
+                    {'role': 'assistant', 'content': [{'type': 'text', 'text': '[{"say": {"text": "hello"}}]'}]}]
+        legacy_file = self.log._legacy_log_file('old')
+        with open(legacy_file, 'w') as f:
+            json.dump({'agent': 'test_agent', 'messages': messages}, f)
+        log = ChatLog(log_id='old', agent='test_agent')
+        self.assertEqual(log.messages, messages)
+        self.assertFalse(os.path.exists(legacy_file))
+        self.assertTrue(os.path.exists(log._log_file()))
+        self.assertEqual(ChatLog(log_id='old', agent='test_agent').messages, messages)
+
+    def test_merged_command_results_reload(self):
+        self.log.add_message({'role': 'user', 'content': [{'type': 'text', 'text': 'hi'}]})
+        self.log.add_commands([{'run': {'step': 0}}])
+        self.log.add_commands([{'run': {'step': 1}}, {'run': {'step': 2}}])
+        self.log.add_message({'role': 'user', 'content': [{'type': 'text', 'text': '{"result": 0}'}]}, command_result=True)
+        self.log.add_message({'role': 'user', 'content': [{'type': 'text', 'text': '{"result": 1}'}]}, command_result=True)
+        # written to the file without serializing the merged messages
+        self.assertEqual([r['op'] for r in self.records()], ['meta', 'add', 'add', 'merge', 'add', 'merge'])
+        log = self.assert_reloads()
+        self.assertEqual(json.loads(log.messages[1]['content'][0]['text']), [{'run': {'step': i}} for i in range(3)])
+        self.assertEqual(json.loads(log.messages[2]['content'][0]['text']), [{'result': 0}, {'result': 1}])
+        self.assertEqual(log._command_results, {2})
+
+    def test_user_message_merged_into_results(self):
+        self.log.add_message({'role': 'user', 'content': [{'type': 'text', 'text': 'task ' + 'x' * 300}]})
+        self.log.add_commands([{'run': {'step': 0}}])
+        self.log.add_message({'role': 'user', 'content': [{'type': 'text', 'text': '{"result": 0}'}]}, command_result=True)
+        # JSON text from the user is merged into the results
+        self.log.add_message({'role': 'user', 'content': [{'type': 'text', 'text': '{"answer": 42}'}]})
+        self.assertEqual(len(self.log.messages), 3)
+        self.assertEqual(self.log._command_results, set())
+        for log in [self.log, self.reload()]:
+            # the merged message is the current turn, not the first task
+            recent = log.get_recent(log._token_prefix[-1] - 10)
+            self.assertEqual(recent, log.messages[2:])
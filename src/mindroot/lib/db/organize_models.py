@@ -1,6 +1,12 @@
+import logging
+from copy import deepcopy
 from typing import List, Dict, Optional
 from termcolor import colored
 from mindroot.registry import data_access
+from ..plugins import on_manifest_change
+
+# the model index depends on which plugins are enabled
+on_manifest_change(data_access.invalidate)
 
 # Load equivalent flags
 def load_equivalent_flags() -> List[List[str]]:
@@ -54,7 +60,7 @@ def organize_for_display(models: List[Dict], providers: List[Dict], equivalent_f
 
     return organized_data
 
-async def load_organized():
+def _read_organized() -> List[Dict]:
     models = data_access.read_models()
     providers = data_access.read_providers()
     plugins = data_access.read_plugins()
@@ -64,15 +70,51 @@ async def load_organized():
     equivalent_flags = load_equivalent_flags()
     return organize_for_display(models, providers, equivalent_flags)
 
+def _matching_entry(entry: Dict) -> Optional[Dict]:
+    models = entry['provider']['models']
+    available_models = [model for model in models if model['available']]
+    if len(available_models) == 0:
+        return None
+    result = {}
+    result.update(available_models[0])
+    result['provider'] = entry['provider']['plugin']
+    result.update(entry['model'])
+    if 'meta' in result:
+        result.update(result['meta'])
+    return result
+
+def _build_model_index() -> Dict:
+    organized_data = _read_organized()
+    # service -> flag -> matching model info, as returned by matching_models()
+    services = {}
+    for service in organized_data:
+        flags = services.setdefault(service['service'], {})
+        for flag in service['flags']:
+            matches = flags.setdefault(flag['flag'], [])
+            for entry in flag['models']:
+                result = _matching_entry(entry)
+                if result is not None:
+                    matches.append(result)
+    return {
+        'organized': organized_data,
+        'services': services
+    }
+
+def get_model_index() -> Dict:
+    """Organized models and lookup indexes, cached until one of the source files changes."""
+    return data_access.cached('model_index',
+                              [data_access.models_file, data_access.providers_file,
+                               data_access.plugins_file, data_access.equivalent_flags_file],
+                              _build_model_index)
+
+async def load_organized():
+    return deepcopy(get_model_index()['organized'])
+
 async def uses_models(service_or_command_name: str) -> bool:
     if not isinstance(service_or_command_name, str) or not service_or_command_name:
         logging.error('Invalid service_or_command_name')
         raise ValueError('Invalid service_or_command_name')
-    organized_data = await load_organized()
-    for service in organized_data:
-        if service['service'] == service_or_command_name:
-            return True
-    return False
+    return service_or_command_name in get_model_index()['services']
 
 async def matching_models(service_or_command_name: str, flags: List[str]) -> Optional[List[Dict]]:
     if not isinstance(service_or_command_name, str) or not service_or_command_name:
@@ -84,25 +126,12 @@ async def matching_models(service_or_command_name: str, flags: List[str]) -> Opt
 
     if len(flags) == 0:
         flags = ['no_flags']
-    organized_data = await load_organized()
     # find all models that match the given service_or_command_name and equivalent_flags
+    service_flags = get_model_index()['services'].get(service_or_command_name, {})
     matching_models = []
-    for service in organized_data:
-        if service['service'] == service_or_command_name:
-            for flag in service['flags']:
-                if flag['flag'] in flags:
-                    for entry in flag['models']:
-                        result = {}  
-                        models = entry['provider']['models']
-                        available_models = [model for model in models if model['available']]
-                        if len(available_models) > 0:
-                            result.update(available_models[0])
-                            result['provider'] = entry['provider']['plugin']
-                            result.update(entry['model'])
-                            if 'meta' in result:
-                                result.update(result['meta'])
-
-                            matching_models.append(result)
+    for flag, matches in service_flags.items():
+        if flag in flags:
+            matching_models.extend(dict(match) for match in matches)
     return matching_models
 
 if __name__ == '__main__':
@@ -21,6 +21,45 @@ async def load_provider_data() -> Optional[Dict]:
         return None
     return provider_data
 
+def _build_preferred_index() -> Dict:
+    settings = data_access.read_preferred_models()
+    providers = data_access.read_providers()
+    models = data_access.read_models()
+
+    # model name -> (provider plugin, provider model entry)
+    model_providers = {}
+    for provider in providers:
+        for provider_model in provider['models']:
+            model_providers[provider_model['name']] = (provider['plugin'], provider_model)
+    models_by_name = {model['name']: model for model in models}
+
+    # (service_or_command_name, flag) -> settings with model details, in file order
+    preferred = {}
+    for order, setting in enumerate(settings):
+        model = dict(setting)
+        if model['model'] in model_providers:
+            provider_plugin, provider_model = model_providers[model['model']]
+            model['provider'] = provider_plugin
+            model.update(provider_model)
+            if model['model'] in models_by_name:
+                model.update(models_by_name[model['model']])
+            if 'meta' in model:
+                model.update(model['meta'])
+        key = (setting['service_or_command_name'], setting['flag'])
+        preferred.setdefault(key, []).append((order, model))
+
+    return {
+        'model_providers': {name: info[0] for name, info in model_providers.items()},
+        'preferred': preferred
+    }
+
+def get_preferred_index() -> Dict:
+    """Preferred model settings indexed by (service_or_command_name, flag), cached until the files change."""
+    return data_access.cached('preferred_index',
+                              [data_access.preferred_models_file, data_access.providers_file,
+                               data_access.models_file],
+                              _build_preferred_index)
+
 async def find_preferred_models(service_or_command_name: str, flags: List[str]) -> Optional[List[Dict]]:
     if not isinstance(service_or_command_name, str) or not service_or_command_name:
         logging.error('Invalid service_or_command_name')
@@ -30,43 +69,19 @@ async def find_preferred_models(service_or_command_name: str, flags: List[str])
         return None
 
     try:
-        settings = data_access.read_preferred_models()
+        preferred = get_preferred_index()['preferred']
     except Exception as e:
         logging.error(f'Error reading settings file: {e}')
         return None
 
     matching_models = []
-    # filter by service_or_command_name
-    settings = [setting for setting in settings if setting['service_or_command_name'] == service_or_command_name]
-
-    # example settings
-    for setting in settings:
-        print("setting: ", setting)
-
-        #if setting['flag'] is in flags
-        if setting['flag'] in flags:
-            matching_models.append(setting)
+    for flag in set(flags):
+        matching_models.extend(preferred.get((service_or_command_name, flag), []))
 
     if not matching_models:
         logging.debug('No matching models found')
         return None
 
-    providers = await load_provider_data()
-    models = await load_models()
-
-    for model in matching_models:
-        for provider in providers:
-            for provider_model in provider['models']:
-                if provider_model['name'] == model['model']:
-                    model['provider'] = provider['plugin']
-                    model.update(provider_model)
-                    for model_entry in models:
-                        if model['name'] == model['model']:
-                            model.update(model_entry)
-                            break
-
-                    if 'meta' in model:
-                        model.update(model['meta'])
-
+    matching_models = [dict(model) for order, model in sorted(matching_models, key=lambda item: item[0])]
     logging.debug(f'Matching models found: {matching_models}')
     return matching_models
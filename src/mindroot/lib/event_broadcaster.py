@@ -0,0 +1,449 @@
+import asyncio
+import itertools
+import json
+import os
+import uuid
+from collections import deque, OrderedDict
+from loguru import logger
+
+# event ids are "<epoch>-<number>". The epoch changes with every process, so
+# a Last-Event-ID from before a restart is recognized instead of being
+# compared with numbers that started over.
+EPOCH = uuid.uuid4().hex[:8]
+
+
+def format_event_id(event_id) -> str:
+    return f"{EPOCH}-{event_id}"
+
+
+def parse_event_id(last_event_id):
+    """Number of an event id of this process, or None if it is from another one."""
+    epoch, _, number = str(last_event_id).rpartition('-')
+    if epoch != EPOCH:
+        return None
+    try:
+        return int(number)
+    except ValueError:
+        return None
+
+
+class PendingEvent:
+    """Buffered event. Consecutive partial_command events for the same command
+    are merged into one, which is JSON encoded when it is sent.
+    """
+    __slots__ = ['id', 'event', 'data', 'item', 'snapshot', 'suffixes', 'end']
+
+    def __init__(self, event_id, event, data, item, snapshot=None):
+        self.id = event_id
+        self.event = event
+        self.data = data
+        self.item = item
+        # function returning the full data of a delta, for subscribers without
+        # deltas or without the start of the command
+        self.snapshot = snapshot
+        # appended text of merged deltas
+        self.suffixes = None
+        self.end = data['offset'] + len(data['suffix']) if 'suffix' in data else None
+
+    def for_subscriber(self, deltas) -> 'PendingEvent':
+        """Copy of this event to queue for a subscriber.
+
+        Unless deltas is set, a delta is replaced by the full data, encoded
+        when it is sent.
+        """
+        if deltas or self.end is None or self.snapshot is None:
+            self._join()
+            return PendingEvent(self.id, self.event, self.data, self.item, self.snapshot)
+        return PendingEvent(self.id, self.event, {'command': self.data.get('command')}, None, self.snapshot)
+
+    def merge(self, other: 'PendingEvent') -> bool:
+        """Merge a newer partial_command event for the same command into this one."""
+        if other.end is None:
+            # full arguments replace whatever was pending
+            self.__init__(other.id, self.event, other.data, other.item, other.snapshot)
+            return True
+        if self.end is None or self.data['path'] != other.data['path'] or self.end != other.data['offset']:
+            return False
+        # a delta continuing this one, join the suffixes once it is sent
+        if self.suffixes is None:
+            self.suffixes = [self.data['suffix']]
+        self.suffixes.append(other.data['suffix'])
+        self.end += len(other.data['suffix'])
+        self.id = other.id
+        self.item = None
+        self.snapshot = other.snapshot
+        return True
+
+    def _join(self) -> None:
+        if self.suffixes is not None:
+            data = dict(self.data)
+            data['suffix'] = ''.join(self.suffixes)
+            self.data = data
+            self.suffixes = None
+
+    def to_item(self) -> dict:
+        if self.item is None:
+            if self.suffixes is not None:
+                self._join()
+            elif self.snapshot is not None:
+                self.data = self.snapshot()
+            self.item = {'id': format_event_id(self.id), 'event': self.event, 'data': json.dumps(self.data)}
+        return self.item
+
+
+class Subscription:
+    """Bounded buffer of events for one SSE client.
+
+    Iterate over it to get (session_id, event) pairs, where event is a dict
+    with 'id', 'event' and 'data' (already JSON encoded) for EventSourceResponse.
+    """
+
+    def __init__(self, broadcaster, session_ids, max_buffer, deltas=False):
+        self.broadcaster = broadcaster
+        self.session_ids = list(session_ids)
+        self.max_buffer = max_buffer
+        # partial_command events with only the appended text (see lib.utils.partial_delta)
+        self.deltas = deltas
+        # per session, the streamed command whose arguments this subscriber
+        # has, as (command, instance), so deltas of it can be applied
+        self._streams = {}
+        self.closed = False
+        self.dropped = False
+        self._events = deque()
+        self._ready = asyncio.Event()
+
+    def put(self, session_id, event: PendingEvent, coalesce_key=None, limit=True) -> None:
+        """Queue an event (shared with other subscribers, it is copied).
+
+        Args:
+            session_id (str): Session of the event
+            event (PendingEvent): The event
+            coalesce_key (tuple, optional): (command, instance) of a partial_command event
+            limit (bool): Disconnect the subscriber if its buffer is full
+        """
+        if self.closed:
+            return
+        if coalesce_key is not None:
+            # a delta is only sent if the subscriber got the start of the
+            # command, otherwise (e.g. connected in the middle of it) all
+            # of the arguments are
+            has_params = self._streams.get(session_id) == coalesce_key
+            self._streams[session_id] = coalesce_key
+            event = event.for_subscriber(self.deltas and has_params)
+        else:
+            event = event.for_subscriber(self.deltas)
+        if coalesce_key is not None and self._events:
+            if self._events[-1][2] == (session_id, coalesce_key):
+                # a streaming command, merge with its pending event
+                if self._events[-1][1].merge(event):
+                    return
+        if limit and len(self._events) >= self.max_buffer:
+            # slow consumer, disconnect it. The browser reconnects with
+            # Last-Event-ID and catches up from the replay buffer.
+            logger.warning("SSE subscriber for {session_ids} fell behind, disconnecting",
+                           session_ids=self.session_ids)
+            self.dropped = True
+            self.close()
+            return
+        if coalesce_key is not None:
+            coalesce_key = (session_id, coalesce_key)
+        self._events.append((session_id, event, coalesce_key))
+        self._ready.set()
+
+    def close(self) -> None:
+        self.closed = True
+        self._ready.set()
+        self.broadcaster.unsubscribe(self)
+
+    async def __aiter__(self):
+        try:
+            while True:
+                while self._events:
+                    session_id, event, _ = self._events.popleft()
+                    yield session_id, event.to_item()
+                if self.closed:
+                    return
+                self._ready.clear()
+                await self._ready.wait()
+        finally:
+            self.close()
+
+
+class EventBroadcaster:
+    """Fan-out of agent output events to SSE subscribers, by session.
+
+    publish() never blocks: each subscriber has a bounded buffer in which
+    consecutive partial_command events are merged, and subscribers that
+    fall further behind are disconnected. The last events of each session
+    are kept in a replay buffer so reconnecting clients can resume from their
+    Last-Event-ID.
+    """
+
+    def __init__(self, max_buffer=None, replay_size=None, max_replay_sessions=None):
+        if max_buffer is None:
+            max_buffer = int(os.environ.get('AH_SSE_BUFFER', 1000))
+        if replay_size is None:
+            replay_size = int(os.environ.get('AH_SSE_REPLAY', 500))
+        if max_replay_sessions is None:
+            max_replay_sessions = int(os.environ.get('AH_SSE_REPLAY_SESSIONS', 256))
+        self.max_buffer = max_buffer
+        self.replay_size = replay_size
+        self.max_replay_sessions = max_replay_sessions
+        # session_id -> set of Subscription
+        self._subscribers = {}
+        # session_id -> deque of (id, PendingEvent, coalesce_key)
+        self._replay = OrderedDict()
+        self._ids = itertools.count(1)
+
+    def __contains__(self, session_id) -> bool:
+        return session_id in self._subscribers
+
+    def publish(self, session_id, event: str, data, snapshot=None) -> None:
+        """Send an event to all subscribers of a session.
+
+        Args:
+            session_id (str): Chat session (log_id)
+            event (str): Event name
+            data: JSON serializable event data
+            snapshot (callable, optional): For partial_command deltas, returns
+                                           the full data for subscribers without deltas
+                                           or that didn't get the start of the command
+        """
+        event_id = next(self._ids)
+        item = {'id': format_event_id(event_id), 'event': event, 'data': json.dumps(data)}
+        pending = PendingEvent(event_id, event, data, item, snapshot)
+        coalesce_key = None
+        if event == 'partial_command':
+            # only events of the same streamed command are merged, not those
+            # of the next command with the same name
+            coalesce_key = (data.get('command'), data.get('instance'))
+
+        replay = self._replay.get(session_id)
+        if replay is None:
+            replay = self._replay[session_id] = deque(maxlen=self.replay_size)
+            self._trim_replay()
+        else:
+            self._replay.move_to_end(session_id)
+        if coalesce_key is not None and replay and replay[-1][2] == coalesce_key \
+                and replay[-1][1].merge(pending):
+            replay[-1] = (event_id, replay[-1][1], coalesce_key)
+        else:
+            replay.append((event_id, pending, coalesce_key))
+
+        for subscription in list(self._subscribers.get(session_id, ())):
+            subscription.put(session_id, pending, coalesce_key)
+
+    def _trim_replay(self) -> None:
+        while len(self._replay) > self.max_replay_sessions:
+            for session_id in self._replay:
+                if session_id not in self._subscribers:
+                    del self._replay[session_id]
+                    break
+            else:
+                return
+
+    def subscribe(self, session_ids, last_event_id=None, deltas=False) -> Subscription:
+        """Subscribe to the events of one or more sessions.
+
+        Args:
+            session_ids (str or list): Session(s) to subscribe to
+            last_event_id (str, optional): Last event id the client received,
+                                           newer buffered events are replayed (all
+                                           of them for an id from another process)
+            deltas (bool): Send partial_command events with only the appended
+                           text, for clients that apply them. The first event
+                           of each command sent is a full snapshot
+
+        Returns:
+            Subscription: Async iterable of (session_id, event)
+        """
+        if isinstance(session_ids, str):
+            session_ids = [session_ids]
+        subscription = Subscription(self, session_ids, self.max_buffer, deltas)
+        if last_event_id:
+            last_id = parse_event_id(last_event_id)
+            # an id from before a restart: the client missed everything buffered since
+            missed = []
+            for session_id in session_ids:
+                for event_id, pending, coalesce_key in self._replay.get(session_id, ()):
+                    if last_id is None or event_id > last_id:
+                        missed.append((event_id, session_id, pending, coalesce_key))
+            missed.sort(key=lambda entry: entry[0])
+            # like any new subscriber, it gets the full arguments of a streamed
+            # command before deltas of it
+            for _, session_id, pending, coalesce_key in missed:
+                subscription.put(session_id, pending, coalesce_key, limit=False)
+        for session_id in session_ids:
+            self._subscribers.setdefault(session_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        for session_id in subscription.session_ids:
+            subscribers = self._subscribers.get(session_id)
+            if subscribers is None:
+                continue
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self._subscribers[session_id]
+
+    def close_session(self, session_id) -> None:
+        """Disconnect all subscribers of a session and drop its replay buffer."""
+        for subscription in list(self._subscribers.get(session_id, ())):
+            subscription.close()
+        self._replay.pop(session_id, None)
+
+
+import unittest
+
+class TestEventBroadcaster(unittest.TestCase):
+    def setUp(self):
+        self.broadcaster = EventBroadcaster(max_buffer=5, replay_size=20)
+
+    def received(self, subscription):
+        """Events queued for a subscriber, as sent: (event, decoded data, id)."""
+        items = []
+        while subscription._events:
+            _, event, _ = subscription._events.popleft()
+            item = event.to_item()
+            items.append((item['event'], json.loads(item['data']), item['id']))
+        return items
+
+    def say(self, offset, suffix, instance=1):
+        return {'command': 'say', 'instance': instance, 'path': ['text'], 'offset': offset, 'suffix': suffix}
+
+    def test_ids_have_epoch(self):
+        subscription = self.broadcaster.subscribe('s1')
+        self.broadcaster.publish('s1', 'running_command', {'command': 'say'})
+        [(_, _, event_id)] = self.received(subscription)
+        self.assertEqual(parse_event_id(event_id), 1)
+        self.assertIsNone(parse_event_id('0123abcd-1'))
+        self.assertIsNone(parse_event_id('1'))
+
+    def test_replay_after_reconnect(self):
+        subscription = self.broadcaster.subscribe('s1')
+        for i in range(3):
+            self.broadcaster.publish('s1', 'command_result', {'n': i})
+        last_id = self.received(subscription)[1][2]
+        subscription.close()
+        self.broadcaster.publish('s1', 'command_result', {'n': 3})
+        self.broadcaster.publish('s2', 'command_result', {'n': 'other session'})
+        # events after the last one the client got
+        resumed = self.broadcaster.subscribe('s1', last_event_id=last_id)
+        self.assertEqual([data['n'] for _, data, _ in self.received(resumed)], [2, 3])
+        # an id from before a restart gets everything buffered
+        restarted = self.broadcaster.subscribe('s1', last_event_id='0123abcd-2')
+        self.assertEqual([data['n'] for _, data, _ in self.received(restarted)], [0, 1, 2, 3])
+
+    def test_slow_subscriber_dropped_and_reconnects(self):
+        subscription = self.broadcaster.subscribe('s1')
+        other = self.broadcaster.subscribe('s1')
+        self.broadcaster.publish('s1', 'command_result', {'n': 0})
+        last_id = self.received(subscription)[0][2]
+        for i in range(1, 7):
+            self.broadcaster.publish('s1', 'command_result', {'n': i})
+            self.received(other)
+        self.assertTrue(subscription.dropped)
+        self.assertTrue(subscription.closed)
+        self.assertNotIn(subscription, self.broadcaster._subscribers['s1'])
+        # the others keep receiving
+        self.assertFalse(other.closed)
+        resumed = self.broadcaster.subscribe('s1', last_event_id=last_id)
+        self.assertEqual([data['n'] for _, data, _ in self.received(resumed)], list(range(1, 7)))
+
+    def test_coalesce_streamed_command(self):
+        subscription = self.broadcaster.subscribe('s1', deltas=True)
+        self.broadcaster.publish('s1', 'partial_command', {'command': 'say', 'instance': 1, 'params': {'text': 'He'}})
+        self.broadcaster.publish('s1', 'partial_command', self.say(2, 'll'))
+        self.broadcaster.publish('s1', 'partial_command', self.say(4, 'o'))
+        # the next command with the same name isn't merged into this one
+        self.broadcaster.publish('s1', 'partial_command', self.say(0, 'Bye', instance=2))
+        self.broadcaster.publish('s1', 'partial_command', self.say(3, '!', instance=2))
+        events = [data for _, data, _ in self.received(subscription)]
+        self.assertEqual(events, [{'command': 'say', 'instance': 1, 'params': {'text': 'He'}},
+                                  self.say(2, 'llo'), self.say(0, 'Bye!', instance=2)])
+
+    def stream(self, encoder, text, complete=False):
+        """Publish a streamed say command as services.partial_command does."""
+        params = {'text': text}
+        data = encoder.encode('say', params, complete)
+        if data is None:
+            return
+        full_params = encoder.params if encoder.params is not None else params
+        instance = data['instance']
+
+        def snapshot():
+            return {'command': 'say', 'instance': instance, 'params': full_params}
+
+        self.broadcaster.publish('s1', 'partial_command', data, snapshot)
+
+    def apply(self, state, items):
+        """Arguments a client ends up with after the events, None if it drops one."""
+        from .utils.partial_delta import apply_delta
+        for _, data, _ in items:
+            if 'suffix' in data:
+                if state is None or state['instance'] != data['instance']:
+                    return None
+                state = {'instance': data['instance'],
+                         'params': apply_delta(state['params'], data['path'], data['offset'], data['suffix'])}
+            else:
+                state = {'instance': data['instance'], 'params': data['params']}
+        return state
+
+    def test_deltas_per_subscriber(self):
+        from .utils.partial_delta import PartialCommandEncoder
+        encoder = PartialCommandEncoder()
+        deltas = self.broadcaster.subscribe('s1', deltas=True)
+        full = self.broadcaster.subscribe('s1')
+        self.stream(encoder, 'He')
+        deltas_items, full_items = self.received(deltas), self.received(full)
+        self.stream(encoder, 'Hello')
+        deltas_items += self.received(deltas)
+        full_items += self.received(full)
+        self.assertEqual([data for _, data, _ in deltas_items],
+                         [{'command': 'say', 'instance': 1, 'params': {'text': 'He'}}, self.say(2, 'llo')])
+        self.assertEqual([data for _, data, _ in full_items],
+                         [{'command': 'say', 'instance': 1, 'params': {'text': 'He'}},
+                          {'command': 'say', 'instance': 1, 'params': {'text': 'Hello'}}])
+        # the same events, with the same ids
+        self.assertEqual([event_id for _, _, event_id in deltas_items],
+                         [event_id for _, _, event_id in full_items])
+
+    def test_delta_subscriber_resumes_with_snapshot(self):
+        from .utils.partial_delta import PartialCommandEncoder
+        encoder = PartialCommandEncoder()
+        subscription = self.broadcaster.subscribe('s1', deltas=True)
+        self.stream(encoder, 'One')
+        self.stream(encoder, 'One two')
+        items = self.received(subscription)
+        state = self.apply(None, items)
+        subscription.close()
+        self.stream(encoder, 'One two three')
+        self.stream(encoder, 'One two three four')
+        resumed = self.broadcaster.subscribe('s1', last_event_id=items[-1][2], deltas=True)
+        replayed = self.received(resumed)
+        # the arguments so far, then deltas again
+        self.assertEqual([data for _, data, _ in replayed],
+                         [{'command': 'say', 'instance': 1, 'params': {'text': 'One two three four'}}])
+        self.stream(encoder, 'One two three four five')
+        live = self.received(resumed)
+        self.assertEqual([data for _, data, _ in live], [self.say(18, ' five')])
+        self.assertEqual(self.apply(state, replayed + live)['params'], {'text': 'One two three four five'})
+
+    def test_reconnect_mid_command_gets_snapshot(self):
+        from .utils.partial_delta import PartialCommandEncoder
+        encoder = PartialCommandEncoder()
+        subscription = self.broadcaster.subscribe('s1', deltas=True)
+        self.stream(encoder, 'One')
+        self.stream(encoder, 'One two')
+        self.received(subscription)
+        subscription.close()
+        # a new page and a reconnect after a restart have none of the
+        # arguments, and get all of them first
+        fresh = self.broadcaster.subscribe('s1', deltas=True)
+        restarted = self.broadcaster.subscribe('s1', last_event_id='0123abcd-1', deltas=True)
+        self.stream(encoder, 'One two three')
+        self.stream(encoder, 'One two three four')
+        for client in (fresh, restarted):
+            items = self.received(client)
+            self.assertIn('params', items[0][1])
+            self.assertEqual(self.apply(None, items)['params'], {'text': 'One two three four'})
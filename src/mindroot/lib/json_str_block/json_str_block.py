@@ -2,7 +2,192 @@ import json
 from partial_json_parser import loads, ensure_json
 import re
 
-def replace_raw_blocks(jsonish):
+START_RAW = 'START_RAW'
+END_RAW = 'END_RAW'
+
+# scanner states
+_OUT = 0
+_STRING_START = 1
+_STRING = 2
+_RAW_START = 3
+_RAW = 4
+_RAW_CLOSE = 5
+
+_OUT_SPECIAL = re.compile(r'"|START_RAW')
+_STRING_SPECIAL = re.compile(r'["\\\x00-\x1f]')
+_CONTROL_ESCAPES = {'\n': '\\n', '\r': '\\r', '\t': '\\t', '\b': '\\b', '\f': '\\f'}
+
+
+def _escape_control(c):
+    return _CONTROL_ESCAPES.get(c) or '\\u%04x' % ord(c)
+
+
+def _partial_token_length(text, token):
+    """Length of the longest end of text that is the start of token."""
+    for k in range(min(len(token) - 1, len(text)), 0, -1):
+        if text.endswith(token[:k]):
+            return k
+    return 0
+
+
+class RawBlockRewriter:
+    """
+    Resumable, single pass version of replace_raw_blocks().
+
+    Feed it the text as it is streamed; it remembers whether it is inside a
+    JSON string (and after a backslash) or a raw block, so every character
+    is scanned once. result() returns the JSON for the text so far, with an
+    unfinished raw block closed as a string (ending in a line break, like
+    each of its lines).
+
+    Usage:
+        rewriter = RawBlockRewriter()
+        async for part in stream:
+            rewriter.feed(part)
+            json_text = rewriter.result()
+
+    or replace_raw_blocks(buffer, rewriter) with a buffer that only grows.
+    """
+
+    def __init__(self):
+        # number of characters fed so far
+        self.offset = 0
+        self._state = _OUT
+        self._out = []
+        self._raw = []
+        # end of the input that might be part of START_RAW or END_RAW
+        self._held = ''
+        self._escape = False
+        self._quoted = False
+
+    def feed(self, text: str) -> None:
+        """Scan the next part of the text."""
+        self.offset += len(text)
+        text = self._held + text
+        self._held = ''
+        pos = 0
+        n = len(text)
+        while pos < n:
+            state = self._state
+            if state == _STRING:
+                pos = self._scan_string(text, pos)
+            elif state == _OUT:
+                pos = self._scan_out(text, pos)
+            elif state == _RAW:
+                pos = self._scan_raw(text, pos)
+            elif state == _STRING_START:
+                pos = self._scan_string_start(text, pos)
+            elif state == _RAW_START:
+                pos = self._scan_raw_start(text, pos)
+            else:
+                pos = self._scan_raw_close(text, pos)
+
+    def result(self) -> str:
+        """JSON for the text fed so far."""
+        out = ''.join(self._out)
+        self._out = [out]
+        if self._state in (_RAW_START, _RAW):
+            raw = ''.join(self._raw)
+            self._raw = [raw]
+            if self._state == _RAW:
+                # as the line by line version did
+                return out + json.dumps(raw + self._held + '\n')
+            return out + json.dumps(raw + self._held)
+        if self._state == _STRING_START:
+            return out + '"' + self._held
+        return out + self._held
+
+    def _scan_out(self, text, pos):
+        m = _OUT_SPECIAL.search(text, pos)
+        if m is None:
+            keep = _partial_token_length(text, START_RAW)
+            self._out.append(text[pos:len(text) - keep])
+            self._held = text[len(text) - keep:]
+            return len(text)
+        self._out.append(text[pos:m.start()])
+        if m.group() == '"':
+            # the quote is written once we know the string isn't "START_RAW
+            self._state = _STRING_START
+        else:
+            self._start_raw(quoted=False)
+        return m.end()
+
+    def _scan_string_start(self, text, pos):
+        start = text[pos:pos + len(START_RAW)]
+        if start == START_RAW:
+            self._start_raw(quoted=True)
+            return pos + len(START_RAW)
+        if len(start) < len(START_RAW) and START_RAW.startswith(start):
+            self._held = text[pos:]
+            return len(text)
+        self._out.append('"')
+        self._state = _STRING
+        return pos
+
+    def _scan_string(self, text, pos):
+        if self._escape:
+            self._escape = False
+            c = text[pos]
+            # a backslash before a line break becomes \n
+            self._out.append(_escape_control(c)[1:] if c < ' ' else c)
+            return pos + 1
+        m = _STRING_SPECIAL.search(text, pos)
+        if m is None:
+            self._out.append(text[pos:])
+            return len(text)
+        i = m.start()
+        self._out.append(text[pos:i])
+        c = text[i]
+        if c == '"':
+            self._out.append('"')
+            self._state = _OUT
+        elif c == '\\':
+            self._out.append('\\')
+            self._escape = True
+        else:
+            # literal line breaks etc. aren't allowed in JSON strings
+            self._out.append(_escape_control(c))
+        return i + 1
+
+    def _start_raw(self, quoted):
+        self._quoted = quoted
+        self._raw = []
+        self._state = _RAW_START
+
+    def _scan_raw_start(self, text, pos):
+        # the raw text starts on the line after START_RAW
+        c = text[pos]
+        if c in ' \t\r':
+            return pos + 1
+        self._state = _RAW
+        return pos + 1 if c == '\n' else pos
+
+    def _scan_raw(self, text, pos):
+        idx = text.find(END_RAW, pos)
+        if idx == -1:
+            keep = _partial_token_length(text, END_RAW)
+            self._raw.append(text[pos:len(text) - keep])
+            self._held = text[len(text) - keep:]
+            return len(text)
+        self._raw.append(text[pos:idx])
+        self._out.append(json.dumps(''.join(self._raw)))
+        self._raw = []
+        self._state = _RAW_CLOSE
+        return idx + len(END_RAW)
+
+    def _scan_raw_close(self, text, pos):
+        # drop the closing quote of "START_RAW ... END_RAW"
+        c = text[pos]
+        if c == '"':
+            self._state = _OUT
+            return pos + 1
+        if self._quoted and c in ' \t\r\n':
+            return pos + 1
+        self._state = _OUT
+        return pos
+
+
+def replace_raw_blocks(jsonish, rewriter=None):
     """
     Allows embedding raw text blocks for JSON properties, e.g.:
 
@@ -19,65 +204,68 @@ def replace_raw_blocks(jsonish):
     def foo():
         print('hello world')
     END_RAW }
-    } 
+    }
     ]
+
+    The raw text (from the line after START_RAW up to END_RAW) becomes a
+    JSON string, "START_RAW ... END_RAW" in quotes is accepted too. Line
+    breaks and other control characters inside JSON strings are escaped.
+
+    Args:
+        jsonish (str): Text to convert, may be incomplete
+        rewriter (RawBlockRewriter, optional): Rewriter that already scanned the
+            start of jsonish (e.g. the streamed buffer at the previous token),
+            only the rest of the text is scanned
+
+    Returns:
+        str: JSON text
     """
-    final_string = ""
-    in_raw = False
-    raw_string = ""
-    for line in jsonish.split("\n"):
-        if in_raw:
-            if "END_RAW" in line:
-                line = line.replace("\nEND_RAW\n\"", "") 
-                line = line.replace("\nEND_RAW\"", "")
-                line = line.replace("\nEND_RAW", "")
-                line = line.replace("END_RAW\"", "")
-                line = line.replace("END_RAW", "")
-                final_string += json.dumps(raw_string) + line
-                in_raw = False
-            else:
-                raw_string += line + "\n"
-        else:
-            if "START_RAW" in line:
-                in_raw = True
-                raw_string = ""
-                line = line.replace("\"START_RAW\n", "")
-                line = line.replace("\"START_RAW", "")
-                line = line.replace("START_RAW \n", "")
-                line = line.replace("START_RAW\n", "")
-                line = line.replace("START_RAW", "")
-                final_string += line
-            else:
-                final_string += line + "\n"
-    if in_raw:
-        final_string += json.dumps(raw_string)
-
-    final_string = re.sub(r'(?<!")""(?!")', '"', final_string)
-    # check if parsable as partial json
-    try:
-        #print("should be json: \n", final_string)
-        ensure_json(final_string)
-    except Exception as e:
-        escaped_nl_in_fenced = re.sub(r'```[\s\S]*?```',
-                          lambda m: m.group(0).replace('\n', '\\n'),
-                          final_string)
-        try:
-            ensure_json(escaped_nl_in_fenced)
-            return escaped_nl_in_fenced
-        except Exception as e:
-            try:
-                final_string = final_string.strip().replace("\n", "\\n")
-                ensure_json(final_string)
-                return final_string
-            except Exception as e:
-                return final_string
-    return final_string
+    if rewriter is None:
+        rewriter = RawBlockRewriter()
+    rewriter.feed(jsonish[rewriter.offset:])
+    return rewriter.result()
 
 
 if __name__ == "__main__":
-    # read test example 1 from ex1.txt
-    with open("ex9.txt") as f:
-    #    #with open("test_case_1.json") as f:
+    # python -m lib.json_str_block.json_str_block [example file]
+    # converts the example, checks the examples (ex*.txt) give the same values
+    # as the original line by line version, then times converting them in one
+    # go and token by token as they are streamed
+    import glob
+    import os
+    import sys
+    import time
+
+    def replace_raw_blocks_lines(jsonish):
+        # the original version, without its fallbacks for invalid JSON
+        final_string = ""
+        in_raw = False
+        raw_string = ""
+        for line in jsonish.split("\n"):
+            if in_raw:
+                if "END_RAW" in line:
+                    line = line.replace("END_RAW\"", "")
+                    line = line.replace("END_RAW", "")
+                    final_string += json.dumps(raw_string) + line
+                    in_raw = False
+                else:
+                    raw_string += line + "\n"
+            else:
+                if "START_RAW" in line:
+                    in_raw = True
+                    raw_string = ""
+                    line = line.replace("\"START_RAW", "")
+                    line = line.replace("START_RAW", "")
+                    final_string += line
+                else:
+                    final_string += line + "\n"
+        if in_raw:
+            final_string += json.dumps(raw_string)
+        return re.sub(r'(?<!")""(?!")', '"', final_string)
+
+    this_dir = os.path.dirname(os.path.abspath(__file__))
+    example = sys.argv[1] if len(sys.argv) > 1 else os.path.join(this_dir, "ex9.txt")
+    with open(example) as f:
         jsonish = f.read()
     new_json = replace_raw_blocks(jsonish)
 
@@ -87,5 +275,41 @@ if __name__ == "__main__":
 
     print('-----------------------------------------')
     print(data)
+    print('-----------------------------------------')
 
+    for path in sorted(glob.glob(os.path.join(this_dir, "ex*.txt")), key=lambda p: int(re.sub(r'\D', '', os.path.basename(p)))):
+        with open(path) as f:
+            text = f.read()
+        tokens = [text[i:i + 4] for i in range(0, len(text), 4)]
+
+        start = time.perf_counter()
+        for _ in range(20):
+            replace_raw_blocks(text)
+        whole = (time.perf_counter() - start) / 20
+
+        start = time.perf_counter()
+        buffer = ''
+        for token in tokens:
+            buffer += token
+            replace_raw_blocks(buffer)
+        rescan = time.perf_counter() - start
+
+        start = time.perf_counter()
+        rewriter = RawBlockRewriter()
+        buffer = ''
+        for token in tokens:
+            buffer += token
+            result = replace_raw_blocks(buffer, rewriter)
+        resumed = time.perf_counter() - start
+        assert result == replace_raw_blocks(text)
+
+        try:
+            expected = loads(replace_raw_blocks_lines(text))
+        except Exception:
+            # e.g. line breaks in strings, which only the new version escapes
+            expected = None
+        if expected is not None:
+            assert loads(result) == expected, path
 
+        print(f"{os.path.basename(path):>10} {len(text):>7} chars  whole {whole * 1000:7.2f} ms  "
+              f"per token: rescan {rescan * 1000:8.1f} ms, resumed {resumed * 1000:7.1f} ms")
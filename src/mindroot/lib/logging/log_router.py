@@ -1,8 +1,8 @@
 from loguru import logger
 from fastapi import APIRouter, Query
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, StreamingResponse
 from datetime import datetime, timedelta
-from .logfiles import get_logs
+from .logfiles import get_logs, iter_log_lines
 
 router = APIRouter()
 
@@ -128,16 +128,27 @@ async def api_logs(
     end: str = Query(..., description="End time (ISO format)"),
     limit: int = Query(1000, description="Maximum number of logs to return"),
     search_str: str = Query(None, description="Search string"),
-    cursor: str = Query(None, description="Cursor for pagination")
+    cursor: str = Query(None, description="Cursor for pagination"),
+    level: str = Query(None, description="Comma separated levels, e.g. INFO,ERROR"),
+    function: str = Query(None, description="Comma separated function names"),
+    format: str = Query("json", description="json, or ndjson to stream one log entry per line")
 ):
-    start_time = datetime.fromisoformat(start)
-    end_time = datetime.fromisoformat(end)
-    cursor_time = datetime.fromisoformat(cursor) if cursor else None
+    start_time = datetime.fromisoformat(start).replace(tzinfo=None)
+    end_time = datetime.fromisoformat(end).replace(tzinfo=None)
+    cursor_time = datetime.fromisoformat(cursor).replace(tzinfo=None) if cursor else None
     search_str = search_str.strip() if search_str else None
     if search_str == 'null':
         search_str = None
+    levels = [l.strip().upper() for l in level.split(',') if l.strip()] if level else None
+    functions = [f.strip() for f in function.split(',') if f.strip()] if function else None
 
-    logs, next_cursor = await get_logs(start_time, end_time, search_str, limit, cursor_time)
+    if format == 'ndjson':
+        # the log lines are already JSON, send them as they are without
+        # collecting the results in memory
+        lines = iter_log_lines(start_time, end_time, search_str, limit, cursor_time, levels, functions)
+        return StreamingResponse((line for _, line in lines), media_type="application/x-ndjson")
+
+    logs, next_cursor = await get_logs(start_time, end_time, search_str, limit, cursor_time, levels, functions)
 
     return {
         "logs": logs,
@@ -1,6 +1,12 @@
 import os
+import re
 import json
 import sys
+import time
+import queue
+import random
+import atexit
+import threading
 from datetime import datetime, timedelta
 from loguru import logger
 
@@ -10,16 +16,185 @@ if not os.path.exists('logs'):
 logger.remove()  # Remove default handler
 logger.add(sys.stderr, format="{time} | {level} | {function} | {message}", level="INFO")
 
-def json_sink(message):
-    record = message.record
-    log_entry = {
-        "time": record["time"].isoformat(),
-        "level": record["level"].name,
-        "function": record["function"],
-        "message": record["message"],
-        "extra": record["extra"],
-    }
-    write_log(log_entry)
+LEVEL_NAMES = ['TRACE', 'DEBUG', 'INFO', 'SUCCESS', 'WARNING', 'ERROR', 'CRITICAL']
+
+def parse_sampling(spec):
+    """Parse log sampling rules.
+
+    Args:
+        spec (str): Comma separated rules of the form LEVEL=rate, module=rate or
+                    module:LEVEL=rate, e.g. "DEBUG=0.1,coreplugins.agent.agent:DEBUG=0.01"
+
+    Returns:
+        dict: (module or None, level or None) -> fraction of records to keep
+    """
+    rules = {}
+    for rule in spec.split(','):
+        rule = rule.strip()
+        if not rule:
+            continue
+        key, _, rate = rule.partition('=')
+        module, _, level = key.strip().rpartition(':')
+        if not module and level.upper() not in LEVEL_NAMES:
+            module, level = level, ''
+        try:
+            rules[(module or None, level.upper() or None)] = float(rate)
+        except ValueError:
+            print(f"Invalid log sampling rule: {rule}")
+    return rules
+
+class JsonLogSink:
+    """Loguru sink writing JSON lines to hourly log files.
+
+    Records are encoded on the calling thread and written by a background
+    thread that keeps the current hour's file open and writes in batches,
+    flushing every batch_size records or flush_interval seconds. Records can
+    be sampled per level and module (AH_LOG_SAMPLE, see parse_sampling).
+    """
+
+    def __init__(self, flush_interval=None, batch_size=None, max_queue=None, sampling=None):
+        if flush_interval is None:
+            flush_interval = float(os.environ.get('AH_LOG_FLUSH_INTERVAL', 1.0))
+        if batch_size is None:
+            batch_size = int(os.environ.get('AH_LOG_BATCH_SIZE', 200))
+        if max_queue is None:
+            max_queue = int(os.environ.get('AH_LOG_QUEUE_SIZE', 10000))
+        if sampling is None:
+            sampling = os.environ.get('AH_LOG_SAMPLE', '')
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.sampling = parse_sampling(sampling)
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._file_name = None
+        self._file = None
+        self._index = None
+        # second of the last index row written
+        self._bucket = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def sample_rate(self, module, level):
+        if not self.sampling:
+            return 1.0
+        name = module
+        while name:
+            for key in [(name, level), (name, None)]:
+                if key in self.sampling:
+                    return self.sampling[key]
+            name = name.rpartition('.')[0]
+        return self.sampling.get((None, level), 1.0)
+
+    def __call__(self, message):
+        record = message.record
+        level = record["level"].name
+        rate = self.sample_rate(record["name"], level)
+        if rate < 1.0 and random.random() >= rate:
+            return
+        log_entry = {
+            "time": record["time"].isoformat(),
+            "level": level,
+            "function": record["function"],
+            "message": record["message"],
+            "extra": record["extra"],
+        }
+        self.put(log_entry)
+
+    def put(self, log_entry):
+        timestamp = datetime.fromisoformat(log_entry['time'])
+        # encode now, the entry may be changed by the caller after this returns
+        line = (json.dumps(log_entry, default=str) + '\n').encode('utf-8')
+        self._start()
+        try:
+            self._queue.put_nowait((generate_file_name(timestamp), line, bucket_key(timestamp)))
+        except queue.Full:
+            self.dropped += 1
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='json-log-writer', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        pending = []
+        last_flush = time.monotonic()
+        while True:
+            timeout = max(0.0, last_flush + self.flush_interval - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if item is not None:
+                if item[0] is None:
+                    # flush request, item[1] is an Event to set when done
+                    self._write(pending)
+                    pending = []
+                    last_flush = time.monotonic()
+                    item[1].set()
+                    continue
+                pending.append(item)
+            if len(pending) >= self.batch_size or time.monotonic() - last_flush >= self.flush_interval:
+                self._write(pending)
+                pending = []
+                last_flush = time.monotonic()
+
+    def _open(self, file_name):
+        if self._file is not None:
+            self._file.close()
+            self._index.close()
+        # unbuffered, so each batch is appended with a single write
+        self._file = open(file_name, 'ab', buffering=0)
+        self._index = open(index_file_name(file_name), 'ab', buffering=0)
+        self._file_name = file_name
+        self._bucket = None
+
+    def _write(self, pending):
+        try:
+            start = 0
+            while start < len(pending):
+                file_name = pending[start][0]
+                end = start + 1
+                while end < len(pending) and pending[end][0] == file_name:
+                    end += 1
+                self._write_file(file_name, pending[start:end])
+                start = end
+        except Exception as e:
+            print(f"Error writing log file {self._file_name}: {e}", file=sys.stderr)
+
+    def _write_file(self, file_name, items):
+        if file_name != self._file_name:
+            self._open(file_name)
+        data = b''.join(line for _, line, _ in items)
+        self._file.write(data)
+        # other processes may append to the same file, the batch ends where
+        # the file position is after the write
+        offset = self._file.tell() - len(data)
+        rows = []
+        for _, line, bucket in items:
+            if self._bucket is None or bucket > self._bucket:
+                rows.append(index_row(bucket, offset))
+                self._bucket = bucket
+            offset += len(line)
+        if rows:
+            # rows only after the lines they point to are on disk
+            self._index.write(''.join(rows).encode())
+
+    def flush(self, timeout=5.0):
+        """Wait until the queued records are written."""
+        if self._thread is None or not self._thread.is_alive():
+            return
+        done = threading.Event()
+        try:
+            self._queue.put((None, done), timeout=timeout)
+        except queue.Full:
+            return
+        done.wait(timeout)
+
+json_sink = JsonLogSink()
+atexit.register(json_sink.flush)
 
 logger.info("This is a test log message")
 
@@ -28,10 +203,159 @@ logger.add(json_sink, level="DEBUG")
 def generate_file_name(timestamp):
     return f"logs/log_{timestamp.strftime('%Y-%m-%d_%H')}.json"
 
+# Each hourly log file has a sidecar index (log_*.idx) with a tab separated row
+# per second with records: the second (local time of the records) and the byte
+# offset of its first record. Every process writing the file appends rows after
+# the records they point to, so the rows are in time order, give or take the
+# flush interval of the writers. Queries bisect the index file to find the part
+# of the log file to read.
+INDEX_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+INDEX_BUCKET_FORMAT = '%Y-%m-%dT%H:%M:%S'
+# read this much more on both ends, for records written out of order by
+# processes appending to the same file
+INDEX_SLACK = timedelta(seconds=5)
+_LINE_PREFIX = re.compile(rb'\{"time": "([^"]+)", "level": "([^"]+)", "function": "([^"]*)"')
+
+def time_key(timestamp):
+    """Sortable string for a log time, in the local time of the record."""
+    return timestamp.replace(tzinfo=None).strftime(INDEX_TIME_FORMAT)
+
+def bucket_key(timestamp):
+    """The second of a log time, as used in the index."""
+    return timestamp.replace(tzinfo=None).strftime(INDEX_BUCKET_FORMAT)
+
+def index_file_name(file_name):
+    return file_name[:-len('.json')] + '.idx'
+
+def index_row(bucket, offset):
+    return f"{bucket}\t{offset}\n"
+
+def parse_index_row(line):
+    """(second, offset) of an index row, None if it is incomplete or invalid."""
+    parts = line.rstrip(b'\n').split(b'\t')
+    if not line.endswith(b'\n') or len(parts) != 2:
+        return None
+    try:
+        return parts[0].decode(), int(parts[1])
+    except ValueError:
+        return None
+
+def parse_log_line(line):
+    """(time_key, level, function) of a log line, None if it can't be parsed."""
+    match = _LINE_PREFIX.match(line)
+    try:
+        if match:
+            log_time = datetime.fromisoformat(match.group(1).decode())
+            return time_key(log_time), match.group(2).decode(), match.group(3).decode()
+        log_entry = json.loads(line)
+        return time_key(datetime.fromisoformat(log_entry['time'])), log_entry['level'], log_entry['function']
+    except (ValueError, KeyError, TypeError):
+        return None
+
+def _index_row_from(f, pos):
+    """First valid row of an index file starting at or after pos.
+
+    Returns:
+        tuple: (second, offset, position of the row), None if there is none
+    """
+    f.seek(max(pos - 1, 0))
+    if pos > 0:
+        # the rest of the row pos - 1 is in
+        f.readline()
+    while True:
+        row_pos = f.tell()
+        line = f.readline()
+        if not line:
+            return None
+        row = parse_index_row(line)
+        if row is not None:
+            return row + (row_pos,)
+
+def _index_row_before(f, pos):
+    """Last valid row of an index file ending at or before pos (a row start), or None."""
+    start = pos
+    while start > 0:
+        start = max(0, start - 4096)
+        f.seek(start)
+        lines = f.read(pos - start).splitlines(keepends=True)
+        if start > 0:
+            # may start in the middle of a row
+            lines = lines[1:]
+        for line in reversed(lines):
+            row = parse_index_row(line)
+            if row is not None:
+                return row
+    return None
+
+def _bisect_index(f, size, bucket):
+    """Position of the first row of an index file for bucket or a later second (size if none)."""
+    lo, hi = 0, size
+    while lo < hi:
+        mid = (lo + hi) // 2
+        row = _index_row_from(f, mid)
+        if row is None or row[0] >= bucket:
+            hi = mid
+        else:
+            lo = mid + 1
+    row = _index_row_from(f, lo)
+    return row[2] if row else size
+
+def index_range(file_name, start_time, end_time):
+    """Part of a log file that has the records from start_time to end_time.
+
+    Returns:
+        tuple: (start offset, end offset or None for the end of the file)
+    """
+    index_file = index_file_name(file_name)
+    if not os.path.exists(index_file):
+        return 0, None
+    with open(index_file, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        # the records before the first second of the range are all earlier
+        pos = _bisect_index(f, size, bucket_key(start_time - INDEX_SLACK))
+        row = _index_row_before(f, pos)
+        start = row[1] if row else 0
+        # the records from the first second after the range on are all later
+        pos = _bisect_index(f, size, bucket_key(end_time + INDEX_SLACK + timedelta(seconds=1)))
+        row = _index_row_from(f, pos)
+        end = row[1] if row else None
+    return start, end
+
+def has_index(file_name):
+    """Whether a log file has an index (in this format)."""
+    try:
+        with open(index_file_name(file_name), 'rb') as f:
+            return parse_index_row(f.readline()) is not None
+    except FileNotFoundError:
+        return False
+
+def build_index(file_name):
+    """Write the index of a log file that was written without one."""
+    rows = []
+    bucket = None
+    offset = 0
+    with open(file_name, 'rb') as f:
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            record = parse_log_line(line)
+            if record is not None:
+                # the second of the time key
+                second = record[0].partition('.')[0]
+                if bucket is None or second > bucket:
+                    bucket = second
+                    rows.append(index_row(bucket, offset))
+            offset += len(line)
+    index_file = index_file_name(file_name)
+    tmp_file = index_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        f.write(''.join(rows))
+    os.replace(tmp_file, index_file)
+
 def get_log_files(start_time, end_time):
     files_to_read = []
     # Ensure both datetimes are naive
-    current_time = start_time.replace(tzinfo=None)
+    current_time = start_time.replace(tzinfo=None, minute=0, second=0, microsecond=0)
     end_time = end_time.replace(tzinfo=None)
     while current_time <= end_time:
         file_name = generate_file_name(current_time)
@@ -40,7 +364,63 @@ def get_log_files(start_time, end_time):
         current_time += timedelta(hours=1)
     return files_to_read
 
-async def get_logs(start_time, end_time, search_str=None, limit=30000, cursor=None):
+def iter_log_lines(start_time, end_time, search_str=None, limit=None, cursor=None, levels=None, functions=None):
+    """Yield matching log lines, as JSON encoded bytes.
+
+    Args:
+        start_time (datetime): Start of the time range
+        end_time (datetime): End of the time range
+        search_str (str, optional): Only lines containing this string
+        limit (int, optional): Maximum number of lines
+        cursor (datetime, optional): Only records after this time
+        levels (list, optional): Only these levels
+        functions (list, optional): Only records logged from these functions
+
+    Yields:
+        tuple: (time, line)
+    """
+    start_key = time_key(start_time)
+    end_key = time_key(end_time)
+    range_start = start_time
+    if cursor is not None:
+        range_start = max(start_time, cursor + timedelta(microseconds=1))
+        start_key = time_key(range_start)
+    search_bytes = search_str.encode('utf-8') if search_str else None
+    count = 0
+    for file_name in get_log_files(start_time, end_time):
+        if file_name != json_sink._file_name and not has_index(file_name) \
+           and time.time() - os.path.getmtime(file_name) > 3600:
+            # no longer written to, index it for next time
+            build_index(file_name)
+        start, end = index_range(file_name, range_start, end_time)
+        with open(file_name, 'rb') as f:
+            f.seek(start)
+            offset = start
+            for line in f:
+                if end is not None and offset >= end:
+                    break
+                offset += len(line)
+                if not line.endswith(b'\n'):
+                    # still being written
+                    break
+                if search_bytes is not None and search_bytes not in line:
+                    continue
+                record = parse_log_line(line)
+                if record is None:
+                    continue
+                log_time, level, function = record
+                if log_time < start_key or log_time > end_key:
+                    continue
+                if levels and level not in levels:
+                    continue
+                if functions and function not in functions:
+                    continue
+                yield log_time, line
+                count += 1
+                if limit is not None and count >= limit:
+                    return
+
+async def get_logs(start_time, end_time, search_str=None, limit=30000, cursor=None, levels=None, functions=None):
     # Ensure start_time and end_time are naive
     start_time = start_time.replace(tzinfo=None)
     end_time = end_time.replace(tzinfo=None)
@@ -50,37 +430,98 @@ async def get_logs(start_time, end_time, search_str=None, limit=30000, cursor=No
     print(end_time)
     print(search_str)
 
-    files = get_log_files(start_time, end_time)
     logs = []
     next_cursor = None
-
-    for file in files:
-        with open(file, 'r') as f:
-            for line in f:
-                if search_str is not None and search_str not in line:
-                    continue
-                log_entry = json.loads(line)
-                log_time = datetime.fromisoformat(log_entry['time']).replace(tzinfo=None)
-                
-                if cursor and log_time <= cursor.replace(tzinfo=None):
-                    continue
-                
-                if start_time <= log_time <= end_time:
-                    logs.append(log_entry)
-                    
-                if len(logs) == limit:
-                    next_cursor = log_time
-                    break
-        
-        if next_cursor:
-            break
+    for log_time, line in iter_log_lines(start_time, end_time, search_str, limit, cursor, levels, functions):
+        logs.append(json.loads(line))
+        if len(logs) == limit:
+            next_cursor = datetime.strptime(log_time, INDEX_TIME_FORMAT)
 
     return logs, next_cursor
 
 def write_log(log_entry):
-    timestamp = datetime.fromisoformat(log_entry['time'])
-    file_name = generate_file_name(timestamp)
-    
-    with open(file_name, 'a') as f:
-        json.dump(log_entry, f)
-        f.write('\n')
+    json_sink.put(log_entry)
+
+
+import unittest
+import tempfile
+
+class TestLogIndex(unittest.TestCase):
+    START = datetime(2026, 1, 1, 10, 0, 0)
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmp.name)
+        os.makedirs('logs')
+        self.file_name = generate_file_name(self.START)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def entry(self, i):
+        # 4 records per second
+        log_time = self.START + timedelta(seconds=i / 4)
+        return {"time": log_time.isoformat(), "level": "INFO" if i % 3 else "ERROR",
+                "function": "f", "message": f"record {i}", "extra": {}}
+
+    def write(self, sink, numbers):
+        for i in numbers:
+            sink.put(self.entry(i))
+        sink.flush()
+
+    def query(self, start, end, **kwargs):
+        lines = iter_log_lines(self.START + timedelta(seconds=start), self.START + timedelta(seconds=end), **kwargs)
+        return [json.loads(line)['message'] for _, line in lines]
+
+    def expected(self, start, end):
+        return [f"record {i}" for i in range(start * 4, min(end * 4 + 1, 240))]
+
+    def index_rows(self):
+        with open(index_file_name(self.file_name), 'rb') as f:
+            return [parse_index_row(line) for line in f]
+
+    def assert_rows_point_to_their_second(self):
+        with open(self.file_name, 'rb') as f:
+            for second, offset in self.index_rows():
+                f.seek(offset)
+                self.assertTrue(parse_log_line(f.readline())[0].startswith(second))
+
+    def test_row_per_second(self):
+        self.write(JsonLogSink(flush_interval=0.01, batch_size=7), range(240))
+        rows = self.index_rows()
+        self.assertEqual(len(rows), 60)
+        self.assert_rows_point_to_their_second()
+
+    def test_query_reads_part_of_file(self):
+        self.write(JsonLogSink(flush_interval=0.01, batch_size=7), range(240))
+        start, end = index_range(self.file_name, self.START + timedelta(seconds=20), self.START + timedelta(seconds=30))
+        self.assertGreater(start, 0)
+        self.assertLess(end, os.path.getsize(self.file_name))
+        self.assertEqual(self.query(20, 30), self.expected(20, 30))
+        self.assertEqual(self.query(0, 2), self.expected(0, 2))
+        self.assertEqual(self.query(58, 70), self.expected(58, 70))
+        self.assertEqual(self.query(20, 30, levels=['ERROR'], limit=2), ["record 81", "record 84"])
+
+    def test_writers_sharing_file(self):
+        # like two worker processes, each with its own file handles
+        first = JsonLogSink(flush_interval=0.01)
+        second = JsonLogSink(flush_interval=0.01)
+        for batch in range(0, 240, 10):
+            self.write(first if batch % 20 else second, range(batch, batch + 10))
+        self.assert_rows_point_to_their_second()
+        self.assertEqual(self.query(20, 30), self.expected(20, 30))
+
+    def test_file_without_index(self):
+        with open(self.file_name, 'w') as f:
+            for i in range(240):
+                f.write(json.dumps(self.entry(i)) + '\n')
+        self.assertFalse(has_index(self.file_name))
+        self.assertEqual(index_range(self.file_name, self.START, self.START), (0, None))
+        self.assertEqual(self.query(20, 30), self.expected(20, 30))
+        build_index(self.file_name)
+        self.assertTrue(has_index(self.file_name))
+        self.assertEqual(len(self.index_rows()), 60)
+        self.assert_rows_point_to_their_second()
+        self.assertEqual(self.query(20, 30), self.expected(20, 30))
@@ -30,6 +30,8 @@ from .manifest import (
     update_plugin_manifest,
     toggle_plugin_state,
     list_enabled,
+    cached_plugin_manifest,
+    on_manifest_change,
     MANIFEST_FILE
 )
 from .paths import get_plugin_path, get_plugin_import_path
@@ -46,6 +48,8 @@ __all__ = [
     'update_plugin_manifest',
     'toggle_plugin_state',
     'list_enabled',
+    'cached_plugin_manifest',
+    'on_manifest_change',
     'get_plugin_path',
     'get_plugin_import_path',
     'MANIFEST_FILE'
@@ -2,13 +2,18 @@ import os
 import sys
 import json
 import shutil
+import hashlib
 import tempfile
 import requests
 import zipfile
 import subprocess
-from pkg_resources import require as pkg_require
+from pkg_resources import require as pkg_require, ResolutionError
 from .manifest import update_plugin_manifest
 
+# requirements that were satisfied, by interpreter and requirements file hash
+DEPENDENCY_CACHE_FILE = 'data/plugin_dependency_cache.json'
+_dependency_cache = None
+
 def download_github_files(repo_path, tag=None):
     """Download GitHub repo files to temp directory.
     
@@ -65,24 +70,66 @@ def download_github_files(repo_path, tag=None):
         shutil.rmtree(temp_dir)
         raise e
 
+def _load_dependency_cache():
+    global _dependency_cache
+    if _dependency_cache is None:
+        try:
+            with open(DEPENDENCY_CACHE_FILE, 'r') as f:
+                _dependency_cache = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            _dependency_cache = {}
+    return _dependency_cache
+
+def _save_dependency_cache():
+    try:
+        os.makedirs(os.path.dirname(DEPENDENCY_CACHE_FILE), exist_ok=True)
+        tmp_file = DEPENDENCY_CACHE_FILE + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(_dependency_cache, f, indent=2)
+        os.replace(tmp_file, DEPENDENCY_CACHE_FILE)
+    except OSError as e:
+        print(f"Could not save plugin dependency cache: {e}")
+
 def check_plugin_dependencies(plugin_path):
     """Check if all plugin dependencies are met.
+
+    Successful checks are cached by the hash of requirements.txt (and the
+    Python interpreter), so unchanged plugins are not checked again on
+    every start. Failed checks are not cached.
     
     Args:
         plugin_path (str): Path to plugin directory
         
     Returns:
-        bool: True if all dependencies are met
+        bool: True if all dependencies are met (requirements that can't be
+              checked are assumed to be met)
     """
+    if not plugin_path:
+        return True
     requirements_file = os.path.join(plugin_path, 'requirements.txt')
     if os.path.exists(requirements_file):
-        with open(requirements_file, 'r') as f:
-            requirements = f.read().splitlines()
+        with open(requirements_file, 'rb') as f:
+            content = f.read()
+        key = sys.executable + ':' + hashlib.sha256(content).hexdigest()
+        cache = _load_dependency_cache()
+        if cache.get(key):
+            return True
+        requirements = content.decode('utf-8').splitlines()
         for requirement in requirements:
+            requirement = requirement.split('#', 1)[0].strip()
+            if not requirement or requirement.startswith('-'):
+                # blank line, comment or pip option
+                continue
             try:
                 pkg_require(requirement)
-            except:
+            except ResolutionError:
+                # not installed or wrong version
                 return False
+            except Exception as e:
+                # e.g. git+https://... lines, which can't be checked
+                print(f"Warning: can't check plugin requirement {requirement!r} in {requirements_file}: {e}")
+        cache[key] = True
+        _save_dependency_cache()
     return True
 
 def install_plugin_dependencies(plugin_path):
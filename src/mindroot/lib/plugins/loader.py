@@ -1,17 +1,28 @@
 import os
 import sys
+import json
+import time
+import asyncio
 import importlib
 import termcolor
 import traceback
 from fastapi import FastAPI
 from fastapi.staticfiles import StaticFiles
 from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.routing import BaseRoute, Match, NoMatchFound, compile_path
 from .paths import get_plugin_path, get_plugin_import_path
-from .manifest import list_enabled, load_plugin_manifest
+from .manifest import list_enabled, load_plugin_manifest, cached_plugin_manifest
 from .installation import check_plugin_dependencies
 
 app_instance = None
 
+# seconds spent on each step of loading each plugin, see load()
+load_timings = {}
+
+# route paths of each plugin from earlier runs, used for lazy loading:
+# {plugin_name: {"paths": [...], "public": [...]}}
+ROUTES_FILE = 'data/plugin_routes.json'
+
 def load_middleware(app, plugin_name, plugin_path):
     """Load plugin middleware if it exists.
     
@@ -65,11 +76,269 @@ def mount_static_files(app, plugin_name, category):
             'yellow'
         ))
 
-async def load(app=None):
+def has_module_file(plugin_name, category, module_name):
+    """Check for a module file in a plugin without importing the plugin."""
+    plugin_dir = get_plugin_path(plugin_name)
+    if not plugin_dir:
+        return False
+    dir_name = os.path.basename(plugin_dir)
+    if category != 'core':
+        return os.path.exists(os.path.join(plugin_dir, 'src', dir_name, f'{module_name}.py'))
+    return os.path.exists(os.path.join(plugin_dir, f'{module_name}.py'))
+
+def route_paths(routes, public=False):
+    """Paths of routes, including those of routers included in them.
+
+    With public set, only the paths of @public_route() endpoints.
+    """
+    paths = []
+    for route in routes:
+        if hasattr(route, 'path'):
+            if not public or hasattr(getattr(route, 'endpoint', None), '__public_route__'):
+                paths.append(route.path)
+        elif hasattr(route, 'original_router'):
+            # included router (newer FastAPI versions)
+            paths.extend(route_paths(route.original_router.routes, public))
+    return paths
+
+def load_router(app, plugin_name, plugin_path, category):
+    """Include the plugin's router if it has one.
+
+    Returns:
+        dict: Paths of the routes that were added ('paths') and of
+              those that don't require authentication ('public')
+    """
+    # we need to see if ther router.py actually exists
+    # because if not this isn't an error, it just means there is no router
+    # but if there is and we get an importerror, then we need to report that
+    # as an error
+    plugin_dir = get_plugin_path(plugin_name)
+    if not plugin_dir:
+        return {'paths': [], 'public': []}
+
+    dir_name = os.path.basename(plugin_dir)
+
+    if category != 'core':
+        router_path = os.path.join(plugin_dir, 'src', dir_name, 'router.py')
+    else:
+        router_path = os.path.join(plugin_dir, 'router.py')
+
+    if not os.path.exists(router_path):
+        print(f"No router found for plugin: {plugin_name} at path {plugin_path}/router.py")
+        return {'paths': [], 'public': []}
+
+    try:
+        router_module = importlib.import_module(f"{plugin_path}.router")
+        app.include_router(router_module.router)
+        print(termcolor.colored(
+            f"Included router for plugin: {plugin_name}",
+            'yellow'
+        ))
+        routes = router_module.router.routes
+        return {'paths': route_paths(routes), 'public': route_paths(routes, public=True)}
+    except ImportError as e:
+        trace = traceback.format_exc()
+        print(termcolor.colored(
+            f"Failed to load router for plugin: {plugin_name}\n{str(e)}\n{trace}",'red'))
+        return {'paths': [], 'public': []}
+
+def import_plugin(plugin_name, category, timings):
+    """Check a plugin's dependencies and import it.
+
+    Args:
+        plugin_name (str): Name of the plugin
+        category (str): Plugin category
+        timings (dict): Seconds spent per step are added here
+
+    Returns:
+        tuple: (module, import path of the plugin)
+
+    Raises:
+        RuntimeError: If the plugin can't be found or its dependencies are not met
+    """
+    step = time.perf_counter()
+
+    # Get plugin import path
+    plugin_path = get_plugin_import_path(plugin_name)
+    if not plugin_path:
+        raise RuntimeError(f"Failed to locate plugin: {plugin_name}")
+
+    # Check dependencies for non-core plugins
+    if category != 'core' and not check_plugin_dependencies(get_plugin_path(plugin_name)):
+        raise RuntimeError(f"Dependencies not met for plugin {plugin_name}")
+    now = time.perf_counter()
+    timings['dependencies'] = now - step
+    step = now
+
+    # Import plugin module
+    try:
+        module = importlib.import_module(plugin_path)
+    except ImportError:
+        module = importlib.import_module(f"{plugin_path}.mod")
+    timings['import'] = time.perf_counter() - step
+
+    print(termcolor.colored(
+        f"Loaded plugin: {plugin_name} ({category})",
+        'green'
+    ))
+    return module, plugin_path
+
+def add_plugin_routes(app, plugin_name, plugin_path, category, timings, static=True):
+    """Add an imported plugin's middleware, router and static files.
+
+    Args:
+        app (FastAPI): The FastAPI application instance
+        plugin_name (str): Name of the plugin
+        plugin_path (str): Import path of the plugin
+        category (str): Plugin category
+        timings (dict): Seconds spent per step are added here
+        static (bool): Mount the static files (already mounted for deferred plugins)
+
+    Returns:
+        dict: Route paths as returned by load_router()
+    """
+    step = time.perf_counter()
+
+    def timed(name):
+        nonlocal step
+        now = time.perf_counter()
+        timings[name] = now - step
+        step = now
+
+    # Load middleware
+    load_middleware(app, plugin_name, plugin_path)
+    timed('middleware')
+
+    # Load router if exists
+    paths = load_router(app, plugin_name, plugin_path, category)
+    timed('router')
+
+    # Mount static files
+    if static:
+        mount_static_files(app, plugin_name, category)
+        timed('static')
+    return paths
+
+async def call_on_load(app, plugin_name, module):
+    """Call a plugin's on_load(), recording how long it took."""
+    print(termcolor.colored(
+        f"Calling on_load() for plugin: {plugin_name}",
+        'yellow', 'on_green'
+    ))
+    start = time.perf_counter()
+    try:
+        await module.on_load(app)
+    finally:
+        timings = load_timings.setdefault(plugin_name, {})
+        timings['on_load'] = time.perf_counter() - start
+        timings['total'] = timings.get('total', 0) + timings['on_load']
+
+def lazy_plugin_names():
+    """Plugins to load on the first request to one of their routes.
+
+    Set with "lazy": true in the plugin's manifest entry, or the comma
+    separated AH_LAZY_PLUGINS environment variable.
+    """
+    names = set(name.strip() for name in os.environ.get('AH_LAZY_PLUGINS', '').split(',') if name.strip())
+    manifest = cached_plugin_manifest()
+    for category in manifest['plugins']:
+        for plugin_name, plugin_info in manifest['plugins'][category].items():
+            if plugin_info.get('lazy'):
+                names.add(plugin_name)
+    return names
+
+def load_recorded_routes():
+    try:
+        with open(ROUTES_FILE, 'r') as f:
+            routes = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+    # older files only have the list of paths
+    return {plugin_name: {'paths': paths, 'public': []} if isinstance(paths, list) else paths
+            for plugin_name, paths in routes.items()}
+
+def save_recorded_routes(routes):
+    try:
+        os.makedirs(os.path.dirname(ROUTES_FILE), exist_ok=True)
+        with open(ROUTES_FILE, 'w') as f:
+            json.dump(routes, f, indent=2)
+    except OSError as e:
+        print(f"Could not save plugin routes: {e}")
+
+class LazyPluginRoute(BaseRoute):
+    """Stands in for the routes of a lazily loaded plugin.
+
+    Matches the route paths the plugin had when it was last loaded. The first
+    matching request imports the plugin (router, on_load() etc.), replaces
+    this placeholder with the real routes and is then routed again.
+    public_paths are those of its routes that don't require authentication,
+    see PublicRoutes.build().
+    """
+
+    def __init__(self, app, plugin_name, category, paths, public_paths=()):
+        self.app = app
+        self.plugin_name = plugin_name
+        self.category = category
+        self.paths = paths
+        self.public_paths = list(public_paths)
+        self.path_regexes = [compile_path(path)[0] for path in paths]
+        self.loaded = False
+        self._lock = asyncio.Lock()
+
+    def matches(self, scope):
+        if scope['type'] in ('http', 'websocket'):
+            for path_regex in self.path_regexes:
+                if path_regex.match(scope['path']):
+                    return Match.FULL, {}
+        return Match.NONE, {}
+
+    def url_path_for(self, name, /, **path_params):
+        raise NoMatchFound(name, path_params)
+
+    async def handle(self, scope, receive, send):
+        async with self._lock:
+            if not self.loaded:
+                await self.load()
+        await self.app.router(scope, receive, send)
+
+    async def load(self):
+        print(termcolor.colored(f"Loading lazy plugin: {self.plugin_name}", 'yellow'))
+        timings = load_timings.setdefault(self.plugin_name, {})
+        start = time.perf_counter()
+        try:
+            module, plugin_path = import_plugin(self.plugin_name, self.category, timings)
+            if hasattr(module, 'on_load'):
+                await call_on_load(self.app, self.plugin_name, module)
+            add_plugin_routes(self.app, self.plugin_name, plugin_path, self.category, timings, static=False)
+        finally:
+            self.app.router.routes.remove(self)
+            self.loaded = True
+            timings['total'] = time.perf_counter() - start
+
+def print_load_timings():
+    """Print the time spent loading each plugin, slowest first."""
+    steps = ['dependencies', 'import', 'middleware', 'router', 'static', 'on_load']
+    print(termcolor.colored("Plugin load times (ms):", 'cyan'))
+    print(f"  {'plugin':<24}{'total':>9}" + ''.join(f"{step:>14}" for step in steps))
+    for plugin_name, timings in sorted(load_timings.items(), key=lambda item: -item[1].get('total', 0)):
+        row = f"  {plugin_name:<24}{timings.get('total', 0) * 1000:>9.1f}"
+        row += ''.join(f"{timings[step] * 1000:>14.1f}" if step in timings else f"{'-':>14}" for step in steps)
+        print(row)
+
+async def load(app=None, lazy=None):
     """Load all enabled plugins.
-    
+
+    Plugins are loaded one at a time in manifest order: each is imported,
+    its on_load() is awaited, then its middleware, router and static files
+    are added. A plugin whose module sets on_load_concurrent = True declares
+    that its on_load() doesn't depend on the plugins loaded after it (or
+    they on it): it is started as a task and the remaining plugins load
+    while it runs. load() waits for all of these tasks before returning.
+
     Args:
         app (FastAPI, optional): The FastAPI application instance
+        lazy (set, optional): Plugins to load on first request instead,
+                              defaults to lazy_plugin_names()
         
     Raises:
         Exception: If no FastAPI instance is provided or found
@@ -90,92 +359,139 @@ async def load(app=None):
     if project_root not in sys.path:
         sys.path.insert(0, project_root)
 
+    if lazy is None:
+        lazy = lazy_plugin_names()
+    recorded_routes = load_recorded_routes()
+    routes_changed = False
+
     # Load enabled plugins
     enabled_plugins = list_enabled()
     failed_plugins = []
+    on_load_tasks = []
 
     for plugin_name, category in enabled_plugins:
+        timings = load_timings[plugin_name] = {}
+        start = time.perf_counter()
         try:
-            # Get plugin import path
-            plugin_path = get_plugin_import_path(plugin_name)
-            if not plugin_path:
-                failed_plugins.append(
-                    (plugin_name, f"Failed to locate plugin: {plugin_name}")
-                )
-                continue
-
-            # Check dependencies for non-core plugins
-            if category != 'core' and not check_plugin_dependencies(plugin_path):
-                failed_plugins.append(
-                    (plugin_name, f"Dependencies not met for plugin {plugin_name}")
-                )
+            # middleware can't be added once the app is running, so plugins with middleware load now
+            recorded = recorded_routes.get(plugin_name)
+            if plugin_name in lazy and recorded and recorded['paths'] and \
+               not has_module_file(plugin_name, category, 'middleware'):
+                app.router.routes.append(LazyPluginRoute(app, plugin_name, category, recorded['paths'], recorded['public']))
+                mount_static_files(app, plugin_name, category)
+                print(termcolor.colored(f"Deferred loading plugin: {plugin_name} ({category})", 'yellow'))
                 continue
 
-            # Import plugin module
-            try:
-                module = importlib.import_module(plugin_path)
-            except ImportError:
-                module = importlib.import_module(f"{plugin_path}.mod")
-
-            print(termcolor.colored(
-                f"Loaded plugin: {plugin_name} ({category})", 
-                'green'
-            ))
+            module, plugin_path = import_plugin(plugin_name, category, timings)
 
             # Call plugin initialization
             if hasattr(module, 'on_load'):
-                print(termcolor.colored(
-                    f"Calling on_load() for plugin: {plugin_name}",
-                    'yellow', 'on_green'
-                ))
-                await module.on_load(app)
-
-            # Load middleware
-            load_middleware(app, plugin_name, plugin_path)
-
-            # Load router if exists
-            try:
-                # we need to see if ther router.py actually exists
-                # because if not this isn't an error, it just means there is no router
-                # but if there is and we get an importerror, then we need to report that
-                # as an error
-                # so to detect if the file exists we need to import os
-                plugin_dir = get_plugin_path(plugin_name)
-                if not plugin_dir:
-                    return
-                    
-                dir_name = os.path.basename(plugin_dir)
-                
-                if category != 'core': 
-                    router_path = os.path.join(plugin_dir, 'src', dir_name, 'router.py')
-                else:
-                    router_path = os.path.join(plugin_dir, 'router.py')
-
-                if os.path.exists(router_path):
-                    router_module = importlib.import_module(f"{plugin_path}.router")
-                    app.include_router(router_module.router)
-                    print(termcolor.colored(
-                        f"Included router for plugin: {plugin_name}",
-                        'yellow'
-                    ))
+                if getattr(module, 'on_load_concurrent', False):
+                    task = asyncio.ensure_future(call_on_load(app, plugin_name, module))
+                    on_load_tasks.append((plugin_name, task))
                 else:
-                    print(f"No router found for plugin: {plugin_name} at path {plugin_path}/router.py")
+                    await call_on_load(app, plugin_name, module)
 
-            except ImportError as e:
-                trace = traceback.format_exc()
-                print(termcolor.colored(
-                    f"Failed to load router for plugin: {plugin_name}\n{str(e)}\n{trace}",'red'))
-            # Mount static files
-            mount_static_files(app, plugin_name, category)
+            paths = add_plugin_routes(app, plugin_name, plugin_path, category, timings)
+            if paths != recorded:
+                recorded_routes[plugin_name] = paths
+                routes_changed = True
 
         except Exception as e:
             trace = traceback.format_exc()
             failed_plugins.append(
                 (plugin_name, f"Failed to load plugin: {str(e)}\n{trace}")
             )
+        finally:
+            timings['total'] = time.perf_counter() - start
+
+    if routes_changed:
+        save_recorded_routes(recorded_routes)
+
+    # Wait for the on_load() calls of plugins that run them concurrently
+    results = await asyncio.gather(*[task for _, task in on_load_tasks], return_exceptions=True)
+    for (plugin_name, _), result in zip(on_load_tasks, results):
+        if isinstance(result, Exception):
+            trace = ''.join(traceback.format_exception(result))
+            failed_plugins.append((plugin_name, f"on_load() failed: {str(result)}\n{trace}"))
+
+    print_load_timings()
 
     # Report failed plugins
     if failed_plugins:
         print(termcolor.colored("Failed to load the following plugins:", 'red'))
         for plugin_name, reason in failed_plugins:
             print(f"{plugin_name}: {reason}")
+
+
+import unittest
+import tempfile
+import types
+from unittest import mock
+
+class TestLoad(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.events = []
+        self.plugins = []
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmp.name)
+        from . import installation
+        patches = [
+            mock.patch(f'{__name__}.list_enabled', lambda: self.plugins),
+            mock.patch(f'{__name__}.get_plugin_import_path', lambda name: f'_test_plugin_{name}'),
+            mock.patch(f'{__name__}.get_plugin_path', lambda name: os.path.join(self.tmp.name, name)),
+            mock.patch(f'{__name__}.load_middleware', lambda app, name, path: self.events.append(('routes', name))),
+            mock.patch(f'{__name__}.load_router', lambda *args: {'paths': [], 'public': []}),
+            mock.patch(f'{__name__}.mount_static_files', lambda *args: None),
+            mock.patch.object(installation, '_dependency_cache', None),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        for name, _ in self.plugins:
+            sys.modules.pop(f'_test_plugin_{name}', None)
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def add_plugin(self, name, category='core', delay=0.01, requirements=None, **attrs):
+        module = types.ModuleType(f'_test_plugin_{name}')
+        async def on_load(app):
+            self.events.append(('start', name))
+            await asyncio.sleep(delay)
+            self.events.append(('end', name))
+        module.on_load = on_load
+        module.__dict__.update(attrs)
+        sys.modules[module.__name__] = module
+        os.makedirs(name)
+        if requirements is not None:
+            with open(os.path.join(name, 'requirements.txt'), 'w') as f:
+                f.write(requirements)
+        self.plugins.append((name, category))
+
+    async def test_on_load_in_manifest_order(self):
+        self.add_plugin('a')
+        self.add_plugin('b')
+        await load(FastAPI(), lazy=set())
+        self.assertEqual(self.events, [('start', 'a'), ('end', 'a'), ('routes', 'a'),
+                                       ('start', 'b'), ('end', 'b'), ('routes', 'b')])
+
+    async def test_on_load_concurrent(self):
+        self.add_plugin('a', delay=0.05, on_load_concurrent=True)
+        self.add_plugin('b')
+        await load(FastAPI(), lazy=set())
+        # a's routes don't wait for its on_load(), b is loaded while it runs,
+        # and load() returns once it is done
+        events = self.events
+        self.assertLess(events.index(('routes', 'a')), events.index(('start', 'a')))
+        self.assertLess(events.index(('start', 'a')), events.index(('end', 'b')))
+        self.assertEqual(events[-1], ('end', 'a'))
+
+    async def test_dependencies_not_met(self):
+        self.add_plugin('a', category='installed', requirements='mindroot-no-such-package>=1.0\n')
+        self.add_plugin('b', category='installed', requirements='# comment\ngit+https://example.com/b.git\n')
+        await load(FastAPI(), lazy=set())
+        # a isn't initialized or routed, a requirement that can't be checked doesn't fail b
+        self.assertEqual(self.events, [('start', 'b'), ('end', 'b'), ('routes', 'b')])
@@ -1,22 +1,78 @@
 import json
 import os
+from copy import deepcopy
 from datetime import datetime
 
 # Central definition of manifest file location
 MANIFEST_FILE = 'plugin_manifest.json'
 
+# Parsed manifest, revalidated against the file's mtime and size.
+# 'enabled' caches list_enabled() results for this version of the manifest.
+_manifest_cache = {'stamp': None, 'manifest': None, 'enabled': {}}
+_change_callbacks = []
+
+def on_manifest_change(callback):
+    """Register a function to call (without arguments) when the manifest changes.
+
+    Used by caches that depend on the installed or enabled plugins.
+
+    Args:
+        callback (callable): Function to call
+
+    Returns:
+        callable: The callback, so this can be used as a decorator
+    """
+    _change_callbacks.append(callback)
+    return callback
+
+def _notify_change():
+    for callback in _change_callbacks:
+        try:
+            callback()
+        except Exception as e:
+            print(f"Error in plugin manifest change callback {callback}: {e}")
+
+def _manifest_stamp():
+    try:
+        stat = os.stat(MANIFEST_FILE)
+        return (stat.st_mtime_ns, stat.st_size)
+    except FileNotFoundError:
+        return None
+
+def _set_cached_manifest(manifest, stamp):
+    changed = _manifest_cache['manifest'] is not None
+    _manifest_cache['stamp'] = stamp
+    _manifest_cache['manifest'] = manifest
+    _manifest_cache['enabled'] = {}
+    if changed:
+        _notify_change()
+
+def cached_plugin_manifest():
+    """Get the plugin manifest without copying it.
+
+    The result is shared, it must not be modified. Use load_plugin_manifest()
+    to get a copy to change and save.
+
+    Returns:
+        dict: The manifest data structure
+    """
+    stamp = _manifest_stamp()
+    if stamp is None:
+        create_default_plugin_manifest()
+        stamp = _manifest_stamp()
+    if stamp != _manifest_cache['stamp']:
+        # first use, or changed outside of this module
+        with open(MANIFEST_FILE, 'r') as f:
+            _set_cached_manifest(json.load(f), stamp)
+    return _manifest_cache['manifest']
+
 def load_plugin_manifest():
     """Load the plugin manifest file.
     
     Returns:
         dict: The manifest data structure
     """
-    abs_path = os.path.abspath(MANIFEST_FILE)
-    if not os.path.exists(MANIFEST_FILE):
-        create_default_plugin_manifest()
-
-    with open(MANIFEST_FILE, 'r') as f:
-        return json.load(f)
+    return deepcopy(cached_plugin_manifest())
 
 def save_plugin_manifest(manifest):
     """Save the plugin manifest file.
@@ -26,6 +82,7 @@ def save_plugin_manifest(manifest):
     """
     with open(MANIFEST_FILE, 'w') as f:
         json.dump(manifest, f, indent=2)
+    _set_cached_manifest(deepcopy(manifest), _manifest_stamp())
 
 def update_plugin_manifest(plugin_name, source, source_path, remote_source=None, version="0.0.1", metadata=None):
     """Update or add a plugin entry in the manifest.
@@ -101,8 +158,11 @@ def list_enabled(include_category=True):
     Returns:
         list: List of enabled plugins, optionally with categories
     """
+    manifest = cached_plugin_manifest()
+    cached = _manifest_cache['enabled'].get(include_category)
+    if cached is not None:
+        return list(cached)
     enabled_list = []
-    manifest = load_plugin_manifest()
     for category in manifest['plugins']:
         for plugin_name, plugin_info in manifest['plugins'][category].items():
             if plugin_info.get('enabled'):
@@ -110,4 +170,5 @@ def list_enabled(include_category=True):
                     enabled_list.append((plugin_name, category))
                 else:
                     enabled_list.append(plugin_name)
-    return enabled_list
+    _manifest_cache['enabled'][include_category] = enabled_list
+    return list(enabled_list)
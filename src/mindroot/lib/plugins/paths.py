@@ -1,7 +1,7 @@
 import os
 import sys
 from importlib.util import find_spec
-from .manifest import load_plugin_manifest
+from .manifest import cached_plugin_manifest
 
 def _get_project_root():
     """Get the absolute path to the project root directory.
@@ -58,7 +58,7 @@ def get_plugin_path(plugin_name):
     Returns:
         str: Absolute path to the plugin directory or None if not found
     """
-    manifest = load_plugin_manifest()
+    manifest = cached_plugin_manifest()
     for category in manifest['plugins']:
         if plugin_name in manifest['plugins'][category]:
             plugin_info = manifest['plugins'][category][plugin_name]
@@ -86,7 +86,7 @@ def get_plugin_import_path(plugin_name):
     Returns:
         str: Import path for the plugin or None if not found
     """
-    manifest = load_plugin_manifest()
+    manifest = cached_plugin_manifest()
     for category in manifest['plugins']:
         if plugin_name in manifest['plugins'][category]:
             plugin_info = manifest['plugins'][category][plugin_name]
@@ -3,10 +3,11 @@ import traceback
 import json
 import logging
 from typing import List, Dict, Optional
-from ..db.preferences import find_preferred_models
-from ..db.organize_models import uses_models, matching_models
+from ..db.preferences import find_preferred_models, get_preferred_index
+from ..db.organize_models import uses_models, matching_models, get_model_index
 from ..utils.check_args import *
 import sys
+import time
 import nanoid
 from termcolor import colored
 
@@ -14,6 +15,9 @@ from termcolor import colored
 class ProviderManager:
     def __init__(self):
         self.functions = {}
+        # (name, context flags) -> (function_info, model), see resolve()
+        self._dispatch_cache = {}
+        self._dispatch_indexes = None
 
     def register_function(self, name, provider, implementation, signature, docstring, flags):
         if name not in self.functions:
@@ -29,78 +33,99 @@ class ProviderManager:
             'flags': flags,
             'provider': provider
         })
+        self._dispatch_cache.clear()
         print("registered function: ", name, provider, implementation, signature, docstring, flags)
-    
-    async def execute(self, name, *args, **kwargs):
-        #print(f"execute: {name} called")
 
-        if check_empty_args(args, kwargs=kwargs):
-            raise ValueError(f"function '{name}' called with empty arguments.")
+    async def resolve(self, name, flags=None):
+        """Find the implementation and model to use for a function.
 
-        if name not in self.functions:
-            raise ValueError(f"function '{name}' not found.")
-        preferred_models = None
-        preferred_provider = None
+        Results are cached per (name, flags) until a function is registered
+        or the model registry/preferred model settings change.
+
+        Args:
+            name (str): Function name
+            flags (tuple, optional): Context flags, None when called without a ChatContext
 
-        found_context = False
-        context = None
-        for arg in args:
-            if arg.__class__.__name__ == 'ChatContext':
-                found_context = True
-                context = arg
-                break
-        
+        Returns:
+            tuple: (function_info, model) where model is the selected model info or None
+        """
+        indexes = (get_model_index(), get_preferred_index())
+        if self._dispatch_indexes is None or any(a is not b for a, b in zip(indexes, self._dispatch_indexes)):
+            self._dispatch_cache.clear()
+            self._dispatch_indexes = indexes
 
-        if not found_context and not ('context' in kwargs):
-            kwargs['context'] = self.context
-            context = self.context
+        key = (name, flags)
+        if key in self._dispatch_cache:
+            return self._dispatch_cache[key]
+
+        if name not in self.functions:
+            raise ValueError(f"function '{name}' not found.")
 
-        #print("context is ", context)
         need_model = await uses_models(name)
+        preferred_models = None
+        preferred_provider = None
 
-        if context.__class__.__name__ == 'ChatContext':
-            preferred_models = await find_preferred_models(name, context.flags)
-            context.data['model'] = None
+        if flags is not None:
+            preferred_models = await find_preferred_models(name, list(flags))
 
             if need_model and preferred_models is None:
                 #print("Did not find preferred, loading all matching based on flags")
-                preferred_models = await matching_models(name, context.flags)
-            
-            if preferred_models is not None:
-                if len(preferred_models) > 0:
-                    context.data['model'] = preferred_models[0]
+                preferred_models = await matching_models(name, list(flags))
 
-        if preferred_models is not None:
-            if len(preferred_models) > 0:
-                print("preferred models:", preferred_models)
-                preferred_provider = preferred_models[0]['provider']
+        model = None
+        if preferred_models is not None and len(preferred_models) > 0:
+            print("preferred models:", preferred_models)
+            model = preferred_models[0]
+            preferred_provider = model['provider']
 
         function_info = None
 
         if not need_model and (preferred_provider is None):
             preferred_provider = self.functions[name][0]['provider']
 
-
         if preferred_provider is not None:
             for func_info in self.functions[name]:
                 if func_info['provider'] == preferred_provider:
                     function_info = func_info
                     break
-            function_info = self.functions[name][0]
+            if function_info is None:
+                print(f"preferred provider '{preferred_provider}' has no function '{name}', using '{self.functions[name][0]['provider']}'")
+                function_info = self.functions[name][0]
 
         if function_info is None:
             raise ValueError(f"1. function '{name}' not found. preferred_provider is '{preferred_provider}'.")
 
-        implementation = function_info['implementation']
-
-        if implementation is None:
+        if function_info['implementation'] is None:
             raise ValueError(f"2. function '{name}' not found. preferred_provider is '{preferred_provider}'.")
 
-        try:
-            result = await implementation(*args, **kwargs)
-        except Exception as e:
-            raise e
-        return result
+        self._dispatch_cache[key] = (function_info, model)
+        return function_info, model
+
+    async def execute(self, name, *args, **kwargs):
+        #print(f"execute: {name} called")
+
+        if name not in self.functions:
+            raise ValueError(f"function '{name}' not found.")
+
+        if 'context' in kwargs:
+            context = kwargs['context']
+        else:
+            context = None
+            for arg in args:
+                if arg.__class__.__name__ == 'ChatContext':
+                    context = arg
+                    break
+            if context is None:
+                kwargs['context'] = self.context
+                context = self.context
+
+        if context.__class__.__name__ == 'ChatContext':
+            function_info, model = await self.resolve(name, tuple(context.flags))
+            context.data['model'] = dict(model) if model is not None else None
+        else:
+            function_info, model = await self.resolve(name)
+
+        return await function_info['implementation'](*args, **kwargs)
 
     def get_docstring(self, name):
         if name not in self.functions:
@@ -175,7 +200,10 @@ class HookManager:
         results = []
         for hook_info in self.hooks[name]:
             implementation = hook_info['implementation']
+            start = time.perf_counter()
             result = await implementation(*args, **kwargs)
+            # read by the startup profiler (mindroot --profile-startup)
+            hook_info['last_duration'] = time.perf_counter() - start
             results.append(result)
         return results
 
@@ -0,0 +1,66 @@
+"""Micro-benchmark for ProviderManager dispatch overhead.
+
+Run from the mindroot source directory:
+
+    python -m lib.providers.dispatch_benchmark [iterations]
+
+Uses a temporary directory with an empty model registry, so it measures
+only the resolution/dispatch work done by execute() compared to calling
+the implementation directly.
+"""
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from . import ProviderManager
+
+
+class ChatContext:
+    def __init__(self):
+        self.flags = []
+        self.data = {}
+
+
+async def noop(text="", context=None):
+    return text
+
+
+def write_empty_registry():
+    os.makedirs('data', exist_ok=True)
+    for name in ['models.json', 'providers.json', 'equivalent_flags.json', 'preferred_models.json']:
+        with open(os.path.join('data', name), 'w') as f:
+            json.dump([], f)
+    with open('plugin_manifest.json', 'w') as f:
+        json.dump({'plugins': {'core': {}, 'local': {}, 'installed': {}}}, f)
+
+
+async def run(iterations):
+    manager = ProviderManager()
+    manager.register_function('noop', 'bench', noop, None, None, [])
+    context = ChatContext()
+    manager.context = context
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        await noop("hi", context=context)
+    direct = time.perf_counter() - start
+
+    await manager.execute('noop', "hi")
+    start = time.perf_counter()
+    for _ in range(iterations):
+        await manager.execute('noop', "hi")
+    dispatched = time.perf_counter() - start
+
+    print(f"direct call:     {direct / iterations * 1e6:8.2f} us")
+    print(f"execute():       {dispatched / iterations * 1e6:8.2f} us")
+    print(f"dispatch cost:   {(dispatched - direct) / iterations * 1e6:8.2f} us per call")
+
+
+if __name__ == '__main__':
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.chdir(tmp_dir)
+        write_empty_registry()
+        asyncio.run(run(iterations))
@@ -1,25 +1,150 @@
 from fastapi import FastAPI, Request
+from starlette.routing import Mount
+from starlette.staticfiles import StaticFiles
 from typing import Set
 from functools import wraps
+import re
 
 app = FastAPI()
-public_routes: Set[str] = set()
+
+_PARAM = re.compile(r"\{([^}:]+)(?::([^}]+))?\}")
+
+
+def path_pattern(path: str) -> str:
+    """Regex for a route path, with {param} matching one segment and {param:path} the rest."""
+    pattern = ''
+    last = 0
+    for match in _PARAM.finditer(path):
+        pattern += re.escape(path[last:match.start()])
+        pattern += '.*' if match.group(2) == 'path' else '[^/]+'
+        last = match.end()
+    return pattern + re.escape(path[last:])
+
+
+def find_routes(routes, prefix=''):
+    """Yield (path, route) for routes, including those inside mounts and included routers."""
+    for route in routes:
+        if isinstance(route, Mount):
+            yield f"{prefix}{route.path}", route
+            for sub_route in route.routes:
+                if hasattr(sub_route, 'path'):
+                    yield f"{prefix}{route.path}{sub_route.path}", sub_route
+        elif hasattr(route, 'path'):
+            yield f"{prefix}{route.path}", route
+        elif hasattr(route, 'original_router'):
+            # included router (newer FastAPI versions)
+            include_prefix = getattr(getattr(route, 'include_context', None), 'prefix', '') or ''
+            yield from find_routes(route.original_router.routes, prefix + include_prefix)
+
+
+class PublicRoutes:
+    """Paths that don't require authentication.
+
+    Built from the app's route table: routes whose endpoint is decorated with
+    @public_route() (also of lazy plugins that aren't loaded yet), plus static asset mounts (/static, /imgs and
+    /{plugin}/static) when public_static is set. Plain paths are checked with
+    a set lookup, paths with parameters and prefixes with a single compiled
+    regex. `path in public_routes` tells whether a request path is public.
+
+    The table is rebuilt when the number of app routes changes, e.g. after a
+    lazy plugin has been loaded.
+    """
+
+    def __init__(self):
+        self._exact: Set[str] = set()
+        self._patterns = []
+        self._prefixes = []
+        self._manual = []
+        self._regex = None
+        self._app = None
+        self._route_count = None
+        self.public_static = False
+
+    def add(self, path: str) -> None:
+        """Make a path public. It may contain {param} parts."""
+        self._manual.append(('path', path))
+        self._add_path(path)
+        self._compile()
+
+    def add_prefix(self, prefix: str) -> None:
+        """Make every path starting with prefix public."""
+        self._manual.append(('prefix', prefix))
+        self._prefixes.append(prefix)
+        self._compile()
+
+    def _add_path(self, path):
+        if '{' in path:
+            self._patterns.append(path_pattern(path))
+        else:
+            self._exact.add(path)
+
+    def _compile(self):
+        self._patterns = list(dict.fromkeys(self._patterns))
+        self._prefixes = list(dict.fromkeys(self._prefixes))
+        parts = self._patterns + [re.escape(prefix) + '.*' for prefix in self._prefixes]
+        self._regex = re.compile('|'.join(parts)) if parts else None
+
+    def build(self, app, public_static=False) -> None:
+        """Collect the public routes from the app's route table.
+
+        Args:
+            app (FastAPI): The application, after plugins have been loaded
+            public_static (bool): Let static asset mounts skip authentication
+        """
+        self._app = app
+        self.public_static = public_static
+        self._route_count = len(app.routes)
+        self._exact = set()
+        self._patterns = []
+        self._prefixes = []
+        for route in app.routes:
+            # placeholder of a lazily loaded plugin (see LazyPluginRoute)
+            for path in getattr(route, 'public_paths', ()):
+                self._add_path(path)
+        for path, route in find_routes(app.routes):
+            if hasattr(route, 'endpoint') and hasattr(route.endpoint, '__public_route__'):
+                self._add_path(path)
+            elif public_static and isinstance(route, Mount) and isinstance(route.app, StaticFiles) \
+                    and (path in ['/static', '/imgs'] or path.endswith('/static')):
+                self._prefixes.append(path.rstrip('/') + '/')
+        for kind, path in self._manual:
+            if kind == 'prefix':
+                self._prefixes.append(path)
+            else:
+                self._add_path(path)
+        self._compile()
+
+    def __contains__(self, path) -> bool:
+        if self._app is not None and len(self._app.routes) != self._route_count:
+            self.build(self._app, self.public_static)
+        if path in self._exact:
+            return True
+        return self._regex is not None and self._regex.fullmatch(path) is not None
+
+    def __len__(self) -> int:
+        return len(self._exact) + len(self._patterns) + len(self._prefixes)
+
+    def __iter__(self):
+        yield from self._exact
+        yield from self._patterns
+        yield from self._prefixes
+
+
+public_routes = PublicRoutes()
 
 def public_route():
-    # include route path/function name
-    print("public_route decorator called", public_routes)
+    """Mark a route as not requiring authentication.
+
+    The path is registered when the route table is scanned after plugins
+    are loaded (see PublicRoutes.build).
+    """
     def decorator(func):
         @wraps(func)
         async def wrapper(*args, **kwargs):
-            print("public route !!!!!!!!!!!")
             request: Request = next((arg for arg in args if isinstance(arg, Request)), None)
             if request:
                 request.state.public_route = True
             return await func(*args, **kwargs)
         wrapper.__public_route__ = True
-        public_routes.add(func.__name__)
-        print("wrapper.__public_route__", wrapper.__public_route__)
         return wrapper
     return decorator
-
-
@@ -0,0 +1,234 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from .providers.services import service_manager
+from .providers.commands import command_manager
+from .chatcontext import ChatContext
+
+
+class SessionCache:
+    """LRU registry of live ChatContext objects (with their ChatLog), keyed by log_id.
+
+    Keeps sessions in memory between messages instead of reloading the
+    context file, agent data and chat log for every message. Every user of a
+    session gets the same ChatContext instance, so changes made by one task
+    (e.g. exit_conversation) are seen by the others immediately.
+
+    Agent runs on a session are serialized by its lock (see use()): a
+    message sent while the agent is still working on the previous one waits
+    until that run, with all of its command iterations, has finished.
+
+    Sessions idle for longer than idle_timeout, and the least recently used
+    ones beyond max_sessions, are saved and dropped, except while they are in
+    use: dropping a context a task still has would let a reload create a
+    second ChatLog appending to the same file.
+    """
+
+    def __init__(self, max_sessions=None, idle_timeout=None):
+        if max_sessions is None:
+            max_sessions = int(os.environ.get('AH_SESSION_CACHE_SIZE', 256))
+        if idle_timeout is None:
+            idle_timeout = float(os.environ.get('AH_SESSION_IDLE_SECONDS', 1800))
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        # log_id -> {'context', 'last_used', 'agent_stamp'}
+        self._sessions = OrderedDict()
+        self._locks = {}
+        self._loading = {}
+        # log_id -> number of tasks in use() blocks, running or waiting for the lock
+        self._users = {}
+
+    def lock(self, log_id) -> asyncio.Lock:
+        """Lock serializing agent runs on a session."""
+        if log_id not in self._locks:
+            self._locks[log_id] = asyncio.Lock()
+        return self._locks[log_id]
+
+    @asynccontextmanager
+    async def use(self, log_id, lock=False):
+        """Keep a session in memory while a task works with its context.
+
+        Args:
+            log_id (str): Session
+            lock (bool): Also hold the session's lock, waiting for the agent
+                         run that holds it to finish
+        """
+        self._users[log_id] = self._users.get(log_id, 0) + 1
+        try:
+            if lock:
+                async with self.lock(log_id):
+                    yield
+            else:
+                yield
+        finally:
+            self._users[log_id] -= 1
+            if not self._users[log_id]:
+                del self._users[log_id]
+
+    def in_use(self, log_id) -> bool:
+        lock = self._locks.get(log_id)
+        return log_id in self._users or (lock is not None and lock.locked())
+
+    def add(self, context: ChatContext) -> None:
+        """Register a newly created (and saved) context."""
+        self._sessions[context.log_id] = {
+            'context': context,
+            'last_used': time.monotonic(),
+            'agent_stamp': _agent_stamp(context.agent_name)
+        }
+        self._sessions.move_to_end(context.log_id)
+        self._evict()
+
+    async def get(self, log_id) -> ChatContext:
+        """Get the live context for a session, loading it from disk if needed."""
+        entry = self._sessions.get(log_id)
+        if entry is not None:
+            entry['last_used'] = time.monotonic()
+            self._sessions.move_to_end(log_id)
+            context = entry['context']
+            agent_stamp = _agent_stamp(context.agent_name)
+            if agent_stamp != entry['agent_stamp']:
+                # agent.json was edited, pick up the changes
+                context.agent = await service_manager.get_agent_data(context.agent_name, context)
+                context.flags = context.agent.get('flags', [])
+                entry['agent_stamp'] = agent_stamp
+            return context
+
+        # concurrent callers wait for the same load
+        if log_id not in self._loading:
+            self._loading[log_id] = asyncio.ensure_future(self._load(log_id))
+        try:
+            return await asyncio.shield(self._loading[log_id])
+        finally:
+            self._loading.pop(log_id, None)
+
+    async def _load(self, log_id) -> ChatContext:
+        context = ChatContext(command_manager, service_manager)
+        await context.load_context(log_id)
+        self.add(context)
+        return context
+
+    def evict(self, log_id) -> bool:
+        """Save a session and drop it from memory, unless it is in use.
+
+        Returns:
+            bool: False if the session is in use and was kept
+        """
+        if self.in_use(log_id):
+            return False
+        self._locks.pop(log_id, None)
+        entry = self._sessions.pop(log_id, None)
+        if entry is None:
+            return True
+        try:
+            entry['context'].save_context(immediate=True)
+        except Exception as e:
+            print(f"Error saving evicted session {log_id}: {e}")
+        return True
+
+    def _evict(self) -> None:
+        now = time.monotonic()
+        # not the session just added or used, even if the others are all in use
+        for log_id in list(self._sessions.keys())[:-1]:
+            over_capacity = len(self._sessions) > self.max_sessions
+            idle = now - self._sessions[log_id]['last_used'] > self.idle_timeout
+            if not over_capacity and not idle:
+                # the rest were used more recently
+                break
+            self.evict(log_id)
+
+    def flush(self) -> None:
+        """Save all sessions."""
+        for log_id, entry in list(self._sessions.items()):
+            try:
+                entry['context'].save_context(immediate=True)
+            except Exception as e:
+                print(f"Error saving session {log_id}: {e}")
+
+
+def _agent_stamp(agent_name):
+    for scope in ['local', 'shared']:
+        agent_file = os.path.join('data/agents', scope, agent_name, 'agent.json')
+        try:
+            return os.stat(agent_file).st_mtime_ns
+        except (FileNotFoundError, TypeError):
+            continue
+    return None
+
+
+session_cache = SessionCache()
+
+
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+class TestSessionCache(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.cache = SessionCache(max_sessions=2, idle_timeout=3600)
+
+    def context(self, log_id):
+        return SimpleNamespace(log_id=log_id, agent_name='no_such_agent', save_context=mock.Mock())
+
+    async def test_lru_eviction(self):
+        contexts = [self.context(f's{i}') for i in range(3)]
+        self.cache.add(contexts[0])
+        self.cache.add(contexts[1])
+        self.assertIs(await self.cache.get('s0'), contexts[0])
+        self.cache.add(contexts[2])
+        # s1 was the least recently used, it is saved and dropped
+        self.assertEqual(list(self.cache._sessions), ['s0', 's2'])
+        contexts[1].save_context.assert_called_once_with(immediate=True)
+
+    async def test_sessions_in_use_kept(self):
+        contexts = [self.context(f's{i}') for i in range(4)]
+        self.cache.add(contexts[0])
+        async with self.cache.use('s0'):
+            self.cache.add(contexts[1])
+            async with self.cache.use('s1', lock=True):
+                self.cache.add(contexts[2])
+                self.assertFalse(self.cache.evict('s0'))
+                self.assertFalse(self.cache.evict('s1'))
+                self.assertEqual(list(self.cache._sessions), ['s0', 's1', 's2'])
+        contexts[0].save_context.assert_not_called()
+        self.cache.add(contexts[3])
+        self.assertEqual(list(self.cache._sessions), ['s2', 's3'])
+        self.assertEqual(self.cache._users, {})
+
+    async def test_runs_serialized(self):
+        self.cache.add(self.context('s0'))
+        log = []
+
+        async def run(name):
+            async with self.cache.use('s0', lock=True):
+                log.append(name + ' start')
+                await asyncio.sleep(0.01)
+                log.append(name + ' end')
+
+        first = asyncio.ensure_future(run('first'))
+        await asyncio.sleep(0)
+        second = asyncio.ensure_future(run('second'))
+        await asyncio.sleep(0)
+        # waiting for the lock counts as in use, so the lock isn't replaced
+        self.assertTrue(self.cache.in_use('s0'))
+        self.assertFalse(self.cache.evict('s0'))
+        await asyncio.gather(first, second)
+        self.assertEqual(log, ['first start', 'first end', 'second start', 'second end'])
+        self.assertFalse(self.cache.in_use('s0'))
+
+    async def test_concurrent_loads_shared(self):
+        loaded = []
+
+        async def load(log_id):
+            await asyncio.sleep(0.01)
+            context = self.context(log_id)
+            loaded.append(context)
+            self.cache.add(context)
+            return context
+
+        with mock.patch.object(self.cache, '_load', load):
+            first, second = await asyncio.gather(self.cache.get('s0'), self.cache.get('s0'))
+        self.assertEqual(len(loaded), 1)
+        self.assertIs(first, second)
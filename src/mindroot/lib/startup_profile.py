@@ -0,0 +1,129 @@
+"""Startup profiling for the server (mindroot --profile-startup).
+
+Records how long each module import takes (nested imports are attributed to
+the module importing them), plus timings of startup phases such as plugin
+loading and startup() hooks. The report is written as JSON and as collapsed
+stacks ("frame;frame;frame microseconds" lines) that flamegraph.pl,
+speedscope and similar tools can read.
+"""
+import builtins
+import importlib
+import importlib.util
+import json
+import sys
+import threading
+import time
+
+
+class StartupProfiler:
+
+    def __init__(self):
+        # module name -> seconds, including the modules it imported
+        self.imports = {}
+        # collapsed stack -> seconds of self time
+        self.stacks = {}
+        # (name, seconds) of startup phases
+        self.phases = []
+        self._stack = []
+        self._original_import = None
+        self._original_import_module = None
+        self._thread = None
+        self.started = None
+
+    def install(self):
+        """Start timing imports made on this thread."""
+        self.started = time.perf_counter()
+        self._thread = threading.get_ident()
+        self._original_import = builtins.__import__
+        self._original_import_module = importlib.import_module
+        builtins.__import__ = self._import
+        importlib.import_module = self._import_module
+
+    def uninstall(self):
+        if self._original_import is not None:
+            builtins.__import__ = self._original_import
+            importlib.import_module = self._original_import_module
+            self._original_import = None
+
+    def _timed(self, name, do_import):
+        if name in sys.modules or threading.get_ident() != self._thread:
+            return do_import()
+        frame = [name, time.perf_counter(), 0.0]
+        self._stack.append(frame)
+        try:
+            return do_import()
+        finally:
+            self._stack.pop()
+            total = time.perf_counter() - frame[1]
+            self.imports[name] = self.imports.get(name, 0.0) + total
+            stack = ';'.join(['import'] + [f[0] for f in self._stack] + [name])
+            self.stacks[stack] = self.stacks.get(stack, 0.0) + total - frame[2]
+            if self._stack:
+                self._stack[-1][2] += total
+
+    def _import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        full_name = name
+        if level > 0:
+            try:
+                package = (globals or {}).get('__package__') or (globals or {}).get('__name__')
+                full_name = importlib.util.resolve_name('.' * level + name, package)
+            except (ImportError, ValueError):
+                pass
+        return self._timed(full_name, lambda: self._original_import(name, globals, locals, fromlist, level))
+
+    def _import_module(self, name, package=None):
+        full_name = name
+        if name.startswith('.'):
+            try:
+                full_name = importlib.util.resolve_name(name, package)
+            except (ImportError, ValueError):
+                pass
+        return self._timed(full_name, lambda: self._original_import_module(name, package))
+
+    def add_phase(self, name, seconds):
+        """Record a startup phase, name is a ';' separated stack."""
+        self.phases.append((name, seconds))
+        self.stacks[name] = self.stacks.get(name, 0.0) + seconds
+
+    def report(self):
+        return {
+            'total_seconds': time.perf_counter() - self.started if self.started else None,
+            'imports': dict(sorted(self.imports.items(), key=lambda item: -item[1])),
+            'phases': [{'name': name, 'seconds': seconds} for name, seconds in self.phases],
+            'stacks': self.collapsed_stacks()
+        }
+
+    def collapsed_stacks(self):
+        """Stacks in collapsed format, with microsecond counts."""
+        return [f"{stack} {round(seconds * 1e6)}" for stack, seconds in self.stacks.items()
+                if round(seconds * 1e6) > 0]
+
+    def write(self, path='startup_profile.json'):
+        """Write the JSON report, and the collapsed stacks next to it (.folded)."""
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+        folded_path = path.rsplit('.', 1)[0] + '.folded'
+        with open(folded_path, 'w') as f:
+            f.write('\n'.join(self.collapsed_stacks()) + '\n')
+        return path, folded_path
+
+    def print_summary(self, top=25):
+        total = time.perf_counter() - self.started if self.started else 0
+        print(f"Startup took {total * 1000:.1f} ms")
+        print(f"Slowest imports (ms, including nested imports):")
+        for name, seconds in sorted(self.imports.items(), key=lambda item: -item[1])[:top]:
+            print(f"  {seconds * 1000:9.1f}  {name}")
+        print(f"Slowest startup phases (ms):")
+        for name, seconds in sorted(self.phases, key=lambda item: -item[1])[:top]:
+            print(f"  {seconds * 1000:9.1f}  {name}")
+
+
+profiler = None
+
+def start():
+    """Create the profiler and start timing imports."""
+    global profiler
+    if profiler is None:
+        profiler = StartupProfiler()
+        profiler.install()
+    return profiler
@@ -1,6 +1,6 @@
 import os
 from jinja2 import Environment, FileSystemLoader, ChoiceLoader
-from .plugins import list_enabled, get_plugin_path
+from .plugins import list_enabled, get_plugin_path, on_manifest_change
 
 def setup_template_environment():
     """Set up Jinja2 environment with multiple template paths.
@@ -44,6 +44,23 @@ def setup_template_environment():
 # Create a Jinja2 environment with multiple template paths
 env = setup_template_environment()
 
+# (page_name, enabled plugins) -> resolved templates, see resolve_templates()
+_template_cache = {}
+
+@on_manifest_change
+def clear_template_cache():
+    """Drop all resolved templates, e.g. after plugins are installed or toggled."""
+    _template_cache.clear()
+
+def _file_stamp(paths):
+    stamp = {}
+    for path in paths:
+        try:
+            stamp[path] = os.stat(path).st_mtime_ns
+        except OSError:
+            stamp[path] = None
+    return stamp
+
 async def find_parent_template(page_name, plugins):
     """Find parent template in enabled plugins.
     
@@ -131,7 +148,7 @@ async def load_plugin_templates(page_name, plugins):
                 if os.path.exists(path):
                     with open(path) as f:
                         print(f"Found inject template at: {path}")
-                        templates.append({'type': 'inject', 'template': env.from_string(f.read())})
+                        templates.append({'type': 'inject', 'template': env.from_string(f.read()), 'path': path})
                         break
                 else:
                     print(f"Inject template not found at: {path}")
@@ -147,7 +164,7 @@ async def load_plugin_templates(page_name, plugins):
                 if os.path.exists(path):
                     with open(path) as f:
                         print(f"Found override template at: {path}")
-                        templates.append({'type': 'override', 'template': env.from_string(f.read())})
+                        templates.append({'type': 'override', 'template': env.from_string(f.read()), 'path': path})
                         break
                         
         except Exception as e:
@@ -155,6 +172,74 @@ async def load_plugin_templates(page_name, plugins):
             continue
     return templates
 
+async def resolve_templates(page_name, plugins):
+    """Find and compile the templates for a page.
+
+    Results are cached per page and enabled plugin set, and reloaded when one
+    of the inject/override files changes. The parent template is reloaded by
+    the Jinja2 environment itself.
+
+    Args:
+        page_name (str): Name of the template page
+        plugins (list): List of enabled plugins
+
+    Returns:
+        dict: parent_template_path, child_templates and the compiled combined
+              child templates by overridden blocks
+    """
+    key = (page_name, tuple(plugins))
+    resolved = _template_cache.get(key)
+    if resolved is not None and _file_stamp(resolved['stamp']) == resolved['stamp']:
+        return resolved
+
+    parent_template_path = await find_parent_template(page_name, plugins)
+
+    print("\033[92m" + "----------------------------------")
+    print("parent_template_path", parent_template_path)
+    print("page name", page_name, "plugins:", plugins)
+    print("\033[0m")
+
+    if not parent_template_path:
+        parent_template_path = f'templates/{page_name}.jinja2'
+        if not os.path.exists(parent_template_path):
+            raise FileNotFoundError(f"Template not found: {page_name}")
+
+    child_templates = await load_plugin_templates(page_name, plugins)
+    print("child_templates", child_templates)
+
+    resolved = {
+        'parent_template_path': parent_template_path,
+        'child_templates': child_templates,
+        'combined': {},
+        'stamp': _file_stamp([child['path'] for child in child_templates])
+    }
+    _template_cache[key] = resolved
+    return resolved
+
+def get_combined_template(resolved, blocks, overrides):
+    """Get the compiled template that extends the parent with the combined blocks.
+
+    Args:
+        resolved (dict): Resolved templates from resolve_templates()
+        blocks (list): Block names of the parent template
+        overrides (tuple): Names of the blocks that are overridden
+
+    Returns:
+        Template: Compiled combined child template
+    """
+    template = resolved['combined'].get(overrides)
+    if template is not None:
+        return template
+    combined_template_str = '{% extends layout_template %}\n'
+    for block in blocks:
+        if block in overrides:
+            combined_template_str += f'{{% block {block} %}}\n    {{{{ combined_{block}_override|safe }}}}\n{{% endblock %}}\n'
+        else:
+            combined_template_str += f'{{% block {block} %}}\n  {{{{ super() }}}}\n   {{{{ combined_{block}_inject|safe }}}}\n{{% endblock %}}\n'
+    template = env.from_string(combined_template_str)
+    resolved['combined'][overrides] = template
+    return template
+
 async def collect_content(template, blocks, template_type, data):
     """Collect content from child templates.
     
@@ -190,32 +275,20 @@ async def render_combined_template(page_name, plugins, context):
         str: Rendered HTML
     """
     print("plugins:", plugins)
-    parent_template_path = await find_parent_template(page_name, plugins)
-    
-    print("\033[92m" + "----------------------------------")
-    print("parent_template_path", parent_template_path)
-    print("page name", page_name, "plugins:", plugins, "context:", context)
-    print("\033[0m")
-    
-    if parent_template_path:
-        try:
-            parent_template = env.get_template(parent_template_path)
-        except Exception as e:
-            print(f"Error loading template {parent_template_path}: {e}")
-            print(f"Template search paths: {[l.searchpath for l in env.loader.loaders]}")
-            raise
-    else:
-        default_path = f'templates/{page_name}.jinja2'
-        if not os.path.exists(default_path):
-            raise FileNotFoundError(f"Template not found: {page_name}")
-        parent_template = env.get_template(default_path)
+    resolved = await resolve_templates(page_name, plugins)
+    parent_template_path = resolved['parent_template_path']
 
-    child_templates = await load_plugin_templates(page_name, plugins)
+    try:
+        parent_template = env.get_template(parent_template_path)
+    except Exception as e:
+        print(f"Error loading template {parent_template_path}: {e}")
+        print(f"Template search paths: {[l.searchpath for l in env.loader.loaders]}")
+        raise
+
+    child_templates = resolved['child_templates']
     parent_blocks = parent_template.blocks.keys()
     all_content = {block: {'inject': [], 'override': None} for block in parent_blocks}
 
-    print("child_templates", child_templates)
-
     for child_template_info in child_templates:
         print("calling collect_content")
         child_content = await collect_content(
@@ -230,14 +303,8 @@ async def render_combined_template(page_name, plugins, context):
             else:
                 all_content[block]['inject'].extend(content['inject'])
 
-    combined_template_str = '{% extends layout_template %}\n'
-    for block in all_content:
-        if all_content[block]['override']:
-            combined_template_str += f'{{% block {block} %}}\n    {{{{ combined_{block}_override|safe }}}}\n{{% endblock %}}\n'
-        else:
-            combined_template_str += f'{{% block {block} %}}\n  {{{{ super() }}}}\n   {{{{ combined_{block}_inject|safe }}}}\n{{% endblock %}}\n'
-
-    combined_child_template = env.from_string(combined_template_str)
+    overrides = tuple(block for block in all_content if all_content[block]['override'])
+    combined_child_template = get_combined_template(resolved, list(all_content), overrides)
 
     combined_inject = {}
     combined_override = {}
@@ -14,47 +14,136 @@ test3="""
 [{"think": {"extensive_chain_of_thoughts": "Let me review each route file for missing imports:\n\n1. upload_routes.py:\n- Needs traceback for error handling\n\n2. processing_routes.py:\n- Needs datetime for timestamp handling\n- Needs to import load_financial_assumptions\n\n3. results_routes.py:\n- Needs datetime for current_datetime usage\n\n4. common.py looks complete\n\nLet me update these files one at a time with the missing imports."}}], {"write": {"fname": "/xfiles/maverickcre/plugins/cre_b
 """
 
-def merge_json_arrays(data, partial=False):
-    print("merge_json_arrays, partial=", partial)
-    if partial:
-        load_json = partial_json_loads
-        #print("load_json is partial_json_loads")
-    else:
-        #print("load_json is json.loads")
-        load_json = json.loads
-    data = data.strip()
-    parts = re.split(r"\]\s*,*\s*\[", data)
-    if len(parts) == 1 and parts[0] == data:
-        parts = re.split(r"\]\s*,*\s*\{", data)
-    arrays = []
-    for part in parts:
-        if part.startswith("{"):
-            part = "[" + part
-        if not part.startswith("["):
-            part = "[" + part
-        if part.endswith(","):
-            part = part[:-1].strip()
-        if part.endswith('}') and not part.endswith("]"):
-            part += "]"
+_decoder = json.JSONDecoder(strict=False)
+_TOP_LEVEL = re.compile(r'[\[{]')
+_ITEM_OR_END = re.compile(r'[^\s,]')
+_VALUE_TOKEN = re.compile(r'["\[\]{},]')
+# the rest of a string after its opening quote
+_STRING_REST = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*"', re.S)
+_STRING = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"?', re.S)
+_CONTROL = re.compile(r'[\x00-\x1f]')
+
+
+def _escape_controls(match):
+    return _CONTROL.sub(lambda m: json.dumps(m.group())[1:-1], match.group())
+
+
+def _value_end(data, pos):
+    """End of the (invalid) JSON value starting at pos, skipping over strings.
+
+    Returns:
+        int: Index after the value, or None if the text ends inside it
+    """
+    depth = 0
+    while True:
+        m = _VALUE_TOKEN.search(data, pos)
+        if m is None:
+            return None
+        c = m.group()
+        i = m.start()
+        if c == '"':
+            end = _STRING_REST.match(data, i + 1)
+            if end is None:
+                return None
+            pos = end.end()
+        elif c == '[' or c == '{':
+            depth += 1
+            pos = i + 1
+        elif depth == 0:
+            # ',' or the ']' closing the array the value is in
+            return i
+        else:
+            depth -= 1
+            pos = i + 1
+            if depth == 0:
+                return pos
+
+
+def iter_json_array_items(data, partial=False):
+    """Yield the items of one or more concatenated JSON arrays.
+
+    The text is read once: each item is decoded where it starts (strings
+    and all, by the json module) and only the separators between items are
+    scanned here, so brackets inside string values don't matter. Arrays may
+    be separated by commas and whitespace ("[...][...]" or "[...], [...]"),
+    and objects outside of an array ("[...], {...}") are yielded as items
+    too. Line breaks inside strings are accepted.
+
+    The items of an array are yielded once it is closed, or at the end of
+    the text if it ends between items of the last array (a missing "]").
+    Arrays with an item that isn't valid JSON are skipped, like a last array
+    the text ends in the middle of, unless partial is set.
+
+    Args:
+        data (str): Text with the arrays, may end in the middle of an item
+        partial (bool): Also yield the items of a last array the text ends
+                        in the middle of, the unfinished item parsed as
+                        partial JSON
+
+    Yields:
+        The decoded items (usually command objects)
+    """
+    pos = 0
+    n = len(data)
+    in_array = False
+    # items of the current array, None once one was invalid
+    items = []
+    while pos < n:
+        m = (_ITEM_OR_END if in_array else _TOP_LEVEL).search(data, pos)
+        if m is None:
+            break
+        i = m.start()
+        c = data[i]
+        if in_array and c == ']':
+            if items:
+                yield from items
+            in_array = False
+            items = []
+            pos = i + 1
+            continue
+        if c == '[' and not in_array:
+            in_array = True
+            pos = i + 1
+            continue
         try:
-            arrays.append(load_json(part))
-        except Exception as e:
-            try:
-                part = part.replace("\n", "\\n")
-                # if ends with \\n, remove it
-                if part.endswith("\\n"):
-                    part = part[:-2]
-                part = part.strip()
-                if part.startswith('["'):
-                    part = "[{" + part[1:]
-                arrays.append(load_json(part))
-            except Exception as e:
-                pass
-                #print("Error parsing part: ", part)
-                #print(e)
-
-    #print("returning sum(arrays, []):", sum(arrays, []))
-    return sum(arrays, [])
+            item, pos = _decoder.raw_decode(data, i)
+            if items is not None:
+                items.append(item)
+            if not in_array:
+                yield from items
+                items = []
+            continue
+        except ValueError:
+            pass
+        end = _value_end(data, i)
+        if end is None:
+            # the text ends inside this item
+            if partial and items is not None:
+                yield from items
+                try:
+                    yield partial_json_loads(_STRING.sub(_escape_controls, data[i:]))
+                except Exception:
+                    pass
+            return
+        # skip the rest of the array
+        items = None
+        pos = max(end, i + 1)
+        if not in_array:
+            items = []
+
+    # the last array wasn't closed, but its last item is complete
+    if in_array and items:
+        yield from items
+
+
+def merge_json_arrays(data, partial=False):
+    """Items of one or more concatenated JSON arrays, as one list.
+
+    See iter_json_array_items().
+    """
+    items = []
+    items.extend(iter_json_array_items(data, partial))
+    return items
 
 
 #ret = merge_json_arrays(test3, False)
@@ -64,3 +153,50 @@ def merge_json_arrays(data, partial=False):
 #    print(item)
 #    print('-----------------------------------')
 
+
+import unittest
+
+class TestMergeJsonArrays(unittest.TestCase):
+    A = {"say": {"text": "a"}}
+    B = {"say": {"text": "b"}}
+
+    def test_same_as_bracket_split(self):
+        # outputs of the bracket split parser this replaced
+        A, B = self.A, self.B
+        cases = [
+            ('[{"say": {"text": "a"}}]\n', [A], [A]),
+            ('[{"say": {"text": "a"}}', [A], [A]),
+            ('[{"say": {"text": "a"}}][{"say": {"text": "b"}}', [A, B], [A, B]),
+            ('[{"say": {"text": "a"}}, {"say": {"text": "b"}}', [A, B], [A, B]),
+            ('[{"say": {"text": "a"}}, {"say": {"text": "b"}},\n ', [A, B], [A, B]),
+            ('[{"say": {"text": "a"}}, {"say": {"text": "b', [], [A, B]),
+            ('[{"say": {"text": "a"}}], {"say": {"text": "b"}}', [A, B], [A, B]),
+        ]
+        for text, complete, partial in cases:
+            self.assertEqual(merge_json_arrays(text), complete, text)
+            self.assertEqual(merge_json_arrays(text, partial=True), partial, text)
+
+    def test_brackets_in_strings(self):
+        tricky = '[{"say": {"text": "arrays look like ], [ in text"}}][{"say": {"text": "line\nbreak"}}]'
+        self.assertEqual(merge_json_arrays(tricky), [{"say": {"text": "arrays look like ], [ in text"}},
+                                                     {"say": {"text": "line\nbreak"}}])
+
+    def test_invalid_array_skipped(self):
+        text = '[{"say": {"text": "a"}}][{"say": {"text": "b"}, {"bad"}][{"say": {"text": "b"}}]'
+        self.assertEqual(merge_json_arrays(text), [self.A, self.B])
+
+
+if __name__ == "__main__":
+    # python -m lib.utils.merge_arrays
+    import time
+
+    for name, text in [('test', test), ('test2', test2), ('test3', test3)]:
+        print(name, 'complete:', [list(item) for item in merge_json_arrays(text)],
+              'partial:', [list(item) for item in merge_json_arrays(text, partial=True)])
+
+    command = '[{"say": {"text": "' + 'Some streamed text, with [brackets] and {braces}. ' * 20 + '"}}]'
+    text = command * 200
+    start = time.perf_counter()
+    items = merge_json_arrays(text)
+    elapsed = time.perf_counter() - start
+    print(f"{len(items)} commands from {len(text)} characters in {elapsed * 1000:.1f} ms")
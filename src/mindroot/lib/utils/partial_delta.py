@@ -0,0 +1,157 @@
+"""Delta encoding of partial command arguments.
+
+While a command is being streamed, its arguments usually change only by
+text being appended to the string argument that is being generated. Instead
+of sending all of the arguments again for every token, a partial_command
+event then carries just that text:
+
+    {"command": "say", "instance": 3, "path": ["text"], "offset": 120, "suffix": "lo wor"}
+
+meaning the string at params["text"] is now its first `offset` characters
+followed by `suffix`. Any other change is sent as a full snapshot:
+
+    {"command": "say", "instance": 3, "params": {"text": "..."}}
+
+instance numbers the streamed commands, so the events of two consecutive
+commands with the same name are never merged into one.
+
+Run this module to compare the bytes sent for a streamed 20 KB markdown
+command with and without deltas:
+
+    python -m lib.utils.partial_delta
+"""
+import copy
+import json
+
+
+# characters at the end of the previous string compared by find_append()
+APPEND_CHECK = 64
+
+
+def find_append(old, new, path=()):
+    """Check whether new is old with text appended to one string.
+
+    Streamed arguments only grow at the end, so for a longer string only the
+    last APPEND_CHECK characters of the old one are compared, not all of it.
+
+    Args:
+        old: Previous arguments (str, list or dict)
+        new: Current arguments
+
+    Returns:
+        tuple: (path, offset, suffix) with path as a list of keys/indexes,
+               or None if the arguments changed in some other way
+    """
+    if isinstance(new, str):
+        if isinstance(old, str) and len(new) > len(old):
+            offset = len(old)
+            start = max(0, offset - APPEND_CHECK)
+            if new[start:offset] == old[start:]:
+                return list(path), offset, new[offset:]
+        return None
+    if isinstance(new, dict):
+        if not isinstance(old, dict) or len(old) != len(new) or old.keys() != new.keys():
+            return None
+        changed = [key for key, value in new.items() if value is not old[key] and value != old[key]]
+    elif isinstance(new, list):
+        if not isinstance(old, list) or len(old) != len(new):
+            return None
+        changed = [i for i, value in enumerate(new) if value is not old[i] and value != old[i]]
+    else:
+        return None
+    if len(changed) != 1:
+        return None
+    key = changed[0]
+    return find_append(old[key], new[key], path + (key,))
+
+
+def apply_delta(params, path, offset, suffix):
+    """Apply a delta to arguments, as the client does. Returns the new arguments."""
+    if not path:
+        return params[:offset] + suffix
+    params = copy.copy(params)
+    params[path[0]] = apply_delta(params[path[0]], path[1:], offset, suffix)
+    return params
+
+
+class PartialCommandEncoder:
+    """Builds the partial_command event data for one chat session."""
+
+    def __init__(self):
+        self.command = None
+        self.params = None
+        # number of the command being streamed, sent as "instance" so events
+        # of two commands with the same name aren't merged
+        self.instance = 0
+
+    def encode(self, command, params, complete=False):
+        """Event data for the current arguments of a streamed command.
+
+        Args:
+            command (str): Command name
+            params: Arguments parsed so far (may be changed in place by the parser)
+            complete (bool): The command is complete, always send a snapshot so
+                             clients that missed a delta end up with the full arguments
+
+        Returns:
+            dict: Event data, or None if nothing changed since the last event
+        """
+        if command != self.command:
+            self.instance += 1
+        if not complete and command == self.command and self.params is not None:
+            delta = find_append(self.params, params)
+            if delta is not None:
+                path, offset, suffix = delta
+                # the strings are shared, only the containers are copied
+                self.params = copy.deepcopy(params)
+                return {"command": command, "instance": self.instance, "path": path, "offset": offset, "suffix": suffix}
+            if params == self.params:
+                return None
+        if complete:
+            self.command = None
+            self.params = None
+        else:
+            self.command = command
+            self.params = copy.deepcopy(params)
+        return {"command": command, "instance": self.instance, "params": params}
+
+
+if __name__ == '__main__':
+    import time
+
+    paragraph = ("Streaming **markdown** with `code`, \"quotes\" and a list:\n"
+                 "- one\n- two\n\n")
+    markdown = (paragraph * (20000 // len(paragraph) + 1))[:20000]
+    # about 4 characters per token
+    tokens = [markdown[i:i + 4] for i in range(0, len(markdown), 4)]
+
+    start = time.perf_counter()
+    full_bytes = 0
+    text = ''
+    for token in tokens:
+        text += token
+        params = {"markdown": text}
+        full_bytes += len(json.dumps({"command": "json_encoded_md", "chunk": json.dumps(params), "params": params}))
+    full_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    delta_bytes = 0
+    encoder = PartialCommandEncoder()
+    text = ''
+    params = {"markdown": text}
+    received = None
+    for token in tokens:
+        text += token
+        params["markdown"] = text
+        data = encoder.encode("json_encoded_md", params)
+        delta_bytes += len(json.dumps(data))
+        if 'params' in data:
+            received = copy.deepcopy(data['params'])
+        else:
+            received = apply_delta(received, data['path'], data['offset'], data['suffix'])
+    delta_time = time.perf_counter() - start
+    assert received == {"markdown": markdown}
+
+    print(f"{len(tokens)} partial_command events for a {len(markdown)} character markdown argument")
+    print(f"full arguments: {full_bytes:>12,} bytes  {full_time * 1000:8.1f} ms")
+    print(f"deltas:         {delta_bytes:>12,} bytes  {delta_time * 1000:8.1f} ms")
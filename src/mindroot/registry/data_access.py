@@ -1,5 +1,6 @@
 import json
 import os
+import time
 
 class DataAccess:
     def __init__(self):
@@ -9,6 +10,10 @@ class DataAccess:
         self.plugins_file = 'plugin_manifest.json'
         self.equivalent_flags_file = os.path.join(self.data_dir, 'equivalent_flags.json')
         self.preferred_models_file = os.path.join(self.data_dir, 'preferred_models.json')
+        # derived data (indexes etc.) keyed by name, see cached()
+        self._cache = {}
+        # seconds between checks of the source files of a cached value
+        self.check_interval = 1.0
 
     def read_json(self, file_path):
         with open(file_path, 'r') as f:
@@ -17,6 +22,42 @@ class DataAccess:
     def write_json(self, file_path, data):
         with open(file_path, 'w') as f:
             json.dump(data, f, indent=2)
+        self.invalidate()
+
+    # Cache
+    def _file_stamp(self, file_path):
+        try:
+            stat = os.stat(file_path)
+            return (stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            return None
+
+    def cached(self, key, file_paths, build):
+        """Return build(), rebuilding only when one of file_paths changed.
+
+        Files are compared by mtime and size (at most every check_interval
+        seconds) so edits made outside of DataAccess (manual edits etc.) are
+        picked up too. A new object is returned after each rebuild, so
+        callers can compare identities to detect changes. Values are shared
+        between callers and must not be modified.
+        """
+        now = time.monotonic()
+        entry = self._cache.get(key)
+        if entry is not None and now - entry[2] < self.check_interval:
+            return entry[1]
+        stamp = tuple(self._file_stamp(path) for path in file_paths)
+        if entry is not None and entry[0] == stamp:
+            entry[2] = now
+            return entry[1]
+        value = build()
+        self._cache[key] = [stamp, value, now]
+        return value
+
+    def invalidate(self, key=None):
+        if key is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(key, None)
 
     # Models
     def read_models(self):
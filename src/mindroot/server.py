@@ -1,3 +1,9 @@
+import sys
+if '--profile-startup' in sys.argv:
+    # start timing before anything else is imported
+    from .lib import startup_profile
+    startup_profile.start()
+
 from fastapi import FastAPI
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
@@ -8,12 +14,15 @@ import asyncio
 import uvicorn
 from termcolor import colored
 import socket
+import time
 # actually need a good way to part commmand line args
 
 def parse_args():
     import argparse
     parser = argparse.ArgumentParser(description="Run the server")
     parser.add_argument("-p", "--port", type=int, help="Port to run the server on")
+    parser.add_argument("--profile-startup", action="store_true",
+                        help="Profile imports, plugin loading and startup hooks, write startup_profile.json and exit")
     return parser.parse_args()
 
 def get_project_root():
@@ -71,8 +80,45 @@ def find_available_port(start_port=8010, max_attempts=100):
         port += 1
     raise RuntimeError(f"Could not find an available port after {max_attempts} attempts")
 
+def add_startup_phases(profiler):
+    """Add plugin load steps and startup() hook durations to the profile."""
+    hooks = {}
+    for module_name in ['lib.providers.hooks', 'mindroot.lib.providers.hooks']:
+        hook_module = sys.modules.get(module_name)
+        if hook_module is not None:
+            for hook_info in hook_module.hook_manager.hooks.get('startup', []):
+                if 'last_duration' in hook_info:
+                    implementation = hook_info['implementation']
+                    hooks[implementation.__module__] = hook_info['last_duration']
+
+    for plugin_name, timings in plugins.loader.load_timings.items():
+        for step, seconds in timings.items():
+            # imports are already in the import stacks
+            if step in ['total', 'import']:
+                continue
+            if plugin_name == 'startup' and step == 'on_load':
+                for hook_module, hook_seconds in hooks.items():
+                    profiler.add_phase(f"plugins;startup;on_load;startup();{hook_module}", hook_seconds)
+                    seconds -= hook_seconds
+            profiler.add_phase(f"plugins;{plugin_name};{step}", seconds)
+
+def profile_startup(loop):
+    profiler = startup_profile.profiler
+    start = time.perf_counter()
+    loop.run_until_complete(setup_app())
+    setup_seconds = time.perf_counter() - start
+    profiler.uninstall()
+    add_startup_phases(profiler)
+    profiler.print_summary()
+    print(f"setup_app() took {setup_seconds * 1000:.1f} ms (on_load hooks run concurrently)")
+    json_path, folded_path = profiler.write('startup_profile.json')
+    print(colored(f"Wrote {json_path} and {folded_path} (collapsed stacks, in microseconds)", "green"))
+
 def main():
     loop = asyncio.get_event_loop()
+    if '--profile-startup' in sys.argv:
+        profile_startup(loop)
+        return
     app = loop.run_until_complete(setup_app())
     
     try: